@@ -19,51 +19,203 @@
 # - LEGO TouchSensor connected to port BBS2
 #
 
+import asyncio
+import atexit
+from functools import partial
 from os import environ
-from time import sleep
 
-from picamera import PiCamera
-
-from ksm_tictactoe_core_ps import Board, minimax, human_moves_from_image
+from ksm_tictactoe_core_ps import BitBoard
 from ksm_tictactoe_userinterface import show_start_screen, show_start_menu, \
-     show_end_screen, show_message
-from ksm_tictactoe_lego_devices import Tic_tac_toe_machine
+     show_end_screen, show_message, touchscreen
+from ksm_tictactoe_events import SensorWatcher, Aborted, abortable, \
+     run_blocking, drain
+from ksm_tictactoe_lego_devices import Tic_tac_toe_machine, configure_ports
+from ksm_tictactoe_camera import FrameGrabber
+from ksm_tictactoe_calibration import GridCalibration, CALIBRATION_FILE
+from ksm_tictactoe_vision import IncrementalDetector, \
+     human_moves_incremental, StreamingMoveDetector, StreamEnded, \
+     DebugImageWriter, load_engine
+from ksm_tictactoe_movetable import MoveTable, TABLE_FILE
+from ksm_tictactoe_archive import CaptureArchive, board_labels
+from ksm_tictactoe_search import timed_search
+from ksm_tictactoe_moveserver import MoveClient
+from ksm_tictactoe_speculation import SpeculativeMover
+from ksm_tictactoe_profiler import Profiler
+from ksm_tictactoe_startup import Startup, start_camera
+from ksm_tictactoe_motortrace import configure as configure_motor_trace
+from ksm_tictactoe_telemetry import timed
+from ksm_tictactoe_retry import health
+
+
+def load_move_table():
+    ''' Precomputed move table (build with ksm_tictactoe_movetable.py).'''
+    try:
+        return MoveTable(TABLE_FILE)
+    except (OSError, ValueError):
+        return None
+
+
+# Start the hardware in parallel: the start screen shows while the camera
+# warms up and the pen goes home
+startup = Startup()
+startup.add('screen', show_start_screen)
+startup.add('camera', partial(start_camera, (1024, 768)))
+startup.add('ports', configure_ports)
+startup.add('machine', lambda ports: Tic_tac_toe_machine(home=False),
+            after=('ports',))
+startup.add('pen_home', lambda machine: machine.pen.home(),
+            after=('machine',))
+startup.add('calibration', partial(GridCalibration.load, CALIBRATION_FILE))
+startup.add('move_table', load_move_table)
+started = startup.run()
+print(startup.report())
 
 # Picamera
-camera = PiCamera()
-camera.resolution = (1024, 768)
-camera.start_preview()
+camera = started['camera']
+# Capture frames in memory for human move detection
+grabber = FrameGrabber(camera)
+# Examine only the empty fields that changed since the previous turn, with
+# the detector engine tuned offline (ksm_tictactoe_archive.py --save), if
+# any
+detector = IncrementalDetector(engine=load_engine())
+# Calibrated board grid, recalibrated when the camera has moved
+grid = started['calibration']
 
 # Tic tac toe board
-board = Board()
+board = BitBoard()
 
 # Tic tac toe machine
-m = Tic_tac_toe_machine()
+m = started['machine']
+# Wait for the TouchSensor without blocking the event loop
+play_sensor = SensorWatcher(m.ts_play)
+
+# Record the motor traces of every drawn move, for tuning the motion
+# (see ksm_tictactoe_motortrace.py)
+if environ.get('KSM_TICTACTOE_MOTOR_TRACE'):
+    configure_motor_trace(
+        m.motors, environ['KSM_TICTACTOE_MOTOR_TRACE'],
+        rate=int(environ.get('KSM_TICTACTOE_MOTOR_RATE', 100)))
+
+# Detect human moves from the video stream instead of waiting for the
+# TouchSensor
+STREAMING_DETECTION = False
+
+# Debug images of detected moves: 'off', 'latest' or 'keep' (rotated)
+DEBUG_IMAGES = 'latest'
+
+# Maximum thinking time of the computer when searching (seconds)
+SEARCH_BUDGET = 0.5
+
+# Move server shared by several rigs (see ksm_tictactoe_moveserver.py);
+# the computer searches itself when it can not be reached
+MOVE_SERVER = environ.get('KSM_TICTACTOE_MOVE_SERVER')
+
+# Compute the replies to all human moves while the human is thinking
+SPECULATE = True
+# Also move the pen sideways towards the likely replies. The turntable has
+# to stay home for the camera and its move takes longest, so this only
+# pays off on machines where the pen carriage is the slow axis.
+PRE_POSITION = False
+
+# Write debug images in the background
+debug_writer = DebugImageWriter(DEBUG_IMAGES, max_files=200)
+
+# Keep the frames of the human moves, to tune the detection offline with
+# ksm_tictactoe_archive.py (None: no archive)
+CAPTURE_ARCHIVE = 'captures'
+archive = None
+if CAPTURE_ARCHIVE:
+    archive = CaptureArchive(CAPTURE_ARCHIVE, max_frames=1000)
+    atexit.register(archive.close)
+
+# Precomputed move table
+move_table = started['move_table']
+
+move_client = None
+if MOVE_SERVER:
+    move_client = MoveClient(MOVE_SERVER)
+
+
+def detect_human_move():
+    ''' Detect the new human move on the board.'''
+    # The turntable may still be going home after the computer's move
+    m.wait_until_home()
+    before = board_labels(board)
+    result = human_moves_incremental(camera, board, detector, grabber, grid,
+                                     debug_writer)
+    if archive is not None:
+        archive.record(grabber.frame, before, board)
+    return result
+
+
+if STREAMING_DETECTION:
+    streamer = StreamingMoveDetector(camera, detect_human_move)
+    streamer.start()
+
+
+async def wait_for_streamed_move():
+    ''' Wait for the human move in the video stream; raises StreamEnded
+        when the stream has ended.'''
+    while True:
+        # Short waits, so an abort does not leave a thread waiting
+        result = await run_blocking(streamer.wait_for_move, 0.5)
+        if result is not None:
+            return result
+
+
+@timed('computer_move')
+def computer_move(board):
+    ''' Determine the computer's move: move server, table lookup, search
+        as fallback.'''
+    if move_client is not None and len(board.index) == 9:
+        result = move_client.move(board)
+        if result is not None:
+            return result
+    if move_table is not None and len(board.index) == 9:
+        result = move_table.lookup(board)
+        if result is not None:
+            return result
+    return timed_search(board, board.AI_PLAYER, SEARCH_BUDGET)
+
+
+speculator = None
+if SPECULATE:
+    speculator = SpeculativeMover(
+        computer_move, m.pre_position if PRE_POSITION else None)
+
+# Profile the time of every phase of every move and print it per game
+if environ.get('KSM_TICTACTOE_PROFILE'):
+    profiler = Profiler()
+    grabber.capture = profiler.wrap('capture', grabber.capture)
+    detect_human_move = profiler.wrap('vision', detect_human_move)
+    computer_move = profiler.wrap('search', computer_move, 'computer')
+    if speculator is not None:
+        speculator.reply = profiler.wrap('search', speculator.reply,
+                                         'computer')
+    m.draw_computer_move = profiler.wrap('motion', m.draw_computer_move)
+    play_sensor.bump = profiler.wrap('human', play_sensor.bump, 'human')
+    wait_for_streamed_move = profiler.wrap('human', wait_for_streamed_move,
+                                           'human')
+    show_end_screen = profiler.wrap('display', show_end_screen)
+    show_message = profiler.wrap('display', show_message)
+    show_start_menu = profiler.wrap('human', show_start_menu, 'game')
+
 
 #
 # Gameplay
 #
 
-# Show start screen
-show_start_screen()
-
-# Start game
-while True:
-
-    # Show start menu and ask which player will start the game
-    start_player = show_start_menu()
-    if start_player == 'STOP_PROGRAM':
-        show_end_screen()
-        break
-    elif start_player == 'AI_PLAYER':
-        show_message('The computer will start...', 2)
-        computer = True
-    else:
-        show_message('Human player will start...', 2)
-        computer = False
+async def play(computer):
+    ''' Play one game; computer is True when the computer starts. Every
+        stage is aborted when the GO button is pressed.'''
+    global board, STREAMING_DETECTION
+    go = touchscreen.go
 
     # Reset board
     board.reset()
+    detector.reset()
+    if STREAMING_DETECTION:
+        streamer.reset()
 
     # Each game has 9 moves to play
     for move in range(0, 9):
@@ -72,31 +224,44 @@ while True:
             # It's computer's turn
             show_message('Wait for the computer\nto make its move...', 0)
 
-            if move < 1:
-                # Computer plays first, place X on index 0
-                board.index[0] = board.AI_PLAYER
-                computer = False
-                # Draw computer move
-                m.draw_computer_move(0)
-                show_message('Computer move: 0', 0)
+            if speculator is not None:
+                result = await abortable(
+                    run_blocking(speculator.reply, board), go)
             else:
-                result = minimax(board, board.AI_PLAYER)
-                board.index[result['index']] = board.AI_PLAYER
-                computer = False
+                result = await abortable(
+                    run_blocking(computer_move, board), go)
+            board.index[result['index']] = board.AI_PLAYER
+            computer = False
 
-                # Draw computer move
-                m.draw_computer_move(result['index'])
-                show_message('Computer move:' + str(result['index']), 0)
+            # Draw computer move
+            await abortable(
+                run_blocking(m.draw_computer_move, result['index']), go)
+            show_message('Computer move:' + str(result['index']), 0)
 
         else:
             # It's the human's turn
-            show_message('It is your turn.\nMake a move and press TouchSensor', 0)
+            if speculator is not None:
+                speculator.start(board)
+            result = None
+            if STREAMING_DETECTION:
+                show_message('It is your turn.\nMake a move', 0)
+
+                # Detect human move as soon as the hand has left the board
+                try:
+                    result = await abortable(wait_for_streamed_move(), go)
+                except StreamEnded:
+                    # No more video: use the TouchSensor from now on
+                    STREAMING_DETECTION = False
+            if result is None:
+                show_message('It is your turn.\n'
+                             'Make a move and press TouchSensor', 0)
 
-            # Wait for human player to make his move and press TouchSenor
-            m.ts_play.wait_for_bump(timeout_ms=None)
+                # Wait for human player to make his move and press TouchSenor
+                await abortable(play_sensor.bump(), go)
 
-            # Detect human move by using PiCamera
-            nr_circles, board = human_moves_from_image(camera, board)
+                # Detect human move by using PiCamera
+                result = await abortable(run_blocking(detect_human_move), go)
+            nr_circles, board = result
             show_message('Aantal: {}'.format(nr_circles), 2)
             computer = True
 
@@ -122,4 +287,42 @@ while True:
         if move == 8:
             show_message('It is a tie!!', 4)
 
-    start_player = ''
+
+async def gameplay():
+    # Start game
+    while True:
+
+        # Show start menu and ask which player will start the game
+        start_player = await show_start_menu()
+        if start_player == 'STOP_PROGRAM':
+            show_end_screen()
+            break
+        elif start_player == 'AI_PLAYER':
+            show_message('The computer will start...', 2)
+            computer = True
+        else:
+            show_message('Human player will start...', 2)
+            computer = False
+
+        # Every game gives ports that failed a new chance (the cable may
+        # have been fixed)
+        health.reset()
+
+        try:
+            await play(computer)
+        except Aborted:
+            # GO button pressed: stop the machine and back to the menu
+            show_message('Game aborted', 2)
+            m.stop()
+            if speculator is not None:
+                speculator.stop(wait=False)
+            await drain()
+            await run_blocking(m.park)
+
+
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+try:
+    loop.run_until_complete(gameplay())
+finally:
+    loop.close()
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+''' Archive of captured frames and offline replay through the vision.
+
+CaptureArchive keeps the frame of every human move the game detects, as
+a JPEG file, with the board before and after the detection in index.jsonl
+(one JSON record per line). The after board is what the game detected:
+when that was wrong, correct it in index.jsonl, replay() takes it as the
+truth.
+
+replay() runs all frames of an archive through the detection of the
+game, human_moves_incremental(), on a multiprocessing pool, with the
+detector of the game or a candidate set of HoughCircles and
+adaptiveThreshold parameters (see HoughDetector), and reports the
+detection accuracy and frames per second. Compare candidates with the
+game's detection, and with --save let the game use the best one:
+    python3 ksm_tictactoe_archive.py captures --param param2=30,40,50 \
+        --param c=2.5,3.5 --save
+Try it without the machine on a synthetic archive:
+    python3 ksm_tictactoe_archive.py /tmp/captures --synthetic 200
+'''
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import threading
+from time import perf_counter, time
+
+import cv2
+import numpy as np
+
+from ksm_tictactoe_camera import FileCamera, FrameGrabber, render_board
+from ksm_tictactoe_calibration import GridCalibration, CALIBRATION_FILE
+from ksm_tictactoe_core_ps import Board
+from ksm_tictactoe_vision import HoughDetector, IncrementalDetector, \
+     human_moves_incremental, load_engine, save_engine, ENGINE_FILE, \
+     EMPTY, HUMAN, COMPUTER
+
+INDEX_FILE = 'index.jsonl'
+
+
+def board_labels(board):
+    ''' Return the board as 9 labels ('O', 'X' or '.').'''
+    labels = []
+    for value in board.index:
+        if value == board.HU_PLAYER:
+            labels.append(HUMAN)
+        elif value == board.AI_PLAYER:
+            labels.append(COMPUTER)
+        else:
+            labels.append(EMPTY)
+    return ''.join(labels)
+
+
+def board_from_labels(labels, board_factory=Board):
+    ''' Return a new board with the fields of 9 labels.'''
+    board = board_factory()
+    for i, label in enumerate(labels):
+        if label == HUMAN:
+            board.index[i] = board.HU_PLAYER
+        elif label == COMPUTER:
+            board.index[i] = board.AI_PLAYER
+    return board
+
+
+class CaptureArchive:
+    ''' Frames with the board before and after the move, in directory.
+
+    record() copies the frame and returns at once; the JPEG is encoded
+    and written on a background thread. When the queue is full the oldest
+    frame is dropped, so the game never waits. Beyond max_frames the
+    oldest frame files are removed (their records stay in the index).
+    '''
+    def __init__(self, directory='captures', quality=90, max_frames=1000,
+                 queue_size=4):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.quality = quality
+        self.max_frames = max_frames
+        self.dropped = 0
+        self.errors = 0
+        # Continue after the frames already in the archive
+        self.written = sorted(name for name in os.listdir(directory)
+                              if name.startswith('frame_') and
+                              name.endswith('.jpg'))
+        self._counter = len(load_index(directory))
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def record(self, frame, before, after):
+        ''' Queue a camera frame with the boards (labels or boards)
+            before and after the move.'''
+        if not isinstance(before, str):
+            before = board_labels(before)
+        if not isinstance(after, str):
+            after = board_labels(after)
+        item = (frame.copy(), before, after, time())
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def flush(self):
+        ''' Wait until all queued frames are written.'''
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        ''' Write the queued frames and stop the writer thread.'''
+        if self._thread is not None:
+            # A writer thread that has gone would never take the stop item
+            if self._thread.is_alive():
+                self._queue.put(None)
+                self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            try:
+                self._write(*item)
+            except Exception as error:
+                # A failed frame (e.g. a full SD card) must not stop the
+                # writer thread
+                self.errors += 1
+                print('Warning: frame not archived: {}'.format(
+                    str(error).strip()))
+            finally:
+                self._queue.task_done()
+
+    def _write(self, frame, before, after, timestamp):
+        name = 'frame_{:06d}.jpg'.format(self._counter + 1)
+        ok, data = cv2.imencode('.jpg', frame,
+                                [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            raise OSError('Cannot encode ' + name)
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(data.tobytes())
+        height, width = frame.shape[:2]
+        record = {'frame': name, 'size': [width, height], 'before': before,
+                  'after': after, 'time': round(timestamp, 3)}
+        with open(os.path.join(self.directory, INDEX_FILE), 'a') as f:
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+        # Count only recorded frames: the counter restarts from the index
+        self._counter += 1
+        self.written.append(name)
+        while len(self.written) > self.max_frames:
+            try:
+                os.remove(os.path.join(self.directory, self.written.pop(0)))
+            except OSError:
+                pass
+
+
+def load_index(directory):
+    ''' Return all records of the archive in directory.'''
+    try:
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def load_archive(directory):
+    ''' Return the records of the archive whose frames still exist, with
+        the full path of the frame as 'path'.'''
+    records = []
+    for record in load_index(directory):
+        path = os.path.join(directory, record['frame'])
+        if os.path.exists(path):
+            record['path'] = path
+            records.append(record)
+    return records
+
+
+# Detection state of a replay worker process
+_worker = {}
+
+
+def _init_worker(params, calibration):
+    # Without params the detector of the game: its engine file, or the
+    # built-in check per field when there is none
+    engine = load_engine() if params is None else HoughDetector(**params)
+    _worker['detector'] = IncrementalDetector(engine=engine)
+    _worker['grid'] = None
+    if calibration is not None:
+        grid = GridCalibration.load(calibration)
+        # Never overwrite the calibration of the game
+        grid.filename = None
+        _worker['grid'] = grid
+
+
+def _replay_record(record):
+    ''' Detect the move of one record, return (board after, seconds).'''
+    camera = FileCamera([record['path']], tuple(record['size']))
+    grabber = FrameGrabber(camera)
+    board = board_from_labels(record['before'])
+    detector = _worker['detector']
+    # Every record is a first look at its board
+    detector.reset()
+    start = perf_counter()
+    human_moves_incremental(camera, board, detector, grabber,
+                            _worker['grid'])
+    return board_labels(board), perf_counter() - start
+
+
+def replay(directory, params=None, processes=None,
+           calibration=CALIBRATION_FILE, chunksize=4):
+    ''' Run the archive in directory through human_moves_incremental().
+
+    params are HoughDetector parameters of a candidate; None replays the
+    detection of the game (its engine file, see load_engine()).
+    calibration is the grid calibration file (None: fixed board crop).
+    Returns the number of frames, the field accuracy, the fraction of
+    boards with all fields right, the fraction of moves detected
+    exactly (the new circles), frames per second on all processes and
+    the mean latency per frame in milliseconds.
+    '''
+    records = load_archive(directory)
+    if not records:
+        raise ValueError('No frames in archive ' + directory)
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (params, calibration))
+    try:
+        start = perf_counter()
+        results = pool.map(_replay_record, records, chunksize)
+        elapsed = perf_counter() - start
+    finally:
+        pool.close()
+        pool.join()
+    fields_right = 0
+    boards_right = 0
+    moves_right = 0
+    latency = 0.0
+    for record, (after, seconds) in zip(records, results):
+        right = sum(a == b for a, b in zip(after, record['after']))
+        fields_right += right
+        boards_right += right == 9
+        moves_right += _new_moves(record['before'], after) == \
+            _new_moves(record['before'], record['after'])
+        latency += seconds
+    frames = len(records)
+    return {'frames': frames,
+            'field_accuracy': fields_right / (9.0 * frames),
+            'board_accuracy': boards_right / float(frames),
+            'move_accuracy': moves_right / float(frames),
+            'fps': frames / elapsed,
+            'latency_ms': 1000.0 * latency / frames}
+
+
+def _new_moves(before, after):
+    return [i for i in range(9) if before[i] != HUMAN and after[i] == HUMAN]
+
+
+def candidates(param_options):
+    ''' Return all parameter sets of options 'name=v1,v2,...'.'''
+    names = []
+    values = []
+    for option in param_options:
+        name, _, options = option.partition('=')
+        names.append(name)
+        values.append([_number(value) for value in options.split(',')])
+    return [dict(zip(names, combination))
+            for combination in itertools.product(*values)]
+
+
+def _number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def synthetic_archive(directory, count, seed=2018):
+    ''' Fill an archive with noisy synthetic frames of random turns.'''
+    rng = np.random.RandomState(seed)
+    archive = CaptureArchive(directory, max_frames=count)
+    for _ in range(count):
+        # A position of a game with the computer's and human's moves
+        moves = rng.permutation(9)[:rng.randint(1, 9)]
+        before = [EMPTY] * 9
+        for nr, index in enumerate(moves[:-1]):
+            before[index] = COMPUTER if nr % 2 == 0 else HUMAN
+        after = list(before)
+        after[moves[-1]] = HUMAN
+        frame = render_board(after)
+        noise = rng.normal(0, 6, frame.shape)
+        frame = np.clip(frame + noise, 0, 255).astype(np.uint8)
+        archive.record(frame, ''.join(before), ''.join(after))
+        archive.flush()
+    archive.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay captured frames through the move detection.')
+    parser.add_argument('directory', help='capture archive')
+    parser.add_argument('--param', action='append', default=[],
+                        help='HoughDetector parameter values, e.g. '
+                             'param2=30,40,50 (repeat for a grid)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes (default: all CPUs)')
+    parser.add_argument('--calibration', default=CALIBRATION_FILE,
+                        help='grid calibration file')
+    parser.add_argument('--crop', action='store_true',
+                        help='fixed board crop instead of the grid')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='first add this many synthetic frames')
+    parser.add_argument('--save', action='store_true',
+                        help='let the game use the best parameters '
+                             '(writes {})'.format(ENGINE_FILE))
+    args = parser.parse_args()
+
+    if args.synthetic:
+        synthetic_archive(args.directory, args.synthetic)
+    calibration = None if args.crop else args.calibration
+    reports = []
+    # The detection of the game first: candidates have to beat it
+    param_sets = [None]
+    if args.param:
+        param_sets += candidates(args.param)
+    for params in param_sets:
+        report = replay(args.directory, params, args.processes, calibration)
+        reports.append((report['move_accuracy'], report['fps'], params,
+                        report))
+        print('{:40s} moves {:6.1%}  fields {:6.1%}  boards {:6.1%}  '
+              '{:6.1f} fps  {:6.2f} ms/frame'.format(
+                  _label(params), report['move_accuracy'],
+                  report['field_accuracy'], report['board_accuracy'],
+                  report['fps'], report['latency_ms']))
+    # On a tie the first: the game's detection before the candidates
+    best = max(reports, key=lambda item: item[:2])
+    if len(reports) > 1:
+        print('Best: {} ({} frames)'.format(_label(best[2]),
+                                            best[3]['frames']))
+    if args.save:
+        if best[2] is None:
+            print('No candidate beats the game, {} not changed'.format(
+                  ENGINE_FILE))
+        else:
+            save_engine(best[2])
+            print('Saved to {}'.format(ENGINE_FILE))
+
+
+def _label(params):
+    return 'game' if params is None else json.dumps(params)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+''' Hardware backend of the game: the real PiStorms devices or simulated
+ones.
+
+Select the backend with the environment variable KSM_TICTACTOE_BACKEND:
+- 'ev3dev' (default): ev3dev2, evdev and picamera on the real machine
+- 'simulated':        ksm_tictactoe_simulated_devices, runs headless
+
+Play two simulated games with:
+    KSM_TICTACTOE_BACKEND=simulated KSM_TICTACTOE_GAMES=2 \
+        python3 ksm_tictactoe.py
+'''
+from os import environ
+
+BACKEND = environ.get('KSM_TICTACTOE_BACKEND', 'ev3dev')
+
+__all__ = ['BACKEND', 'LegoPort', 'Motor', 'LargeMotor', 'TouchSensor',
+           'Display', 'InputDevice', 'PiCamera']
+
+if BACKEND == 'simulated':
+    from ksm_tictactoe_simulated_devices import \
+         SimulatedLegoPort as LegoPort, \
+         SimulatedMotor as Motor, \
+         SimulatedMotor as LargeMotor, \
+         SimulatedTouchSensor as TouchSensor, \
+         SimulatedDisplay as Display, \
+         SimulatedInputDevice as InputDevice, \
+         simulated_camera as PiCamera
+elif BACKEND == 'ev3dev':
+    from ev3dev2.port import LegoPort
+    from ev3dev2.motor import Motor, LargeMotor
+    from ev3dev2.sensor.lego import TouchSensor
+    from ev3dev2.display import Display
+    from evdev import InputDevice
+    from picamera import PiCamera
+else:
+    raise ValueError('Unknown backend: ' + BACKEND)
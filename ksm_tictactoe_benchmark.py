@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+''' Benchmark suite for the hot paths of ksm_tictactoe_ps.
+
+Times minimax(), the Board operations and human_moves_from_image() with
+warm-up runs and statistical repeats, and writes the results as JSON so
+runs on different commits can be compared. Runs without picamera and
+ev3dev: board photos are replayed through a FileCamera. Without recorded
+photos, synthetic board images are used.
+
+Example:
+    python3 ksm_tictactoe_benchmark.py --images 'photos/*.jpg' \\
+        --output benchmark_results.json
+'''
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime
+from time import perf_counter
+
+import cv2
+
+from ksm_tictactoe_camera import FileCamera, FrameGrabber, render_board
+from ksm_tictactoe_core_ps import Board, BitBoard, minimax, \
+     human_moves_from_image
+from ksm_tictactoe_movetable import reachable_boards
+
+
+def measure(func, warmup=3, repeats=20, number=1):
+    ''' Time func, return statistics of the time per call (seconds).'''
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        for _ in range(number):
+            func()
+        times.append((perf_counter() - start) / number)
+    return {'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.mean(times),
+            'stdev': statistics.stdev(times) if repeats > 1 else 0.0,
+            'repeats': repeats,
+            'number': number}
+
+
+def sample_boards(board_class, count=50, seed=2018):
+    ''' Return reachable positions as boards of board_class.'''
+    rng = random.Random(seed)
+    boards = []
+    for board in rng.sample(list(reachable_boards()), count):
+        sample = board_class()
+        for i in range(9):
+            sample.index[i] = board.index[i]
+        boards.append(sample)
+    return boards
+
+
+def bench_minimax(board_class, step=1, warmup=1, repeats=3):
+    ''' Time minimax() from every reachable position (every step-th).'''
+    boards = []
+    for i, board in enumerate(reachable_boards()):
+        if i % step == 0:
+            sample = board_class()
+            for j in range(9):
+                sample.index[j] = board.index[j]
+            boards.append(sample)
+
+    def run():
+        for board in boards:
+            minimax(board, board.AI_PLAYER)
+
+    result = measure(run, warmup, repeats)
+    result['positions'] = len(boards)
+    return result
+
+
+def bench_board_ops(board_class, repeats=20):
+    ''' Time the Board operations over a set of positions.'''
+    boards = sample_boards(board_class)
+    points = [(x, y) for x in range(0, 220, 11) for y in range(0, 200, 10)]
+    results = {}
+
+    def empty_indexes():
+        for board in boards:
+            board.empty_indexes()
+
+    def check_for_winner():
+        for board in boards:
+            board.check_for_winner(board.AI_PLAYER)
+            board.check_for_winner(board.HU_PLAYER)
+
+    def add_human_move_to_board():
+        board = board_class()
+        for x, y in points:
+            board.add_human_move_to_board(x, y)
+
+    results['empty_indexes'] = measure(empty_indexes, repeats=repeats,
+                                       number=100)
+    results['empty_indexes']['calls'] = len(boards)
+    results['check_for_winner'] = measure(check_for_winner, repeats=repeats,
+                                          number=100)
+    results['check_for_winner']['calls'] = 2 * len(boards)
+    results['add_human_move_to_board'] = measure(add_human_move_to_board,
+                                                 repeats=repeats,
+                                                 number=100)
+    results['add_human_move_to_board']['calls'] = len(points)
+    return results
+
+
+def synthetic_images(directory, count=10, seed=2018):
+    ''' Write synthetic board photos, return their filenames.'''
+    rng = random.Random(seed)
+    images = []
+    for i in range(count):
+        fields = [rng.choice(('O', 'X', None)) for _ in range(9)]
+        filename = os.path.join(directory, 'board{}.jpg'.format(i))
+        cv2.imwrite(filename, render_board(fields))
+        images.append(filename)
+    return images
+
+
+def bench_vision(images, in_memory=False, warmup=2, repeats=10):
+    ''' Time human_moves_from_image() per frame on recorded photos.'''
+    camera = FileCamera(images)
+    grabber = FrameGrabber(camera) if in_memory else None
+    cwd = os.getcwd()
+    # human_moves_from_image() writes its images to the working directory
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            result = measure(lambda: human_moves_from_image(camera, Board(),
+                                                            grabber),
+                             warmup, repeats, number=len(camera.images))
+        finally:
+            os.chdir(cwd)
+    result['frames'] = len(camera.images)
+    return result
+
+
+def git_commit():
+    ''' Return current git commit, or None.'''
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the benchmark suite.')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--images',
+                        help='glob of recorded board photos')
+    parser.add_argument('--quick', action='store_true',
+                        help='minimax from every 20th position only')
+    args = parser.parse_args()
+
+    results = {}
+    step = 20 if args.quick else 1
+    for board_class in (Board, BitBoard):
+        name = board_class.__name__
+        print('Benchmarking {}...'.format(name))
+        results['minimax.' + name] = bench_minimax(board_class, step)
+        for op, stats in bench_board_ops(board_class).items():
+            results['{}.{}'.format(op, name)] = stats
+
+    print('Benchmarking human_moves_from_image...')
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.images:
+            images = [os.path.abspath(image)
+                      for image in sorted(glob.glob(args.images))]
+        else:
+            images = synthetic_images(tmp)
+        results['human_moves_from_image'] = bench_vision(images)
+        results['human_moves_from_image.in_memory'] = bench_vision(
+            images, in_memory=True)
+
+    report = {'commit': git_commit(),
+              'timestamp': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, stats in sorted(results.items()):
+        print('{:40s} median {:12.6f} ms  stdev {:10.6f} ms'.format(
+              name, stats['median'] * 1000, stats['stdev'] * 1000))
+    print('Results written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+''' Calibration of the drawn tic tac toe grid on the camera image.
+
+The two vertical and two horizontal grid lines are found once with
+HoughLinesP, around the expected board region. Their four crossings give
+a perspective transform to a rectified board of 3 x 3 square cells, and
+with it the cell boundaries.
+The calibration is cached in a file and only redone when the cached grid
+lines are no longer on the image (e.g. the camera was bumped).
+
+Calibrate from a photo with:
+    python3 ksm_tictactoe_calibration.py photo.jpg
+'''
+import argparse
+import itertools
+import json
+
+import cv2
+import numpy as np
+
+from ksm_tictactoe_camera import ROI_X, ROI_Y
+
+CALIBRATION_FILE = 'calibration.json'
+
+
+class CalibrationError(Exception):
+    ''' Grid lines could not be found on the image.'''
+    pass
+
+
+def _fit_line(points):
+    ''' Fit a line to points, return (point, direction).'''
+    vx, vy, x, y = cv2.fitLine(np.float32(points), cv2.DIST_L2, 0,
+                               0.01, 0.01).ravel()
+    return np.array((x, y)), np.array((vx, vy))
+
+
+def _candidate_lines(segments, axis, max_lines, gap=10):
+    ''' Group segments that lie on one line (position across the line
+        within gap pixels), return the fitted lines of the max_lines
+        groups with the most segment length.'''
+    if not len(segments):
+        return []
+    # Position across the line: mean x of vertical segments, mean y of
+    # horizontal segments
+    positions = (segments[:, axis] + segments[:, axis + 2]) / 2
+    lengths = np.hypot(segments[:, 2] - segments[:, 0],
+                       segments[:, 3] - segments[:, 1])
+    order = np.argsort(positions)
+    groups = np.split(order, np.flatnonzero(
+        np.diff(positions[order]) > gap) + 1)
+    groups.sort(key=lambda group: -lengths[group].sum())
+    lines = []
+    for group in sorted(groups[:max_lines],
+                        key=lambda group: positions[group].mean()):
+        points = np.concatenate((segments[group, 0:2],
+                                 segments[group, 2:4]))
+        lines.append(_fit_line(points))
+    return lines
+
+
+def _ink(frame, tolerance=3):
+    ''' Return the dark lines on frame, widened by tolerance pixels
+        (lines may be a few pixels off).'''
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    ink = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
+                                cv2.THRESH_BINARY_INV, 15, 10)
+    return cv2.dilate(ink, np.ones((2 * tolerance + 1,) * 2, np.uint8))
+
+
+def _intersection(line1, line2):
+    ''' Return crossing point of two lines given as (point, direction).'''
+    (p1, d1), (p2, d2) = line1, line2
+    matrix = np.array(((d1[0], -d2[0]), (d1[1], -d2[1])))
+    t = np.linalg.solve(matrix, p2 - p1)[0]
+    return p1 + t * d1
+
+
+class GridCalibration:
+    ''' Perspective transform and cell boundaries of the drawn grid.'''
+    def __init__(self, corners=None, cell_size=70, filename=None):
+        # File to cache the calibration in
+        self.filename = filename
+        # Crossings of the grid lines in the camera image: top-left,
+        # top-right, bottom-left, bottom-right
+        self.corners = None
+        self.cell_size = cell_size
+        self.transform = None
+        if corners is not None:
+            self._set_corners(corners)
+
+    @property
+    def calibrated(self):
+        return self.transform is not None
+
+    @property
+    def boundaries(self):
+        ''' Field boundaries (x0, y0, x1, y1) on the rectified board.'''
+        s = self.cell_size
+        return (s, s, 2 * s, 2 * s)
+
+    def _set_corners(self, corners):
+        self.corners = np.float32(corners).reshape(4, 2)
+        s = self.cell_size
+        target = np.float32(((s, s), (2 * s, s), (s, 2 * s), (2 * s, 2 * s)))
+        self.transform = cv2.getPerspectiveTransform(self.corners, target)
+
+    def calibrate(self, frame, min_length=40, roi=(ROI_Y, ROI_X),
+                  margin=0.5, max_lines=6):
+        ''' Find the grid lines on a camera frame.
+
+        Lines are only searched in the expected board region roi = (y
+        range, x range), widened by margin times its size on every side
+        for a camera that has moved. Of the vertical and horizontal lines
+        found there, the two pairs whose grid is best covered by ink and
+        most regular (square cells) are taken, so other lines (table
+        edges, the machine) do not spoil the calibration.
+        '''
+        height, width = frame.shape[:2]
+        (y0, y1), (x0, x1) = roi
+        dy = int((y1 - y0) * margin)
+        dx = int((x1 - x0) * margin)
+        y0, y1 = max(0, y0 - dy), min(height, y1 + dy)
+        x0, x1 = max(0, x0 - dx), min(width, x1 + dx)
+        gray = cv2.cvtColor(frame[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+        edges = cv2.Canny(cv2.GaussianBlur(gray, (5, 5), 0), 50, 150)
+        segments = cv2.HoughLinesP(edges, 1, np.pi / 180, 60,
+                                   minLineLength=min_length, maxLineGap=10)
+        if segments is None:
+            raise CalibrationError('No lines found')
+        segments = segments.reshape(-1, 4).astype(np.float64) + \
+            (x0, y0, x0, y0)
+        dx = segments[:, 2] - segments[:, 0]
+        dy = segments[:, 3] - segments[:, 1]
+        vertical = _candidate_lines(segments[np.abs(dy) > 2 * np.abs(dx)],
+                                    0, max_lines)
+        horizontal = _candidate_lines(segments[np.abs(dx) > 2 * np.abs(dy)],
+                                      1, max_lines)
+        if len(vertical) < 2 or len(horizontal) < 2:
+            raise CalibrationError('Grid lines not found')
+
+        ink = _ink(frame)
+        best = None
+        for left, right in itertools.combinations(vertical, 2):
+            for top, bottom in itertools.combinations(horizontal, 2):
+                corners = [_intersection(top, left),
+                           _intersection(top, right),
+                           _intersection(bottom, left),
+                           _intersection(bottom, right)]
+                try:
+                    self._set_corners(corners)
+                except cv2.error:
+                    continue
+                # Cell width against height: 0 for square cells
+                irregularity = abs(np.log(
+                    np.linalg.norm(corners[1] - corners[0]) /
+                    max(np.linalg.norm(corners[2] - corners[0]), 1e-6)))
+                score = self._coverage(ink) - irregularity
+                if best is None or score > best[0]:
+                    best = (score, corners)
+        if best is not None:
+            self._set_corners(best[1])
+        if best is None or not self.matches(frame):
+            self.transform = None
+            raise CalibrationError('Grid lines do not match')
+
+    def _line_samples(self, samples=50):
+        ''' Return sample points on the 4 grid lines in the camera image.'''
+        s = self.cell_size
+        t = np.linspace(0.05, 0.95, samples) * 3 * s
+        ones = np.ones_like(t)
+        rectified = np.concatenate((
+            np.stack((s * ones, t), axis=1),
+            np.stack((2 * s * ones, t), axis=1),
+            np.stack((t, s * ones), axis=1),
+            np.stack((t, 2 * s * ones), axis=1)))
+        inverse = np.linalg.inv(self.transform)
+        points = cv2.perspectiveTransform(
+            np.float32(rectified).reshape(-1, 1, 2), inverse)
+        return points.reshape(-1, 2)
+
+    def matches(self, frame, min_fraction=0.6, tolerance=3):
+        ''' Check if the calibrated grid lines are on the frame.'''
+        if not self.calibrated:
+            return False
+        return self._coverage(_ink(frame, tolerance)) >= min_fraction
+
+    def _coverage(self, ink):
+        ''' Fraction of the grid line samples on ink (0 when the grid
+            is not all on the image).'''
+        points = np.round(self._line_samples()).astype(np.intp)
+        height, width = ink.shape
+        inside = (points[:, 0] >= 0) & (points[:, 0] < width) & \
+                 (points[:, 1] >= 0) & (points[:, 1] < height)
+        if not inside.all():
+            return 0.0
+        return (ink[points[:, 1], points[:, 0]] > 0).mean()
+
+    def ensure(self, frame):
+        ''' Make sure the calibration matches the frame, calibrate again
+            (and cache it) when it does not. Returns False when that
+            fails.'''
+        if self.matches(frame):
+            return True
+        try:
+            self.calibrate(frame)
+        except CalibrationError:
+            return False
+        if self.filename is not None:
+            self.save(self.filename)
+        return True
+
+    def warp(self, frame):
+        ''' Return the rectified board image (3 x 3 cells).'''
+        size = 3 * self.cell_size
+        return cv2.warpPerspective(frame, self.transform, (size, size))
+
+    def fields_for_points(self, points, rectified=True):
+        ''' Map points (x, y) to field indexes in one vectorised call.
+
+        Points on a boundary belong to the field right of or below it;
+        points outside the board are clipped to the nearest field.
+        '''
+        points = np.float32(points).reshape(-1, 2)
+        if not rectified:
+            points = cv2.perspectiveTransform(
+                points.reshape(-1, 1, 2), self.transform).reshape(-1, 2)
+        cells = np.clip(np.floor(points / self.cell_size), 0, 2)
+        cells = cells.astype(np.intp)
+        return cells[:, 1] * 3 + cells[:, 0]
+
+    def save(self, filename=CALIBRATION_FILE):
+        ''' Cache the calibration in a file.'''
+        self.filename = filename
+        with open(filename, 'w') as f:
+            json.dump({'corners': self.corners.tolist(),
+                       'cell_size': self.cell_size}, f)
+
+    @classmethod
+    def load(cls, filename=CALIBRATION_FILE):
+        ''' Load cached calibration; uncalibrated when there is none.'''
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return cls(filename=filename)
+        return cls(data['corners'], data['cell_size'], filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate the grid.')
+    parser.add_argument('image', help='camera photo of the board')
+    parser.add_argument('--output', default=CALIBRATION_FILE)
+    args = parser.parse_args()
+
+    grid = GridCalibration()
+    grid.calibrate(cv2.imread(args.image))
+    grid.save(args.output)
+    print('Grid crossings: {}'.format(grid.corners.tolist()))
+
+
+if __name__ == '__main__':
+    main()
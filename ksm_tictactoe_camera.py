@@ -0,0 +1,200 @@
+''' Camera sources for ksm_tictactoe_ps that work without a PiCamera.'''
+import shutil
+import threading
+from time import sleep
+
+import cv2
+import numpy as np
+
+from ksm_tictactoe_telemetry import span
+
+# Region of the tic tac toe board on a 1024x768 camera image
+ROI_Y = (150, 350)
+ROI_X = (410, 630)
+
+# Centres of the fields on the board region (matching Board boundaries)
+FIELD_X = (36, 111, 185)
+FIELD_Y = (30, 97, 167)
+
+
+class FileCamera:
+    ''' Stand-in for PiCamera that replays recorded images in turn.'''
+    def __init__(self, images, resolution=(1024, 768)):
+        self.images = list(images)
+        if not self.images:
+            raise ValueError('No images to replay')
+        self.resolution = resolution
+        self._next = 0
+        # Decoded images for raw captures
+        self._frames = {}
+
+    def next_image(self):
+        ''' Return filename of the next image to replay.'''
+        image = self.images[self._next % len(self.images)]
+        self._next += 1
+        return image
+
+    def capture(self, output, format=None, **kwargs):
+        ''' Capture the next image, like PiCamera.capture().
+
+        A filename gets a copy of the image file. A NumPy array gets the
+        decoded BGR pixels, like a raw 'bgr' capture on the PiCamera.
+        '''
+        image = self.next_image()
+        if isinstance(output, np.ndarray):
+            if image not in self._frames:
+                self._frames[image] = cv2.imread(image)
+            np.copyto(output, self._frames[image])
+        else:
+            shutil.copyfile(image, output)
+
+    def start_preview(self):
+        pass
+
+    def stop_preview(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class VideoFileCamera:
+    ''' Stand-in for PiCamera that plays a recorded video file.
+
+    capture_continuous() yields the frames of the video like the video
+    port of the PiCamera; capture() returns the frame being shown at that
+    moment. With realtime the video plays at its own frame rate.
+    '''
+    def __init__(self, filename, realtime=False):
+        self.filename = filename
+        self.realtime = realtime
+        video = cv2.VideoCapture(filename)
+        if not video.isOpened():
+            raise ValueError('Can not open video: ' + filename)
+        self.fps = video.get(cv2.CAP_PROP_FPS) or 30.0
+        self.resolution = (int(video.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                           int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        video.release()
+        self.finished = threading.Event()
+        self._current = None
+        self._lock = threading.Lock()
+
+    def capture_continuous(self, output, format='bgr', use_video_port=True,
+                           resize=None, **kwargs):
+        ''' Yield output for every frame of the video, filled with the
+            frame (resized to resize).'''
+        video = cv2.VideoCapture(self.filename)
+        try:
+            while True:
+                ok, frame = video.read()
+                if not ok:
+                    break
+                with self._lock:
+                    self._current = frame
+                if resize is not None:
+                    cv2.resize(frame, resize, dst=output,
+                               interpolation=cv2.INTER_AREA)
+                else:
+                    np.copyto(output, frame)
+                yield output
+                if self.realtime:
+                    sleep(1.0 / self.fps)
+        finally:
+            video.release()
+            self.finished.set()
+
+    def capture(self, output, format=None, **kwargs):
+        ''' Capture the current frame of the video.'''
+        with self._lock:
+            frame = self._current
+        if frame is None:
+            video = cv2.VideoCapture(self.filename)
+            ok, frame = video.read()
+            video.release()
+        if isinstance(output, np.ndarray):
+            np.copyto(output, frame)
+        else:
+            cv2.imwrite(output, frame)
+
+    def start_preview(self):
+        pass
+
+    def stop_preview(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def render_board(fields, resolution=(1024, 768)):
+    ''' Return a synthetic BGR camera image of a board.
+
+    fields holds 9 values: 'O' and 'X' are drawn, anything else is empty.
+    '''
+    width, height = resolution
+    img = np.full((height, width, 3), 235, dtype=np.uint8)
+    top, bottom = ROI_Y
+    left, right = ROI_X
+
+    # Grid lines between the fields
+    for x in (left + 72, left + 150):
+        cv2.line(img, (x, top), (x, bottom), (40, 40, 40), 3)
+    for y in (top + 60, top + 135):
+        cv2.line(img, (left, y), (right, y), (40, 40, 40), 3)
+
+    for i, value in enumerate(fields):
+        x = left + FIELD_X[i % 3]
+        y = top + FIELD_Y[i // 3]
+        if value == 'O':
+            cv2.circle(img, (x, y), 22, (30, 30, 30), 3)
+        elif value == 'X':
+            cv2.line(img, (x - 18, y - 18), (x + 18, y + 18), (30, 30, 30), 3)
+            cv2.line(img, (x - 18, y + 18), (x + 18, y - 18), (30, 30, 30), 3)
+    return img
+
+
+class FrameGrabber:
+    ''' Capture raw frames in memory for human move detection.
+
+    Frames are captured from the video port straight into a reused NumPy
+    buffer, without a file or JPEG step. The board region is a view on
+    that buffer and all preprocessing steps write into preallocated
+    buffers. Works with PiCamera and FileCamera.
+    '''
+    def __init__(self, camera, roi_y=ROI_Y, roi_x=ROI_X):
+        self.camera = camera
+        width, height = camera.resolution
+        self.roi_y = roi_y
+        self.roi_x = roi_x
+        self.frame = np.empty((height, width, 3), dtype=np.uint8)
+        shape = (roi_y[1] - roi_y[0], roi_x[1] - roi_x[0])
+        self.gray = np.empty(shape, dtype=np.uint8)
+        self.threshold = np.empty(shape, dtype=np.uint8)
+        self.blurred = np.empty(shape, dtype=np.uint8)
+        self.smoothed = np.empty(shape, dtype=np.uint8)
+
+    def capture(self):
+        ''' Capture a frame into the frame buffer and return it.'''
+        self.camera.capture(self.frame, 'bgr', use_video_port=True)
+        return self.frame
+
+    def grab(self):
+        ''' Capture a frame, return the board region (a view).'''
+        self.capture()
+        return self.frame[self.roi_y[0]:self.roi_y[1],
+                          self.roi_x[0]:self.roi_x[1]]
+
+    def preprocess(self, img):
+        ''' Same steps as core preprocess(), into the own buffers.'''
+        with span('vision.gray'):
+            cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        with span('vision.threshold'):
+            cv2.adaptiveThreshold(self.gray, 255,
+                                  cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                  cv2.THRESH_BINARY, 11, 3.5,
+                                  dst=self.threshold)
+        with span('vision.blur'):
+            cv2.GaussianBlur(self.threshold, (5, 5), 0, dst=self.blurred)
+        with span('vision.median'):
+            cv2.medianBlur(self.blurred, 5, dst=self.smoothed)
+        return self.smoothed
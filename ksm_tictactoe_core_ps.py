@@ -2,6 +2,8 @@
 import cv2
 import numpy as np
 
+from ksm_tictactoe_telemetry import span, timed
+
 
 class Board:
     ''' Tic tac toe board.'''
@@ -45,31 +47,171 @@ class Board:
 
     def add_human_move_to_board(self, x, y):
         ''' Determine index of human move. '''
-        if x < self.x0:
-            if y < self.y0:
-                self.index[0] = 'O'
-            elif y > self.y0 and y < self.y1:
-                self.index[3] = 'O'
-            elif y > self.y1:
-                self.index[6] = 'O'
-        elif x > self.x0 and x < self.x1:
-            if y < self.y0:
-                self.index[1] = 'O'
-            elif y > self.y0 and y < self.y1:
-                self.index[4] = 'O'
-            elif y > self.y1:
-                self.index[7] = 'O'
-        elif x > self.x1:
-            if y < self.y0:
-                self.index[2] = 'O'
-            elif y > self.y0 and y < self.y1:
-                self.index[5] = 'O'
-            elif y > self.y1:
-                self.index[8] = 'O'
+        field_index = field_from_position(x, y, self.x0, self.y0,
+                                          self.x1, self.y1)
+        if field_index is not None:
+            self.index[field_index] = 'O'
+
+
+def field_from_position(x, y, x0, y0, x1, y1):
+    ''' Return field index of position (x, y) on the image, or None when
+        the position is on a field boundary.'''
+    if x < x0:
+        column = 0
+    elif x > x0 and x < x1:
+        column = 1
+    elif x > x1:
+        column = 2
+    else:
+        return None
+    if y < y0:
+        row = 0
+    elif y > y0 and y < y1:
+        row = 1
+    elif y > y1:
+        row = 2
+    else:
+        return None
+    return row * 3 + column
+
+
+# Bit masks of the 8 winning lines (bit i is field index i)
+WIN_MASKS = (0b000000111, 0b000111000, 0b111000000,
+             0b001001001, 0b010010010, 0b100100100,
+             0b100010001, 0b001010100)
+
+# Lookup tables for all 512 combinations of 9 fields
+WINNING = tuple(any(bits & mask == mask for mask in WIN_MASKS)
+                for bits in range(512))
+EMPTY_INDEXES = tuple(tuple(i for i in range(9) if not bits >> i & 1)
+                      for bits in range(512))
+
+
+class BitBoard:
+    ''' Tic tac toe board stored as two 9-bit integers, one per player.
+
+    Drop-in replacement for Board: the fields are still available as
+    board.index through a list-like view.
+    '''
+    __slots__ = ('ai_bits', 'hu_bits', 'x0', 'y0', 'x1', 'y1', '_view')
+
+    # Define symbols for human player and computer
+    HU_PLAYER = 'O'
+    AI_PLAYER = 'X'
+
+    def __init__(self):
+        self.ai_bits = 0
+        self.hu_bits = 0
+        self._view = _IndexView(self)
+        # Field boundaries
+        self.x0 = 72
+        self.y0 = 60
+        self.x1 = 150
+        self.y1 = 135
+
+    @property
+    def index(self):
+        ''' List-like view on the fields.'''
+        return self._view
+
+    @index.setter
+    def index(self, fields):
+        self.ai_bits = 0
+        self.hu_bits = 0
+        for i, value in enumerate(fields):
+            self.set_field(i, value)
+
+    def set_field(self, i, value):
+        ''' Set field i to AI_PLAYER, HU_PLAYER or empty (any other value).'''
+        bit = 1 << i
+        if value == self.AI_PLAYER:
+            self.ai_bits |= bit
+            self.hu_bits &= ~bit
+        elif value == self.HU_PLAYER:
+            self.hu_bits |= bit
+            self.ai_bits &= ~bit
+        else:
+            self.ai_bits &= ~bit
+            self.hu_bits &= ~bit
+
+    def get_field(self, i):
+        ''' Return AI_PLAYER, HU_PLAYER or the index of an empty field.'''
+        bit = 1 << i
+        if self.ai_bits & bit:
+            return self.AI_PLAYER
+        if self.hu_bits & bit:
+            return self.HU_PLAYER
+        return i
+
+    def reset(self):
+        ''' Reset board for new game: empty all indexes.'''
+        self.ai_bits = 0
+        self.hu_bits = 0
+
+    def empty_indexes(self):
+        ''' Return all empty indexs.'''
+        return list(EMPTY_INDEXES[self.ai_bits | self.hu_bits])
+
+    def check_for_winner(self, player):
+        ''' Check if player is a winner.'''
+        if player == self.AI_PLAYER:
+            return WINNING[self.ai_bits]
+        if player == self.HU_PLAYER:
+            return WINNING[self.hu_bits]
+        return False
+
+    def add_human_move_to_board(self, x, y):
+        ''' Determine index of human move. '''
+        field_index = field_from_position(x, y, self.x0, self.y0,
+                                          self.x1, self.y1)
+        if field_index is not None:
+            self.set_field(field_index, self.HU_PLAYER)
 
 
+class _IndexView:
+    ''' List-like view on the fields of a BitBoard (compatibility with
+        Board.index).'''
+    __slots__ = ('_board',)
+
+    def __init__(self, board):
+        self._board = board
+
+    def __len__(self):
+        return 9
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._board.get_field(j) for j in range(9)[i]]
+        return self._board.get_field(range(9)[i])
+
+    def __setitem__(self, i, value):
+        self._board.set_field(range(9)[i], value)
+
+    def __iter__(self):
+        return (self._board.get_field(i) for i in range(9))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+@timed('minimax')
 def minimax(new_board, player):
     ''' Implementation of the minimax algorithm.'''
+    return _minimax(new_board, player)
+
+
+def _minimax(new_board, player):
+
+    # A BitBoard is searched on its bits directly
+    if isinstance(new_board, BitBoard):
+        index, score = _minimax_bits(new_board.ai_bits, new_board.hu_bits,
+                                     player == new_board.AI_PLAYER)
+        if index is None:
+            return {'score': score}
+        return {'index': index, 'score': score}
 
     # Array to store al move objects
     moves = []
@@ -104,10 +246,10 @@ def minimax(new_board, player):
         # Collect the score resulted from calling minimax
         # on the opponent of the current player
         if player == new_board.AI_PLAYER:
-            result = minimax(new_board, new_board.HU_PLAYER)
+            result = _minimax(new_board, new_board.HU_PLAYER)
             move['score'] = result['score']
         else:
-            result = minimax(new_board, new_board.AI_PLAYER)
+            result = _minimax(new_board, new_board.AI_PLAYER)
             move['score'] = result['score']
 
         # Reset the spot to empty again
@@ -138,51 +280,147 @@ def minimax(new_board, player):
     return best_move
 
 
-def human_moves_from_image(camera, board):
-    '''Detect alle human moves (circles) in picture. '''
-    nr_circles = 0
-    font = cv2.FONT_HERSHEY_SIMPLEX
+def _minimax_bits(ai_bits, hu_bits, ai_to_move):
+    ''' Minimax on the bits of a BitBoard, returns (index, score).'''
+    if WINNING[hu_bits]:
+        return None, -10
+    if WINNING[ai_bits]:
+        return None, 10
+    spots = EMPTY_INDEXES[ai_bits | hu_bits]
+    if not spots:
+        return None, 0
 
-    # capture image and save to file
-    camera.capture('ttt.jpg')
+    # Choose the first spot with the best score, like minimax()
+    best_index = None
+    if ai_to_move:
+        best_score = -1000
+        for spot in spots:
+            score = _minimax_bits(ai_bits | 1 << spot, hu_bits, False)[1]
+            if score > best_score:
+                best_score = score
+                best_index = spot
+    else:
+        best_score = 1000
+        for spot in spots:
+            score = _minimax_bits(ai_bits, hu_bits | 1 << spot, True)[1]
+            if score < best_score:
+                best_score = score
+                best_index = spot
+    return best_index, best_score
 
-    # Read image and preprocess for circle detection
-    img = cv2.imread('ttt.jpg')
 
-    # Resize image to region of interest (tic tac toe board only)
-    img = img[150: 350, 410: 630]
+def preprocess(img):
+    ''' Preprocess image of the board for circle detection.'''
 
     # Convert to grayscale
-    gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    with span('vision.gray'):
+        gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
     # Adaptive Guassian Threshold is to detect sharp edges in the Image.
-    gray_img = cv2.adaptiveThreshold(gray_img, 255,
-                                     cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                     cv2.THRESH_BINARY, 11, 3.5)
+    with span('vision.threshold'):
+        gray_img = cv2.adaptiveThreshold(gray_img, 255,
+                                         cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                         cv2.THRESH_BINARY, 11, 3.5)
 
     # apply GuassianBlur to reduce noise. medianBlur is also added for
     # smoothening, reducing noise.
-    gray_img = cv2.GaussianBlur(gray_img, (5, 5), 0)
-    gray_img = cv2.medianBlur(gray_img, 5)
+    with span('vision.blur'):
+        gray_img = cv2.GaussianBlur(gray_img, (5, 5), 0)
+    with span('vision.median'):
+        gray_img = cv2.medianBlur(gray_img, 5)
+    return gray_img
+
 
+def hough_circles(gray_img, dp=1.2, min_dist=50, param1=200, param2=50,
+                  min_radius=10, max_radius=50):
+    ''' Return circles (x, y, r) found on preprocessed image.'''
     # Circle detection (= moves of human player)
-    circles = cv2.HoughCircles(gray_img, cv2.HOUGH_GRADIENT, 1.2, 50,
-                               param1=200, param2=50,
-                               minRadius=10, maxRadius=50)
+    with span('vision.hough'):
+        circles = cv2.HoughCircles(gray_img, cv2.HOUGH_GRADIENT, dp,
+                                   min_dist, param1=param1, param2=param2,
+                                   minRadius=min_radius,
+                                   maxRadius=max_radius)
+    if circles is None:
+        return np.empty((0, 3), dtype=np.uint16)
+    return np.uint16(np.around(circles))[0]
+
+
+@timed('human_moves_from_image')
+def human_moves_from_image(camera, board, grabber=None, detector=None,
+                           grid=None, debug_writer=None):
+    '''Detect alle human moves (circles) in picture.
+
+    With a FrameGrabber (ksm_tictactoe_camera) the picture is captured in
+    memory and preprocessed into its preallocated buffers, otherwise it
+    goes through the file ttt.jpg. A detector (see ksm_tictactoe_vision)
+    replaces the built-in HoughCircles detection: its detect(img,
+    boundaries) returns the circles (x, y, r) found on the board image.
+    With a calibrated grid (see ksm_tictactoe_calibration) the board is
+    taken from the rectified image instead of a fixed crop, and circles
+    are mapped to fields by the grid's cell boundaries. With a
+    debug_writer (DebugImageWriter) the annotated image ttt_circles.jpg
+    is written in the background instead of before returning.
+    '''
+    nr_circles = 0
+    font = cv2.FONT_HERSHEY_SIMPLEX
+
+    with span('vision.capture'):
+        if grabber is not None:
+            # Capture raw frame in memory
+            img = grabber.capture()
+        else:
+            # capture image and save to file
+            camera.capture('ttt.jpg')
+
+            # Read image and preprocess for circle detection
+            img = cv2.imread('ttt.jpg')
+
+    with span('vision.board'):
+        if grid is not None and grid.ensure(img):
+            # Rectified image of the board
+            img = grid.warp(img)
+        else:
+            grid = None
+            # Resize image to region of interest (tic tac toe board only)
+            img = img[150: 350, 410: 630]
+
+    if detector is not None:
+        with span('vision.detect'):
+            if grid is not None:
+                boundaries = grid.boundaries
+            else:
+                boundaries = (board.x0, board.y0, board.x1, board.y1)
+            circles = detector.detect(img, boundaries)
+    else:
+        if grabber is not None and grid is None:
+            gray_img = grabber.preprocess(img)
+        else:
+            gray_img = preprocess(img)
+        circles = hough_circles(gray_img)
 
-    if circles is not None:
-        circles = np.uint16(np.around(circles))
-        for (x, y, r) in circles[0, :]:
+    if len(circles):
+        if debug_writer is not None:
+            debug_writer.submit(img, circles)
+        for (x, y, r) in circles:
             nr_circles += 1
-            # Draw the outer circle
-            cv2.circle(img, (x, y), r, (0, 255, 0), 2)
-            # Draw the center if the circle
-            cv2.circle(img, (x, y), 2, (0, 0, 255), 3)
-            # Put number of circle at center
-            cv2.putText(img, str(nr_circles), (x, y), font, 2, 255)
+            if debug_writer is None:
+                # Draw the outer circle
+                cv2.circle(img, (x, y), r, (0, 255, 0), 2)
+                # Draw the center if the circle
+                cv2.circle(img, (x, y), 2, (0, 0, 255), 3)
+                # Put number of circle at center
+                cv2.putText(img, str(nr_circles), (x, y), font, 2, 255)
             # Add human move to board
-            board.add_human_move_to_board(x, y)
-        cv2.imwrite('ttt_circles.jpg', img)
+            if grid is None:
+                board.add_human_move_to_board(x, y)
+        if grid is not None:
+            # Map all circle centres to fields at once
+            for field_index in grid.fields_for_points(
+                    [(x, y) for (x, y, r) in circles]):
+                board.index[field_index] = board.HU_PLAYER
+        if debug_writer is None:
+            with span('vision.write'):
+                cv2.imwrite('ttt_circles.jpg', img)
         return nr_circles, board
     else:
         return nr_circles, board
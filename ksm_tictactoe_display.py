@@ -0,0 +1,165 @@
+''' Display service: draws on the PiStorms screen on its own thread.
+
+Callers hand over a frame and continue at once. Frames are shown in the
+order they arrive, from a bounded queue, and the renderer keeps each on
+the screen for its minimum display time, so the game loop does not have
+to sleep. Frames without a minimum time that follow each other in the
+queue replace each other: only the latest of them is shown.
+Screens that do not change (splash screens, menu) are drawn once and
+cached. Only the rows that changed are written to the framebuffer.
+'''
+import threading
+from collections import deque
+from time import perf_counter, sleep
+
+import numpy as np
+from PIL import ImageChops
+
+
+def rgb565(img):
+    ''' Return PIL image img as RGB565 framebuffer bytes.'''
+    rgb = np.asarray(img.convert('RGB'), dtype=np.uint16)
+    pixels = ((rgb[..., 0] >> 3) << 11) | ((rgb[..., 1] >> 2) << 5) | \
+             (rgb[..., 2] >> 3)
+    return pixels.astype('<u2').tobytes()
+
+
+class DisplayService:
+    ''' Render frames on display (an ev3dev2 Display) on a thread.
+
+    A frame is a text message or a named screen. Screens are registered
+    with a function that draws them on the display and are cached as
+    images after their first use.
+    '''
+    def __init__(self, display, write_regions=True, queue_size=16):
+        self.display = display
+        # Write changed rows straight into a 16 bit framebuffer, if any
+        self.write_regions = write_regions and \
+            getattr(display, 'mmap', None) is not None and \
+            display.var_info.bits_per_pixel == 16
+        self.screens = {}
+        self.cache = {}
+        self.stats = {'frames': 0, 'unchanged': 0, 'bytes': 0,
+                      'render_time': 0.0, 'superseded': 0, 'dropped': 0}
+        self._previous = None
+        # Frames not shown yet, and whether a frame is still within its
+        # minimum display time
+        self.queue_size = queue_size
+        self._pending = deque()
+        self._busy = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def register(self, name, draw):
+        ''' Register screen name, drawn by draw(display).'''
+        self.screens[name] = draw
+
+    def show_screen(self, name, min_time=0):
+        ''' Show registered screen name for at least min_time seconds.'''
+        self._put(('screen', name, min_time))
+
+    def show_text(self, msg, min_time=0):
+        ''' Show message msg for at least min_time seconds.'''
+        self._put(('text', msg, min_time))
+
+    def _put(self, item):
+        with self._condition:
+            if item[2] <= 0 and self._pending and self._pending[-1][2] <= 0:
+                # Frames without a minimum time collapse into the latest
+                self._pending[-1] = item
+                self.stats['superseded'] += 1
+            else:
+                if len(self._pending) >= self.queue_size:
+                    # Never block the caller: drop the oldest frame, one
+                    # without a minimum time if there is one
+                    for old in self._pending:
+                        if old[2] <= 0:
+                            break
+                    else:
+                        old = self._pending[0]
+                    self._pending.remove(old)
+                    self.stats['dropped'] += 1
+                self._pending.append(item)
+            self._condition.notify_all()
+
+    def wait_idle(self):
+        ''' Wait until all frames have been shown for their time.'''
+        with self._condition:
+            while self._pending or self._busy:
+                self._condition.wait()
+
+    def close(self):
+        ''' Show the queued frames and stop the renderer.'''
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    break
+                kind, value, min_time = self._pending.popleft()
+                self._busy = True
+            try:
+                start = perf_counter()
+                if kind == 'screen':
+                    self._show_screen(value)
+                else:
+                    self._show_text(value)
+                self.stats['render_time'] += perf_counter() - start
+                # Minimum display time: the next frames wait in the queue
+                if min_time > 0:
+                    sleep(min_time)
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+
+    def _show_screen(self, name):
+        if name not in self.cache:
+            self.display.clear()
+            self.screens[name](self.display)
+            self.cache[name] = self.display.image.copy()
+        else:
+            self.display.image.paste(self.cache[name], (0, 0))
+        self._update()
+
+    def _show_text(self, msg):
+        self.display.text_pixels(msg, clear_screen=True, x=15, y=100,
+                                 text_color='black', font='lutBS18')
+        self._update()
+
+    def _update(self):
+        ''' Write the rows that changed since the previous frame.'''
+        image = self.display.image
+        self.stats['frames'] += 1
+        if not self.write_regions:
+            self.display.update()
+            return
+        box = None
+        if self._previous is not None:
+            box = ImageChops.difference(self._previous, image).getbbox()
+            if box is None:
+                self.stats['unchanged'] += 1
+                return
+        self._previous = image.copy()
+        width, height = image.size
+        top, bottom = (0, height) if box is None else (box[1], box[3])
+        data = rgb565(image.crop((0, top, width, bottom)))
+        line_length = self.display.fix_info.line_length
+        row = width * 2
+        if line_length == row:
+            self.display.mmap[top * row:bottom * row] = data
+        else:
+            for y in range(top, bottom):
+                offset = y * line_length
+                start = (y - top) * row
+                self.display.mmap[offset:offset + row] = \
+                    data[start:start + row]
+        self.stats['bytes'] += len(data)
@@ -0,0 +1,204 @@
+''' One asyncio event loop for the input and the game flow.
+
+The touchscreen has one persistent reader and the touch sensors are
+watched by polling on the loop, so waiting for the player blocks nothing.
+The blocking stages (motion, vision, search) run on worker threads and
+are awaited on the loop; every wait can have a timeout and is cancelled
+when the GO button is pressed. The display has its own renderer thread
+(see ksm_tictactoe_display).
+
+Written for the asyncio of Python 3.5 (ev3dev stretch): no asyncio.run()
+or asyncio.to_thread().
+'''
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import perf_counter
+
+# evdev events of the PiStorms touchscreen
+EV_SYN = 0
+EV_ABS = 3
+ABS_X = 0
+ABS_Y = 1
+KEY_GO = 28
+
+# The GO button, as returned by TouchScreen.touch()
+GO = 'GO'
+
+# Name of the threads of the blocking stages
+STAGE_THREAD = 'ksm_tictactoe_stage'
+
+
+class Aborted(Exception):
+    ''' The GO button was pressed during a game.'''
+    pass
+
+
+class TouchScreen:
+    ''' Persistent, shared reader of the touchscreen (an evdev InputDevice).
+
+    A thread reads the device and hands touches (x, y), at the end of
+    every report, and GO button presses to the event loop. The touchscreen
+    reports a touch as a stream of events while the finger is down: events
+    within debounce seconds of the previous one are part of the same touch
+    and are dropped. device can also be a function that opens the device
+    when reading starts.
+    '''
+    def __init__(self, device, debounce=0.3):
+        self.device = device
+        self.debounce = debounce
+        self.touches = None
+        self.go = None
+        self._loop = None
+        self._last = {}
+
+    def start(self):
+        ''' Start reading; call from a coroutine on the event loop.'''
+        if self._loop is not None:
+            return
+        if not hasattr(self.device, 'read_loop'):
+            self.device = self.device()
+        self._loop = asyncio.get_event_loop()
+        self.touches = asyncio.Queue()
+        # Set on every GO button press, until clear()
+        self.go = asyncio.Event()
+        thread = threading.Thread(target=self._read, daemon=True)
+        thread.start()
+
+    def _read(self):
+        x = None
+        y = None
+        for event in self.device.read_loop():
+            if event.type == EV_ABS and event.code == ABS_X:
+                x = event.value
+            elif event.type == EV_ABS and event.code == ABS_Y:
+                y = event.value
+            elif event.type == EV_SYN:
+                # End of a report: the position is complete
+                if x is not None and y is not None:
+                    self._emit((x, y))
+            elif event.code == KEY_GO and event.value:
+                self._emit(GO)
+
+    def _emit(self, item):
+        ''' Hand item to the loop, unless it bounces (reader thread).'''
+        kind = GO if item == GO else 'touch'
+        now = perf_counter()
+        last = self._last.get(kind)
+        self._last[kind] = now
+        if last is not None and now - last < self.debounce:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._put, item)
+        except RuntimeError:
+            # The loop has been closed: the program ends
+            pass
+
+    def _put(self, item):
+        if item == GO:
+            self.go.set()
+        self.touches.put_nowait(item)
+
+    async def touch(self, timeout=None):
+        ''' Return the next touch (x, y) or GO. Raises
+            asyncio.TimeoutError after timeout seconds.'''
+        return await asyncio.wait_for(self.touches.get(), timeout)
+
+    def clear(self):
+        ''' Forget the touches and GO presses that were not handled.'''
+        while not self.touches.empty():
+            self.touches.get_nowait()
+        self.go.clear()
+
+
+class SensorWatcher:
+    ''' Non-blocking watcher of an ev3dev2 TouchSensor, polled on the
+        event loop every poll seconds.'''
+    def __init__(self, sensor, poll=0.01):
+        self.sensor = sensor
+        self.poll = poll
+
+    async def _wait(self, pressed):
+        while self.sensor.is_pressed != pressed:
+            await asyncio.sleep(self.poll)
+
+    async def pressed(self, timeout=None):
+        ''' Wait until the sensor is pressed.'''
+        await asyncio.wait_for(self._wait(True), timeout)
+
+    async def released(self, timeout=None):
+        ''' Wait until the sensor is released.'''
+        await asyncio.wait_for(self._wait(False), timeout)
+
+    async def bump(self, timeout=None):
+        ''' Wait until the sensor is pressed and released again.'''
+        async def bump():
+            await self._wait(True)
+            await self._wait(False)
+        await asyncio.wait_for(bump(), timeout)
+
+
+_executor = None
+_running = set()
+_lock = threading.Lock()
+
+
+def run_blocking(func, *args):
+    ''' Run func(*args) on a stage thread, return an asyncio future.'''
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=2)
+    future = _executor.submit(_stage, partial(func, *args))
+    with _lock:
+        _running.add(future)
+    future.add_done_callback(_finished)
+    return asyncio.wrap_future(future)
+
+
+def _stage(func):
+    threading.current_thread().name = STAGE_THREAD
+    return func()
+
+
+def _finished(future):
+    with _lock:
+        _running.discard(future)
+
+
+async def drain(timeout=None):
+    ''' Wait until the stages on threads have finished (after an abort:
+        a thread can not be cancelled, only left to finish).'''
+    with _lock:
+        futures = [asyncio.wrap_future(future) for future in _running]
+    if futures:
+        done, pending = await asyncio.wait(futures, timeout=timeout)
+        for future in done:
+            # The result of an aborted stage does not matter anymore
+            future.exception()
+
+
+async def abortable(awaitable, abort, timeout=None):
+    ''' Wait for awaitable (a coroutine or future) and return its result.
+
+    Raises Aborted as soon as the asyncio.Event abort is set and
+    asyncio.TimeoutError after timeout seconds; the awaitable is
+    cancelled then.
+    '''
+    task = asyncio.ensure_future(awaitable)
+    stop = asyncio.ensure_future(abort.wait())
+    try:
+        done, pending = await asyncio.wait(
+            [task, stop], timeout=timeout,
+            return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        stop.cancel()
+    if task in done:
+        return task.result()
+    task.cancel()
+    if stop in done:
+        raise Aborted('GO button pressed')
+    raise asyncio.TimeoutError()
@@ -17,78 +17,141 @@
 # - LEGO TouchSensor connected to port BAS2
 # - LEGO TouchSensor connected to port BBS2
 #
-from time import sleep
+import threading
+from functools import partial
+from time import perf_counter, time
 
-from ev3dev2.port import LegoPort
-from ev3dev2.motor import Motor, LargeMotor, OUTPUT_D
-from ev3dev2.sensor.lego import TouchSensor
+from ksm_tictactoe_backend import LegoPort, Motor, LargeMotor, TouchSensor
 
-# Configure ports for sensors
-port_BAS2 = LegoPort('pistorms:BAS2')
-port_BAS2.mode = 'ev3-analog'
-port_BBS2 = LegoPort('pistorms:BBS2')
-port_BBS2.mode = 'ev3-analog'
-sleep(2)
+from ksm_tictactoe_motion import wait_for_motors, MotionAborted
+from ksm_tictactoe_retry import retry
+from ksm_tictactoe_telemetry import timed, record, enabled
+from ksm_tictactoe_motortrace import traced, segment
+from ksm_tictactoe_planner import FIELDS, HOME_STEPS, MotionPlanner, \
+     execute
+from ksm_tictactoe_startup import wait_until
 
+# Ports of the TouchSensors
+SENSOR_PORTS = ('pistorms:BAS2', 'pistorms:BBS2')
+_ports_configured = False
 
-class ExceededRetries(Exception):
-    ''' Custom exception for exceeding retries at Remote I/O error.'''
-    pass
 
-
-def try_except(func):
-    ''' Retry function when Remote I/O error occurs.'''
-    def wrapper(*args, **kwargs):
-        for i in range(10):
-            try:
-                result = func(*args, **kwargs)
-                return result
-            except OSError:
-                with open('logfile.txt', 'a') as f:
-                    f.write('OSError\n')
-        raise ExceededRetries('ExceededRetries in function ' + func.__name__)
-    return wrapper
+def configure_ports(timeout=10.0):
+    ''' Configure the ports for the sensors, once, and wait until the
+        TouchSensors can be used (their drivers take a while to load).'''
+    global _ports_configured
+    if _ports_configured:
+        return
+    for address in SENSOR_PORTS:
+        port = LegoPort(address)
+        port.mode = 'ev3-analog'
+    for address in SENSOR_PORTS:
+        wait_until(partial(TouchSensor, address), timeout, what=address)
+    _ports_configured = True
 
 
 class Tic_tac_toe_machine:
-    def __init__(self):
+    def __init__(self, planned=True, home=True):
+        configure_ports()
         self.turntable = Turntable('pistorms:BAM1', 'pistorms:BAM2')
-        self.pen = Pen('pistorms:BBM2', 'pistorms:BBM1')
+        self.pen = Pen('pistorms:BBM2', 'pistorms:BBM1', home)
         self.ts_play = TouchSensor('pistorms:BAS2')
+        # Draw with overlapped motor moves (see ksm_tictactoe_planner)
+        self.planner = None
+        if planned:
+            self.planner = MotionPlanner(
+                turn_positions=self.turntable.motor_turn_positions,
+                move_positions=self.turntable.motor_move_positions,
+                pen_move_positions=self.pen.motor_move_positions)
+        self.motors = {'turn': self.turntable.motor_turn,
+                       'move': self.turntable.motor_move,
+                       'pen_move': self.pen.motor_move,
+                       'pen': self.pen.motor_pen}
+        # Ports of the motors, for the failure counters (see retry)
+        self.ports = self.turntable.ports + self.pen.ports
+        # Set by stop() to abort the move that is drawn
+        self.abort = threading.Event()
 
-    @try_except
+    @timed('draw_computer_move')
+    @traced('draw_computer_move', move=True)
+    # Failures are charged to the ports of the motor calls that failed
+    # (the retried reads and commands of execute() and of the methods
+    # below), not to all ports of the machine
+    @retry('draw', ports=lambda self, *args: ())
     def draw_computer_move(self, field_index):
         ''' Draw the move (cross) of computer.'''
+        if self.planner is not None:
+            # The turntable goes home while the game continues
+            start = time()
+            trace_start = perf_counter()
+            steps = self.planner.plan(field_index)
+            times = execute(steps, self.motors, detach=HOME_STEPS,
+                            abort=self.abort)
+            # Every step of the plan is a sub-move of the motor of its axis
+            for step in steps:
+                begin, end = times[step.name]
+                if enabled() and end is not None:
+                    record('draw.' + step.name, end - begin, start + begin)
+                segment('draw.' + step.name, trace_start + begin,
+                        None if end is None else trace_start + end,
+                        step.axis)
+            return
         # Move pen to given field
         self._move_to_field(field_index)
+        self._check_abort()
         # Draw cross
         self._draw_cross()
+        self._check_abort()
         # Goto start position
         self.turntable.goto_start_pos()
 
-    @try_except
+    def wait_until_home(self):
+        ''' Wait until the turntable is back at its start position: the
+            planned draw returns while it is still on its way, and the
+            camera only sees the board when it is home.'''
+        wait_while_motors_running(self.turntable.motor_move,
+                                  self.turntable.motor_turn)
+
+    def _check_abort(self):
+        if self.abort.is_set():
+            raise MotionAborted('Drawing aborted')
+
+    @retry('command')
+    def stop(self):
+        ''' Abort drawing (from another thread): stop all motors.'''
+        self.abort.set()
+        for motor in self.motors.values():
+            motor.stop()
+
+    @retry('move', ports=lambda self: ())
+    def park(self):
+        ''' Lift the pen and go to the start position after stop().'''
+        self.abort.clear()
+        self.pen.pen_up()
+        self.pen.motor_move.run_to_abs_pos(
+                        position_sp=self.pen.motor_move_positions[0])
+        self.turntable.goto_start_pos()
+        wait_while_motors_running(self.turntable.motor_move,
+                                  self.turntable.motor_turn,
+                                  self.pen.motor_move)
+
+    @retry('command')
+    def pre_position(self, field_indexes):
+        ''' Move the pen sideways to the spot closest to the fields the
+            next move is likely to be drawn in (without waiting).'''
+        planner = self.planner or MotionPlanner(
+            pen_move_positions=self.pen.motor_move_positions)
+        position = planner.neutral_pen_move(field_indexes)
+        if position is not None:
+            self.pen.motor_move.run_to_abs_pos(position_sp=position)
+
+    @timed('draw.move_to_field')
+    @traced('draw.move_to_field')
+    @retry('move', ports=lambda self, *args: ())
     def _move_to_field(self, field_index):
         ''' Move turntable and pen to given field (private method).'''
-        #        turntable   pen
-        # field  turn  move  move
-        # 0      1     5     3
-        # 1      1     4     2
-        # 2      1     3     1
-        # 3      1     4     4
-        # 4      1     3     3
-        # 5      1     2     2
-        # 6      1     3     5
-        # 7      1     2     4
-        # 8      1     1     3
-        field = ((1, 5, 3),
-                 (1, 4, 2),
-                 (1, 3, 1),
-                 (1, 4, 4),
-                 (1, 3, 3),
-                 (1, 2, 2),
-                 (1, 3, 5),
-                 (1, 2, 4),
-                 (1, 1, 3))
+        # Turntable turn and move, pen move position of each field
+        field = FIELDS
 
         # move to field
         self.turntable.turn_to_abs_pos(field[field_index][0])
@@ -98,7 +161,9 @@ class Tic_tac_toe_machine:
                                   self.turntable.motor_turn,
                                   self.pen.motor_move)
 
-    @try_except
+    @timed('draw.draw_cross')
+    @traced('draw.draw_cross')
+    @retry('draw', ports=lambda self: ())
     def _draw_cross(self):
         ''' Draw a cross at given field_index).'''
         # Bring pen down to paper
@@ -124,6 +189,7 @@ class Tic_tac_toe_machine:
 
 class Turntable:
     def __init__(self, port_motor_move, port_motor_turn):
+        self.ports = (port_motor_move, port_motor_turn)
         # Motor for moving turntable forwards and backwards
         self.motor_move = Motor(port_motor_move)
         self.motor_move.speed_sp = 400
@@ -136,25 +202,27 @@ class Turntable:
         self.motor_turn.stop_action = 'brake'
         self.motor_turn_positions = (0, -345, 345)
 
-    @try_except
+    @retry('command')
     def move_to_abs_pos(self, pos):
         ''' Move the turntable to given absolute position [0,..,5].'''
         self.motor_move.run_to_abs_pos(
                         position_sp=self.motor_move_positions[pos])
 
-    @try_except
+    @retry('draw')
     def move_to_rel_pos(self, rel_pos):
         ''' Move the turntable over a given distance.'''
         self.motor_move.run_to_rel_pos(position_sp=rel_pos)  # rel_pos=150
         wait_while_motors_running(self.motor_move)
 
-    @try_except
+    @retry('command')
     def turn_to_abs_pos(self, pos):
         ''' Turn the turntable to a given absolute position [0,..,2].'''
         self.motor_turn.run_to_abs_pos(
                         position_sp=self.motor_turn_positions[pos])
 
-    @try_except
+    @timed('draw.goto_start_pos')
+    @traced('draw.goto_start_pos')
+    @retry('command', ports=lambda self: ())
     def goto_start_pos(self):
         ''' Move and turn the turntable to its start position.'''
         self.move_to_abs_pos(0)
@@ -162,7 +230,8 @@ class Turntable:
 
 
 class Pen:
-    def __init__(self, port_motor_move, port_motor_pen):
+    def __init__(self, port_motor_move, port_motor_pen, home=True):
+        self.ports = (port_motor_move, port_motor_pen)
         # Motor to move pen sideways
         self.motor_move = LargeMotor(port_motor_move)
         self.motor_move.reset()
@@ -174,39 +243,42 @@ class Pen:
         self.motor_pen.stop_action = 'hold'
         # TouchSensor to indicate pen is up
         self.ts_pen = TouchSensor('pistorms:BBS2')
-        # Move pen up
+        if home:
+            self.home()
+
+    def home(self, timeout=10.0):
+        ''' Move pen up until it presses its TouchSensor.'''
         self.motor_pen.run_forever(speed_sp=-200)
-        self.ts_pen.wait_for_pressed()
-        self.motor_pen.stop()
+        try:
+            wait_until(lambda: self.ts_pen.is_pressed, timeout, poll=0.005,
+                       max_poll=0.01, what='Pen TouchSensor')
+        finally:
+            self.motor_pen.stop()
 
-    @try_except
+    @timed('draw.pen_up')
+    @traced('draw.pen_up')
+    @retry('move')
     def pen_up(self):
         ''' Move pen up.'''
         self.motor_pen.run_to_abs_pos(speed_sp=400, position_sp=-20)
         wait_while_motors_running(self.motor_pen)
 
-    @try_except
+    @timed('draw.pen_down')
+    @traced('draw.pen_down')
+    @retry('move')
     def pen_down(self):
         ''' Move pen down.'''
         self.motor_pen.run_to_abs_pos(speed_sp=400, position_sp=20)
         wait_while_motors_running(self.motor_pen)
 
-    @try_except
+    @retry('command')
     def move_to_abs_pos(self, pos):
         ''' Move pen sidways to absolute position [0,..,5].'''
         self.motor_move.run_to_abs_pos(
                         position_sp=self.motor_move_positions[pos])
 
 
-@try_except
+@retry('wait')
 def wait_while_motors_running(*args):
     ''' Hold program when given motors are still running.'''
-    for motor in args:
-        pos = motor.position
-        while True:
-            sleep(0.3)
-            current_pos = motor.position
-            if pos == current_pos:
-                break
-            else:
-                pos = current_pos
+    wait_for_motors(*args)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+''' Waiting for LEGO motors to finish their moves.
+
+wait_for_motors() watches all given motors at the same time and returns
+as soon as the last one has settled. It reads the motor state instead of
+comparing positions 0.3 s apart, and polls fast at first and slower
+while a long move runs.
+
+Measure the time saved per drawn cross on simulated motors with:
+    python3 ksm_tictactoe_motion.py
+
+The waits are checked on simulated motors (moves, stalls, timeouts) by
+test_ksm_tictactoe_motion.py.
+'''
+import argparse
+from time import perf_counter, sleep
+
+
+class MotionError(Exception):
+    ''' A motor did not finish its move.'''
+    pass
+
+
+class MotorTimeout(MotionError):
+    ''' Motors still running after the timeout.'''
+    pass
+
+
+class MotorStalled(MotionError):
+    ''' A motor stalled before reaching its position.'''
+    pass
+
+
+class MotionAborted(MotionError):
+    ''' The move was stopped on request.'''
+    pass
+
+
+def ramp_accel(ramp_sp, max_speed):
+    ''' Acceleration (deg/s^2) of an ev3dev ramp: ramp_sp is the time in
+        ms from 0 to max_speed. No ramp is an infinite acceleration.'''
+    return max_speed * 1000.0 / ramp_sp if ramp_sp else float('inf')
+
+
+def profile(distance, speed, accel_up=float('inf'),
+            accel_down=float('inf')):
+    ''' Trapezoidal speed profile of a move from standstill to standstill.
+
+    Returns (time, peak speed, ramp up time, ramp down time). Short moves
+    never reach speed and have a triangular profile.
+    '''
+    distance = abs(distance)
+    speed = abs(speed)
+    if distance == 0 or speed == 0:
+        return 0.0, 0.0, 0.0, 0.0
+    # Distance needed to ramp up and down at full speed
+    ramps = speed * speed / 2 * (1 / accel_up + 1 / accel_down)
+    if ramps > distance:
+        speed = (2 * distance / (1 / accel_up + 1 / accel_down)) ** 0.5
+        ramps = distance
+    t_up = speed / accel_up
+    t_down = speed / accel_down
+    return t_up + t_down + (distance - ramps) / speed, speed, t_up, t_down
+
+
+def profile_position(t, distance, speed, accel_up=float('inf'),
+                     accel_down=float('inf')):
+    ''' Distance covered after t seconds of a trapezoidal move.'''
+    total, peak, t_up, t_down = profile(distance, speed, accel_up,
+                                        accel_down)
+    sign = -1 if distance < 0 else 1
+    if t >= total:
+        return distance
+    if t < t_up:
+        covered = accel_up * t * t / 2
+    elif t > total - t_down:
+        left = total - t
+        covered = abs(distance) - accel_down * left * left / 2
+    else:
+        covered = peak * t_up / 2 + peak * (t - t_up)
+    return sign * covered
+
+
+def wait_for_motors(*motors, timeout=10.0, poll=0.005, max_poll=0.05,
+                    stall_time=0.5, start_time=0.05, raise_on_stall=False):
+    ''' Wait until all motors have settled, return the stalled motors.
+
+    A motor has settled when its state is no longer 'running' and its
+    position did not change since the previous poll. Right after a
+    run_to_*() command a motor may not have started yet, so it only
+    settles after it was seen running or away from its first position,
+    or after start_time seconds (a move to where it already is). A motor
+    that reports 'stalled', or runs without moving for stall_time
+    seconds, counts as stalled: it is returned (or MotorStalled is raised)
+    instead of waited for. The poll interval starts at poll and grows to
+    max_poll.
+    MotorTimeout is raised when motors still run after timeout seconds.
+    '''
+    start = perf_counter()
+    positions = {}
+    first = {}
+    started = set()
+    moved = {}
+    pending = list(motors)
+    stalled = []
+    interval = poll
+    while True:
+        now = perf_counter()
+        for motor in list(pending):
+            state = motor.state
+            position = motor.position
+            previous = positions.get(motor)
+            positions[motor] = position
+            first.setdefault(motor, position)
+            if 'running' in state or position != first[motor]:
+                started.add(motor)
+            if position != previous:
+                moved[motor] = now
+            if 'stalled' in state or \
+                    now - moved.get(motor, now) >= stall_time:
+                if 'running' in state or 'stalled' in state:
+                    pending.remove(motor)
+                    stalled.append(motor)
+                    continue
+            if 'running' not in state and position == previous and \
+                    (motor in started or now - start >= start_time):
+                pending.remove(motor)
+        if not pending:
+            break
+        if now - start >= timeout:
+            raise MotorTimeout('Motors still running after {} s'.format(
+                               timeout))
+        sleep(interval)
+        interval = min(interval * 1.5, max_poll)
+    if stalled and raise_on_stall:
+        raise MotorStalled('{} motor(s) stalled'.format(len(stalled)))
+    return stalled
+
+
+def wait_sequential(*motors, interval=0.3):
+    ''' The former wait: each motor in turn until its position holds for
+        interval seconds. Kept as reference for the measurement.'''
+    for motor in motors:
+        pos = motor.position
+        while True:
+            sleep(interval)
+            current_pos = motor.position
+            if pos == current_pos:
+                break
+            else:
+                pos = current_pos
+
+
+def measure_cross(wait, speed=400):
+    ''' Draw a cross on simulated motors with wait, return seconds.'''
+    from ksm_tictactoe_simulated_devices import SimulatedMotor, draw_cross
+    turntable = SimulatedMotor(speed_sp=speed)
+    pen_move = SimulatedMotor(speed_sp=speed)
+    pen = SimulatedMotor()
+    start = perf_counter()
+    draw_cross(turntable, pen_move, pen, wait)
+    return perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure motor wait latency per drawn cross.')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    results = {}
+    for name, wait in (('sequential', wait_sequential),
+                       ('concurrent', wait_for_motors)):
+        results[name] = min(measure_cross(wait)
+                            for _ in range(args.repeats))
+        print('{:12s} {:6.3f} s per cross'.format(name, results[name]))
+    print('Saved:       {:6.3f} s per cross'.format(
+          results['sequential'] - results['concurrent']))
+
+
+if __name__ == '__main__':
+    main()
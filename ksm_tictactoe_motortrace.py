@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+''' Motor traces of the drawn moves, for tuning the motion.
+
+MotorRecorder samples position, speed and state of the motors of the
+machine at a fixed rate into a NumPy ring buffer. It only samples while
+a move is drawn (and until its motors have come to rest), so the game
+does not pay for it between moves. Every move is kept as a trace with
+its segments (the timed steps: move to field, pen down, lines, ...) and
+written to its own .npz file. A segment of a planned move names the motor
+(axis) of its step: the steps overlap, so the other motors that move
+during the segment belong to other steps.
+
+Enable with the environment variable KSM_TICTACTOE_MOTOR_TRACE set to
+the directory of the traces (and KSM_TICTACTOE_MOTOR_RATE in Hz):
+    KSM_TICTACTOE_MOTOR_TRACE=traces python3 ksm_tictactoe.py
+
+Print the duration, overshoot, settle and stall time per segment:
+    python3 ksm_tictactoe_motortrace.py traces
+Try it on simulated motors:
+    python3 ksm_tictactoe_motortrace.py /tmp/traces --simulate
+'''
+import argparse
+import atexit
+import collections
+import os
+import queue
+import threading
+from time import perf_counter, sleep
+
+import numpy as np
+
+# Bits of the motor state
+STATES = ('running', 'ramping', 'holding', 'overloaded', 'stalled')
+RUNNING = 1
+STALLED = 16
+
+
+def state_flags(state):
+    ''' Return the ev3dev motor state (list of names) as bits.'''
+    flags = 0
+    for bit, name in enumerate(STATES):
+        if name in state:
+            flags |= 1 << bit
+    return flags
+
+
+class MotorRecorder:
+    ''' Samples motors (dict name -> motor) rate times per second.
+
+    The ring buffer holds capacity samples; a move longer than that keeps
+    only its last samples. Finished traces are kept in traces (the last
+    keep) and written to directory, on a background thread.
+    '''
+    def __init__(self, motors, directory=None, rate=200, capacity=16384,
+                 keep=20, max_tail=5.0):
+        self.names = list(motors)
+        self.motors = [motors[name] for name in self.names]
+        self.directory = directory
+        self.rate = rate
+        self.capacity = capacity
+        # Seconds after the end of a move to wait for the motors to rest
+        self.max_tail = max_tail
+        count = len(self.motors)
+        self.time = np.zeros(capacity, np.float64)
+        self.position = np.zeros((capacity, count), np.int32)
+        self.speed = np.zeros((capacity, count), np.int32)
+        self.state = np.zeros((capacity, count), np.uint8)
+        # Number of samples so far
+        self.samples = 0
+        # Samples later than their tick, and the time spent sampling
+        self.late = 0
+        self.busy = 0.0
+        self.traces = collections.deque(maxlen=keep)
+        self._move = None
+        self._moves = 0
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._stopped = False
+        self._queue = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._moves = len([name for name in os.listdir(directory)
+                               if name.startswith('move_')])
+            self._queue = queue.Queue()
+            threading.Thread(target=self._write_traces, daemon=True).start()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def begin_move(self, name, **info):
+        ''' Start the trace of a move; info is saved with it.'''
+        with self._lock:
+            if self._move is not None:
+                self._finish()
+            self._moves += 1
+            self._move = {'nr': self._moves, 'name': name, 'info': info,
+                          'first': self.samples, 'start': perf_counter(),
+                          'end': None, 'segments': []}
+        self._active.set()
+
+    def end_move(self):
+        ''' End the move; the trace ends when its motors are at rest.'''
+        with self._lock:
+            if self._move is not None:
+                self._move['end'] = perf_counter()
+
+    def segment(self, name, start, end=None, axis=None):
+        ''' Add a segment (perf_counter times, end None when unknown) of
+            motor axis (None: all motors) to the move that is drawn.'''
+        with self._lock:
+            if self._move is not None and self._move['end'] is None:
+                self._move['segments'].append((name, start, end, axis))
+
+    def stop(self):
+        ''' Stop sampling, finish the move and write the traces.'''
+        if self._stopped:
+            return
+        with self._lock:
+            if self._move is not None:
+                self._finish()
+        self._stopped = True
+        self._active.set()
+        self._thread.join()
+        if self._queue is not None:
+            self._queue.put(None)
+            self._queue.join()
+
+    def _run(self):
+        interval = 1.0 / self.rate
+        while True:
+            self._active.wait()
+            if self._stopped:
+                break
+            tick = perf_counter()
+            while self._active.is_set() and not self._stopped:
+                begin = perf_counter()
+                self._sample(begin)
+                now = perf_counter()
+                self.busy += now - begin
+                tick += interval
+                if tick > now:
+                    sleep(tick - now)
+                else:
+                    # Skip the ticks that were missed
+                    self.late += 1
+                    tick = now
+
+    def _sample(self, now):
+        row = self.samples % self.capacity
+        self.time[row] = now
+        for column, motor in enumerate(self.motors):
+            self.position[row, column] = motor.position
+            self.speed[row, column] = motor.speed
+            self.state[row, column] = state_flags(motor.state)
+        with self._lock:
+            self.samples += 1
+            move = self._move
+            if move is None or move['end'] is None:
+                return
+            # The trace ends when no motor runs anymore
+            if not (self.state[row] & RUNNING).any() or \
+                    now - move['end'] >= self.max_tail:
+                self._finish()
+
+    def _finish(self):
+        ''' Copy the samples of the move out of the ring buffer (with the
+            lock held).'''
+        move = self._move
+        self._move = None
+        self._active.clear()
+        first = max(move['first'], self.samples - self.capacity)
+        rows = np.arange(first, self.samples) % self.capacity
+        start = move['start']
+        end = move['end'] if move['end'] is not None else perf_counter()
+        trace = {'name': move['name'], 'info': move['info'],
+                 'motors': list(self.names), 'rate': self.rate,
+                 'time': self.time[rows] - start,
+                 'position': self.position[rows],
+                 'speed': self.speed[rows], 'state': self.state[rows],
+                 'end': end - start,
+                 'segments': [(name, begin - start,
+                               None if stop is None else stop - start, axis)
+                              for name, begin, stop, axis in
+                              sorted(move['segments'],
+                                     key=lambda item: item[1])]}
+        self.traces.append(trace)
+        if self._queue is not None:
+            filename = os.path.join(self.directory, 'move_{:06d}.npz'.format(
+                                    move['nr']))
+            self._queue.put((filename, trace))
+
+    def _write_traces(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                save_trace(*item)
+            finally:
+                self._queue.task_done()
+
+    def report(self):
+        ''' Return the sampling overhead as text.'''
+        if not self.samples:
+            return 'No motor samples'
+        return '{} samples at {} Hz, {:.3f} ms per sample, {} late'.format(
+            self.samples, self.rate, 1000 * self.busy / self.samples,
+            self.late)
+
+
+def save_trace(filename, trace):
+    ''' Write a trace as .npz (segment ends of NaN are unknown, segment
+        axes of '' all motors).'''
+    segments = trace['segments']
+    np.savez_compressed(
+        filename, name=trace['name'], motors=np.array(trace['motors']),
+        rate=trace['rate'], end=trace['end'], time=trace['time'],
+        position=trace['position'], speed=trace['speed'],
+        state=trace['state'],
+        info=np.array(['{}={}'.format(key, value) for key, value in
+                       sorted(trace['info'].items())], dtype=str),
+        segment_names=np.array([segment[0] for segment in segments],
+                               dtype=str),
+        segment_times=np.array([(begin, np.nan if end is None else end)
+                                for name, begin, end, axis in segments],
+                               np.float64).reshape(-1, 2),
+        segment_axes=np.array([segment[3] or '' for segment in segments],
+                              dtype=str))
+
+
+def load_trace(filename):
+    ''' Return a trace written by save_trace().'''
+    with np.load(filename) as data:
+        # Traces written before segments had an axis: all motors
+        axes = data['segment_axes'] if 'segment_axes' in data else \
+            [''] * len(data['segment_names'])
+        return {'name': str(data['name']),
+                'info': dict(item.split('=', 1) for item in data['info']),
+                'motors': [str(name) for name in data['motors']],
+                'rate': int(data['rate']), 'end': float(data['end']),
+                'time': data['time'], 'position': data['position'],
+                'speed': data['speed'], 'state': data['state'],
+                'segments': [(str(name), begin,
+                              None if np.isnan(end) else end,
+                              str(axis) or None)
+                             for name, (begin, end), axis in
+                             zip(data['segment_names'],
+                                 data['segment_times'], axes)]}
+
+
+def analyse(trace, tolerance=2):
+    ''' Return per segment and moving motor: the duration of the segment,
+        the travel, peak speed and overshoot (degrees beyond the final
+        position) of the motor, its settle time (from within tolerance of
+        the final position until it stopped running), the wait (from
+        stopped until the end of the segment) and the stall time.
+        A segment with an axis only has a result for its own motor.'''
+    time = trace['time']
+    if not len(time):
+        return []
+    dt = 1.0 / trace['rate']
+    results = []
+    for name, begin, end, axis in trace['segments']:
+        if end is None:
+            # Detached: until the motors are at rest
+            end = time[-1]
+        rows = np.flatnonzero((time >= begin) & (time <= end))
+        if len(rows) < 2:
+            continue
+        for column, motor in enumerate(trace['motors']):
+            if axis is not None and motor != axis:
+                # The move of another step that overlaps this one
+                continue
+            position = trace['position'][rows, column].astype(np.int64)
+            state = trace['state'][rows, column]
+            final = position[-1]
+            travel = final - position[0]
+            if axis is None and abs(travel) <= tolerance:
+                continue
+            direction = 1 if travel > 0 else -1
+            overshoot = max(0, int(((position - final) * direction).max()))
+            # First sample from which the motor stays at its position
+            away = np.flatnonzero(np.abs(position - final) > tolerance)
+            reached = away[-1] + 1 if len(away) else 0
+            running = np.flatnonzero(state & RUNNING)
+            stopped = running[-1] + 1 if len(running) else 0
+            # Stalled: reported, or running without speed on the way
+            speed = trace['speed'][rows, column]
+            stalled = ((state & STALLED) != 0) | \
+                ((state & RUNNING != 0) & (speed == 0) &
+                 (np.arange(len(rows)) < reached))
+            results.append({
+                'segment': name, 'motor': motor,
+                'duration': end - begin, 'travel': int(travel),
+                'peak_speed': int(np.abs(speed).max()),
+                'overshoot': overshoot,
+                'settle': max(0.0, (min(stopped, len(rows) - 1) -
+                                    min(reached, len(rows) - 1)) * dt),
+                'wait': max(0.0, end - time[rows[min(stopped,
+                                                     len(rows) - 1)]]),
+                'stall': float(stalled.sum() * dt)})
+    return results
+
+
+def format_analysis(results):
+    ''' Return the results of analyse() as a table.'''
+    lines = ['{:28s}{:>10s}{:>8s}{:>7s}{:>7s}{:>6s}{:>8s}{:>7s}{:>7s}'.format(
+             'segment', 'motor', 'time', 'travel', 'speed', 'over',
+             'settle', 'wait', 'stall')]
+    for result in results:
+        lines.append('{segment:28s}{motor:>10s}{duration:8.3f}{travel:7d}'
+                     '{peak_speed:7d}{overshoot:6d}{settle:8.3f}{wait:7.3f}'
+                     '{stall:7.3f}'.format(**result))
+    return '\n'.join(lines)
+
+
+# The recorder of the game, None when motor traces are disabled
+recorder = None
+
+
+def configure(motors, directory, **kwargs):
+    ''' Record traces of motors to directory (see MotorRecorder).'''
+    global recorder
+    recorder = MotorRecorder(motors, directory, **kwargs)
+    atexit.register(recorder.stop)
+    return recorder
+
+
+def traced(name, move=False):
+    ''' Decorator recording every call as segment name, or as a move of
+        its own (first argument after self as 'field').'''
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            if recorder is None:
+                return func(*args, **kwargs)
+            begin = perf_counter()
+            if move:
+                info = {'field': args[1]} if len(args) > 1 else {}
+                recorder.begin_move(name, **info)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if move:
+                    recorder.end_move()
+                else:
+                    recorder.segment(name, begin, perf_counter())
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+def segment(name, start, end=None, axis=None):
+    ''' Add a segment measured elsewhere (perf_counter times) of motor
+        axis (None: all motors).'''
+    if recorder is not None:
+        recorder.segment(name, start, end, axis)
+
+
+def simulate(directory, rate=200):
+    ''' Draw every field with the planner on simulated motors, return
+        the recorder.'''
+    from ksm_tictactoe_planner import MotionPlanner, HOME, execute
+    from ksm_tictactoe_simulated_devices import SimulatedMotor
+    motors = {axis: SimulatedMotor(position=position)
+              for axis, position in HOME.items()}
+    motors['turn'].max_speed = 1560
+    planner = MotionPlanner()
+    simulated = MotorRecorder(motors, directory, rate)
+    for field_index in range(len(planner.fields)):
+        simulated.begin_move('draw_computer_move', field=field_index)
+        start = perf_counter()
+        steps = planner.plan(field_index)
+        times = execute(steps, motors)
+        for step in steps:
+            begin, end = times[step.name]
+            simulated.segment('draw.' + step.name, start + begin,
+                              start + end, step.axis)
+        simulated.end_move()
+    simulated.stop()
+    return simulated
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Print the timing of recorded motor traces.')
+    parser.add_argument('directory', help='directory of the traces')
+    parser.add_argument('--simulate', action='store_true',
+                        help='first record all fields on simulated motors')
+    parser.add_argument('--rate', type=int, default=200,
+                        help='samples per second (--simulate)')
+    parser.add_argument('--tolerance', type=int, default=2,
+                        help='degrees from the final position')
+    args = parser.parse_args()
+
+    if args.simulate:
+        print(simulate(args.directory, args.rate).report())
+    for name in sorted(os.listdir(args.directory)):
+        if not name.endswith('.npz'):
+            continue
+        trace = load_trace(os.path.join(args.directory, name))
+        print('\n{} {} {}: {:.3f} s, {:.3f} s to rest'.format(
+            name, trace['name'], ' '.join(
+                '{}={}'.format(*item)
+                for item in sorted(trace['info'].items())),
+            trace['end'], trace['time'][-1] if len(trace['time']) else 0))
+        print(format_analysis(analyse(trace, args.tolerance)))
+
+
+if __name__ == '__main__':
+    main()
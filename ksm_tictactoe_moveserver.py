@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+''' Move server: one search for several game rigs.
+
+The rigs send their positions over a local Unix or TCP socket, one line
+per request with the base-3 code of the board (see ksm_tictactoe_movetable),
+and get a line '<index> <score>' back ('- 0' when there is no move).
+Requests that arrive together are handled as one batch; every position is
+searched once, in its canonical form (rotations and reflections reduced),
+and answered from the shared cache after that.
+
+Start the server and point the rigs to it:
+    python3 ksm_tictactoe_moveserver.py --address /tmp/ksm_tictactoe.sock
+    KSM_TICTACTOE_MOVE_SERVER=/tmp/ksm_tictactoe.sock python3 ksm_tictactoe.py
+Addresses with a colon are TCP (host:port, [host]:port for IPv6), others
+Unix socket paths. A socket file left by a server that has gone is
+replaced; any other file at the path is left alone.
+
+Measure latency and throughput with simulated rigs on a loopback server:
+    python3 ksm_tictactoe_moveserver.py --bench 4
+'''
+import argparse
+import asyncio
+import os
+import random
+import socket
+import stat
+import tempfile
+import threading
+from time import perf_counter
+
+from ksm_tictactoe_core_ps import Board
+from ksm_tictactoe_movetable import MoveTable, TABLE_FILE, EMPTY, AI, HU, \
+     encode, canonical, cells_from_board, winner
+from ksm_tictactoe_search import timed_search
+
+# No move: the game is over
+NO_MOVE = '- 0'
+
+
+def decode(code):
+    ''' Return the tuple of 9 cell values of a base-3 code.'''
+    cells = []
+    for _ in range(9):
+        cells.append(code % 3)
+        code //= 3
+    return tuple(cells)
+
+
+def board_from_cells(cells):
+    ''' Return a Board with the cell values.'''
+    board = Board()
+    for i, value in enumerate(cells):
+        if value == AI:
+            board.index[i] = board.AI_PLAYER
+        elif value == HU:
+            board.index[i] = board.HU_PLAYER
+    return board
+
+
+def default_search(table_file=TABLE_FILE, budget=0.5):
+    ''' Return the search of the game: table lookup, alpha-beta search as
+        fallback. It maps cells to {'index', 'score'} or None.'''
+    try:
+        table = MoveTable(table_file)
+    except (OSError, ValueError):
+        table = None
+
+    def search(cells):
+        if winner(cells) != EMPTY or EMPTY not in cells:
+            return None
+        if table is not None:
+            result = table.lookup_cells(cells)
+            if result is not None:
+                return result
+        board = board_from_cells(cells)
+        return timed_search(board, board.AI_PLAYER, budget)
+    return search
+
+
+def parse_address(address):
+    ''' Return (host, port) of a TCP address 'host:port' or
+        '[IPv6 host]:port', or the path of a Unix socket.'''
+    if address.startswith('['):
+        host, bracket, port = address[1:].partition(']:')
+        if not bracket:
+            raise ValueError('Address not [host]:port: ' + address)
+        return host, int(port)
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        return host or '127.0.0.1', int(port)
+    return address
+
+
+def remove_stale_socket(path):
+    ''' Remove the Unix socket path of a server that has gone. Raises
+        FileExistsError when path is no socket or a server still listens
+        on it.'''
+    if not stat.S_ISSOCK(os.stat(path).st_mode):
+        raise FileExistsError('Not a socket: ' + path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.remove(path)
+        return
+    finally:
+        probe.close()
+    raise FileExistsError('Move server already running on ' + path)
+
+
+class MoveServer:
+    ''' Batched move search with a shared cache, on an asyncio loop.
+
+    Requests are collected for batch_window seconds (or until batch_size
+    are waiting) and searched together on a worker thread; the cache
+    holds (move, score) per canonical position. When the search of a
+    batch fails, its requests are answered with '? 0' (see stats
+    'errors') and batching goes on.
+    '''
+    def __init__(self, search=None, batch_size=32, batch_window=0.002):
+        self.search = search or default_search()
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.cache = {}
+        self.stats = {'requests': 0, 'batches': 0, 'cache_hits': 0,
+                      'searches': 0, 'latency': 0.0, 'max_latency': 0.0,
+                      'errors': 0}
+        self.started = perf_counter()
+        self._queue = None
+        self._server = None
+        self._batcher = None
+        self._writers = set()
+
+    async def start(self, address):
+        ''' Listen on address (see parse_address).'''
+        self._queue = asyncio.Queue()
+        address = parse_address(address)
+        if isinstance(address, tuple):
+            self._server = await asyncio.start_server(self._handle,
+                                                      *address)
+        else:
+            if os.path.exists(address):
+                remove_stale_socket(address)
+            self._server = await asyncio.start_unix_server(self._handle,
+                                                           address)
+        self._batcher = asyncio.ensure_future(self._batches())
+        self.started = perf_counter()
+
+    async def stop(self):
+        ''' Stop listening and batching.'''
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        await self._server.wait_closed()
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+
+    async def _handle(self, reader, writer):
+        ''' Answer the requests of one rig, in order.'''
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                start = perf_counter()
+                try:
+                    code = int(line)
+                    if not 0 <= code < 3 ** 9:
+                        raise ValueError(line)
+                except ValueError:
+                    self.stats['errors'] += 1
+                    writer.write(b'? 0\n')
+                    continue
+                future = asyncio.Future()
+                self._queue.put_nowait((code, future))
+                try:
+                    result = await future
+                except Exception:
+                    # The search of the batch failed
+                    self.stats['errors'] += 1
+                    writer.write(b'? 0\n')
+                    await writer.drain()
+                    continue
+                if result is None:
+                    answer = NO_MOVE
+                else:
+                    answer = '{} {}'.format(result['index'], result['score'])
+                writer.write(answer.encode() + b'\n')
+                await writer.drain()
+                latency = perf_counter() - start
+                self.stats['requests'] += 1
+                self.stats['latency'] += latency
+                self.stats['max_latency'] = max(self.stats['max_latency'],
+                                                latency)
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _batches(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(),
+                                                        remaining))
+                except asyncio.TimeoutError:
+                    break
+            self.stats['batches'] += 1
+            # Each canonical position once
+            positions = {}
+            for code, future in batch:
+                key, perm = canonical(decode(code))
+                positions.setdefault(key, []).append((perm, future))
+            misses = [key for key in positions if key not in self.cache]
+            self.stats['cache_hits'] += len(batch) - len(misses)
+            error = None
+            if misses:
+                self.stats['searches'] += len(misses)
+                try:
+                    results = await loop.run_in_executor(
+                        None, self._search_batch, misses)
+                except Exception as e:
+                    error = e
+                else:
+                    self.cache.update(results)
+            for key, requests in positions.items():
+                entry = self.cache.get(key)
+                for perm, future in requests:
+                    if future.done():
+                        # The rig has gone
+                        continue
+                    if key not in self.cache:
+                        future.set_exception(error)
+                    elif entry is None:
+                        future.set_result(None)
+                    else:
+                        index, score = entry
+                        future.set_result({'index': perm[index],
+                                           'score': score})
+
+    def _search_batch(self, keys):
+        ''' Search the canonical positions keys (worker thread).'''
+        results = {}
+        for key in keys:
+            result = self.search(decode(key))
+            # Canonical cells map to themselves: the move is in the
+            # canonical frame
+            results[key] = None if result is None else \
+                (result['index'], result['score'])
+        return results
+
+    def report(self):
+        ''' Return latency and throughput as text.'''
+        requests = self.stats['requests']
+        elapsed = perf_counter() - self.started
+        lines = ['{} requests in {:.1f} s: {:.0f} requests/s'.format(
+                 requests, elapsed, requests / elapsed if elapsed else 0)]
+        if requests:
+            lines.append('latency mean {:.2f} ms, max {:.2f} ms'.format(
+                         1000 * self.stats['latency'] / requests,
+                         1000 * self.stats['max_latency']))
+            lines.append('{} batches of {:.1f} requests, {:.1%} from cache, '
+                         '{} searches'.format(
+                             self.stats['batches'],
+                             requests / max(1, self.stats['batches']),
+                             self.stats['cache_hits'] / float(requests),
+                             self.stats['searches']))
+        return '\n'.join(lines)
+
+
+class MoveClient:
+    ''' Blocking client of a move server for the game loop.
+
+    move() returns None when the server can not be reached; the client
+    then does not try again for retry_after seconds, so a rig without
+    server does not wait for a timeout on every move. Thread-safe.
+    '''
+    def __init__(self, address, timeout=1.0, retry_after=30.0):
+        self.address = parse_address(address)
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.failed_at = None
+        self._socket = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if isinstance(self.address, tuple):
+            self._socket = socket.create_connection(self.address,
+                                                    self.timeout)
+        else:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.settimeout(self.timeout)
+            self._socket.connect(self.address)
+        self._file = self._socket.makefile('rwb')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def move(self, board):
+        ''' Return the computer's move {'index', 'score'} on board, or
+            None when the server is unreachable or has no move.'''
+        with self._lock:
+            if self.failed_at is not None and \
+                    perf_counter() - self.failed_at < self.retry_after:
+                return None
+            try:
+                if self._socket is None:
+                    self._connect()
+                code = encode(cells_from_board(board))
+                self._file.write('{}\n'.format(code).encode())
+                self._file.flush()
+                answer = self._file.readline().decode().split()
+                if len(answer) != 2:
+                    raise ConnectionError('Move server closed connection')
+            except (OSError, ValueError):
+                self.close()
+                self.failed_at = perf_counter()
+                return None
+            self.failed_at = None
+            if answer[0] in ('-', '?'):
+                return None
+            return {'index': int(answer[0]), 'score': int(answer[1])}
+
+
+class LoopbackServer:
+    ''' A move server on its own thread and event loop, on a Unix socket
+        in a temporary directory (for testing and --bench).'''
+    def __init__(self, **kwargs):
+        self.directory = tempfile.mkdtemp(prefix='ksm_tictactoe_')
+        self.address = os.path.join(self.directory, 'moves.sock')
+        self.server = MoveServer(**kwargs)
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.server.start(self.address))
+            started.set()
+            self.loop.run_forever()
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.server.stop(),
+                                         self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        os.remove(self.address)
+        os.rmdir(self.directory)
+
+
+def random_game_positions(rng):
+    ''' Yield the positions of a random game where the computer moves.'''
+    cells = [EMPTY] * 9
+    player = rng.choice((AI, HU))
+    while winner(cells) == EMPTY and EMPTY in cells:
+        if player == AI:
+            yield tuple(cells)
+        empty = [i for i in range(9) if cells[i] == EMPTY]
+        cells[rng.choice(empty)] = player
+        player = HU if player == AI else AI
+
+
+def bench(rigs, games=20, seed=2018):
+    ''' Play random games on rigs client threads against a loopback
+        server, return its report.'''
+    server = LoopbackServer()
+    errors = []
+
+    def rig(nr):
+        rng = random.Random(seed + nr)
+        client = MoveClient(server.address)
+        for _ in range(games):
+            for cells in random_game_positions(rng):
+                if client.move(board_from_cells(cells)) is None:
+                    errors.append(cells)
+        client.close()
+    threads = [threading.Thread(target=rig, args=(nr,))
+               for nr in range(rigs)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+    report = server.server.report()
+    server.close()
+    return '{} rigs, {} games each, {:.2f} s, {} failed\n{}'.format(
+        rigs, games, elapsed, len(errors), report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move server for rigs.')
+    parser.add_argument('--address', default='/tmp/ksm_tictactoe.sock',
+                        help='Unix socket path or host:port')
+    parser.add_argument('--bench', type=int, default=0,
+                        help='benchmark this many rigs on a loopback server')
+    parser.add_argument('--report', type=float, default=60.0,
+                        help='seconds between reports')
+    args = parser.parse_args()
+
+    if args.bench:
+        print(bench(args.bench))
+        return
+    server = MoveServer()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def report():
+        while True:
+            await asyncio.sleep(args.report)
+            print(server.report())
+    loop.run_until_complete(server.start(args.address))
+    print('Move server on {}'.format(args.address))
+    reporter = asyncio.ensure_future(report())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reporter.cancel()
+        loop.run_until_complete(server.stop())
+        print(server.report())
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
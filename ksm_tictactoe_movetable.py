@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+''' Precomputed perfect-play move table for ksm_tictactoe_ps.
+
+The solver walks every reachable position once and stores the best move
+and score of the computer (X) for each canonical position: a position is
+reduced with the 8 rotations and reflections of the board to the one with
+the lowest base-3 code. The table file is memory-mapped at runtime. A
+lookup canonicalizes the board (8 permutations of 9 cells), finds the
+entry of the canonical code with a rank bitmap over the 3^9 codes, and
+maps the move back through the permutation: a constant-time lookup in a
+table of 3.7 KB instead of 19.7 KB with one byte per code.
+
+Build and check the table with:
+    python3 ksm_tictactoe_movetable.py --verify
+The same check, and that movetable.bin is up to date, runs with the tests:
+    python3 -m pytest test_ksm_tictactoe_movetable.py
+'''
+import argparse
+import mmap
+import struct
+
+from ksm_tictactoe_core_ps import Board, minimax
+
+TABLE_FILE = 'movetable.bin'
+
+# File layout: header, bitmap of the canonical codes in the table (one bit
+# per base-3 code, in 64-bit blocks), number of codes before each block
+# (uint16), entries (uint8) in code order
+MAGIC = b'KTT3'
+HEADER = struct.Struct('<4sI')
+CODES = 3 ** 9
+BLOCKS = (CODES + 63) // 64
+RANK = struct.Struct('<{}H'.format(BLOCKS))
+
+# Cell values used for encoding positions
+EMPTY = 0
+AI = 1
+HU = 2
+
+# Scores as returned by minimax() and their 2-bit encoding in an entry
+SCORES = (0, 10, -10)
+
+
+def _symmetries():
+    ''' Return the 8 symmetries of the board as cell permutations.
+
+    For permutation p the transformed board is [cells[p[i]] for i in 0..8].
+    '''
+    transforms = (lambda r, c: (r, c),
+                  lambda r, c: (c, 2 - r),
+                  lambda r, c: (2 - r, 2 - c),
+                  lambda r, c: (2 - c, r),
+                  lambda r, c: (r, 2 - c),
+                  lambda r, c: (2 - r, c),
+                  lambda r, c: (c, r),
+                  lambda r, c: (2 - c, 2 - r))
+    perms = []
+    for transform in transforms:
+        perm = [0] * 9
+        for i in range(9):
+            r, c = transform(i // 3, i % 3)
+            perm[r * 3 + c] = i
+        perms.append(tuple(perm))
+    return tuple(perms)
+
+
+SYMMETRIES = _symmetries()
+
+LINES = ((0, 1, 2), (3, 4, 5), (6, 7, 8),
+         (0, 3, 6), (1, 4, 7), (2, 5, 8),
+         (0, 4, 8), (2, 4, 6))
+
+
+def encode(cells):
+    ''' Return base-3 code of a tuple of 9 cell values.'''
+    code = 0
+    for value in reversed(cells):
+        code = code * 3 + value
+    return code
+
+
+def canonical(cells):
+    ''' Return (code, permutation) of the canonical form of cells.'''
+    best_code = None
+    best_perm = None
+    for perm in SYMMETRIES:
+        code = encode([cells[p] for p in perm])
+        if best_code is None or code < best_code:
+            best_code = code
+            best_perm = perm
+    return best_code, best_perm
+
+
+def cells_from_board(board):
+    ''' Return the cell values of a Board as a tuple.'''
+    cells = []
+    for i in range(9):
+        if board.index[i] == board.AI_PLAYER:
+            cells.append(AI)
+        elif board.index[i] == board.HU_PLAYER:
+            cells.append(HU)
+        else:
+            cells.append(EMPTY)
+    return tuple(cells)
+
+
+def winner(cells):
+    ''' Return the player with three in a row, or EMPTY.'''
+    for a, b, c in LINES:
+        if cells[a] != EMPTY and cells[a] == cells[b] == cells[c]:
+            return cells[a]
+    return EMPTY
+
+
+class Solver:
+    ''' Solve all reachable positions with memoized minimax.'''
+    def __init__(self):
+        self.memo = {}
+        # Canonical code -> (move in canonical frame, score)
+        self.table = {}
+
+    def solve(self, cells, player):
+        ''' Return (best move, score) for player to move at cells.'''
+        key = (encode(cells), player)
+        if key in self.memo:
+            return self.memo[key]
+
+        won = winner(cells)
+        if won == AI:
+            result = (None, 10)
+        elif won == HU:
+            result = (None, -10)
+        elif EMPTY not in cells:
+            result = (None, 0)
+        else:
+            opponent = HU if player == AI else AI
+            best_move = None
+            best_score = None
+            for spot in range(9):
+                if cells[spot] != EMPTY:
+                    continue
+                child = cells[:spot] + (player,) + cells[spot + 1:]
+                score = self.solve(child, opponent)[1]
+                # Keep the first best spot, like minimax() does
+                if best_score is None or \
+                   (player == AI and score > best_score) or \
+                   (player == HU and score < best_score):
+                    best_move = spot
+                    best_score = score
+            result = (best_move, best_score)
+
+        self.memo[key] = result
+        return result
+
+    def build(self):
+        ''' Walk all reachable positions where the computer is to move.'''
+        seen = set()
+        empty = (EMPTY,) * 9
+        self._walk(empty, AI, seen)
+        self._walk(empty, HU, seen)
+        return self.table
+
+    def _walk(self, cells, player, seen):
+        if (cells, player) in seen:
+            return
+        seen.add((cells, player))
+        if winner(cells) != EMPTY or EMPTY not in cells:
+            return
+
+        if player == AI:
+            code, perm = canonical(cells)
+            if code not in self.table:
+                canon = tuple(cells[p] for p in perm)
+                self.table[code] = self.solve(canon, AI)
+
+        opponent = HU if player == AI else AI
+        for spot in range(9):
+            if cells[spot] == EMPTY:
+                child = cells[:spot] + (player,) + cells[spot + 1:]
+                self._walk(child, opponent, seen)
+
+
+def write_table(table, filename=TABLE_FILE):
+    ''' Write the solved table to a binary file.'''
+    bitmap = bytearray(8 * BLOCKS)
+    ranks = [0] * BLOCKS
+    entries = bytearray()
+    for code in sorted(table):
+        move, score = table[code]
+        bitmap[code >> 3] |= 1 << (code & 7)
+        for block in range((code >> 6) + 1, BLOCKS):
+            ranks[block] += 1
+        entries.append(move | (SCORES.index(score) << 4))
+    with open(filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(table)))
+        f.write(bitmap)
+        f.write(RANK.pack(*ranks))
+        f.write(entries)
+
+
+class MoveTable:
+    ''' Memory-mapped move table with constant-time lookup.'''
+    def __init__(self, filename=TABLE_FILE):
+        self._file = open(filename, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+        self._view = None
+        magic, self.size = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or len(self._mmap) != \
+                HEADER.size + 8 * BLOCKS + RANK.size + self.size:
+            self.close()
+            raise ValueError('Not a move table: ' + filename)
+        self._view = memoryview(self._mmap)
+        start = HEADER.size
+        self._bitmap = self._view[start:start + 8 * BLOCKS]
+        start += 8 * BLOCKS
+        self._ranks = RANK.unpack_from(self._mmap, start)
+        self._entries = self._view[start + RANK.size:]
+
+    def close(self):
+        ''' Release the memory map.'''
+        if self._view is not None:
+            self._bitmap.release()
+            self._entries.release()
+            self._view.release()
+            self._view = None
+        self._mmap.close()
+        self._file.close()
+
+    def lookup(self, board):
+        ''' Return best move {'index', 'score'} of the computer, or None
+            when the position is not in the table (e.g. game over).'''
+        return self.lookup_cells(cells_from_board(board))
+
+    def lookup_cells(self, cells):
+        ''' Same as lookup() for a tuple of 9 cell values.'''
+        code, perm = canonical(cells)
+        block = code >> 6
+        bits = int.from_bytes(self._bitmap[8 * block:8 * block + 8],
+                              'little')
+        bit = 1 << (code & 63)
+        if not bits & bit:
+            return None
+        # Entries before this one: all codes in earlier blocks and the
+        # lower codes in this block
+        entry = self._entries[self._ranks[block] +
+                              bin(bits & (bit - 1)).count('1')]
+        # The move is stored in the canonical frame
+        return {'index': perm[entry & 0x0f], 'score': SCORES[entry >> 4]}
+
+
+def reachable_boards():
+    ''' Yield every reachable Board where the computer is to move.'''
+    seen = set()
+    stack = [((EMPTY,) * 9, AI), ((EMPTY,) * 9, HU)]
+    while stack:
+        cells, player = stack.pop()
+        if (cells, player) in seen:
+            continue
+        seen.add((cells, player))
+        if winner(cells) != EMPTY or EMPTY not in cells:
+            continue
+        if player == AI:
+            board = Board()
+            for i, value in enumerate(cells):
+                if value == AI:
+                    board.index[i] = board.AI_PLAYER
+                elif value == HU:
+                    board.index[i] = board.HU_PLAYER
+            yield board
+        opponent = HU if player == AI else AI
+        for spot in range(9):
+            if cells[spot] == EMPTY:
+                stack.append((cells[:spot] + (player,) + cells[spot + 1:],
+                              opponent))
+
+
+def verify(table):
+    ''' Check the table against minimax() on every reachable position.
+
+    The table may pick another spot than minimax() when several spots are
+    equally good, so the score of the position and the score of the
+    table's move are compared. Returns the number of positions checked.
+    '''
+    checked = 0
+    for board in reachable_boards():
+        expected = minimax(board, board.AI_PLAYER)
+        result = table.lookup(board)
+        if result is None or result['score'] != expected['score']:
+            raise AssertionError('Score mismatch for {}: {} != {}'.format(
+                                 board.index, result, expected))
+        spot = result['index']
+        if spot not in board.empty_indexes():
+            raise AssertionError('Illegal move {} for {}'.format(
+                                 spot, board.index))
+        board.index[spot] = board.AI_PLAYER
+        if board.check_for_winner(board.AI_PLAYER):
+            score = 10
+        elif not board.empty_indexes():
+            score = 0
+        else:
+            score = minimax(board, board.HU_PLAYER)['score']
+        if score != expected['score']:
+            raise AssertionError('Move {} for {} scores {}, not {}'.format(
+                                 spot, board.index, score,
+                                 expected['score']))
+        checked += 1
+    return checked
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the move table.')
+    parser.add_argument('--output', default=TABLE_FILE)
+    parser.add_argument('--verify', action='store_true',
+                        help='check the table against minimax()')
+    args = parser.parse_args()
+
+    table = Solver().build()
+    write_table(table, args.output)
+    print('Wrote {} positions to {}'.format(len(table), args.output))
+    if args.verify:
+        move_table = MoveTable(args.output)
+        print('Verified {} positions'.format(verify(move_table)))
+        move_table.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+''' Root-parallel search on a pool of worker processes.
+
+The root moves are split over the workers of a process pool. Each worker
+keeps its own SearchEngine (and transposition table) between moves, so
+the pool is started once and stays warm. The best score found so far is
+shared between the workers and used as lower bound (alpha) for the root
+moves that still have to be searched.
+
+The game does not use it: a 3 x 3 move comes from the move table, and a
+full 3 x 3 search takes milliseconds on one core, less than handing the
+root moves to the workers. It is meant for the larger boards of
+ksm_tictactoe_search.py. The benchmark prints the time and speedup for
+each number of processes, up to the number of cores of the machine, so
+the scaling can be read off on the target (the Pi 3B has four cores).
+
+Run the benchmark with:
+    python3 ksm_tictactoe_parallel.py
+'''
+import argparse
+import multiprocessing
+import os
+from time import perf_counter
+
+from ksm_tictactoe_search import SearchEngine, GridBoard, INFINITY, \
+     AI, HU, EMPTY
+
+# Worker state, set by _init_worker()
+_engine = None
+_shared_alpha = None
+_search_id = None
+
+
+def _init_worker(size, k, shared_alpha):
+    global _engine, _shared_alpha
+    _engine = SearchEngine(size, k)
+    _shared_alpha = shared_alpha
+
+
+def _score_root_move(args):
+    ''' Search one root move in a worker, return (move, score, exact,
+        nodes).'''
+    global _search_id
+    search_id, cells, side, move, depth = args
+    if search_id != _search_id:
+        _engine.tt.new_search()
+        _search_id = search_id
+
+    empties = cells.count(EMPTY)
+    key = _engine.hash_cells(cells, side)
+    # One below the best score so far, so a move that ties it still gets
+    # its exact score and the merge can take the first one in move order
+    alpha = _shared_alpha.value - 1
+    _engine.nodes = 0
+    score = _engine.score_move(cells, side, key, empties, depth, move,
+                               alpha, INFINITY)
+    # A score at or below alpha is only an upper bound
+    exact = score > alpha
+    if exact:
+        with _shared_alpha.get_lock():
+            if score > _shared_alpha.value:
+                _shared_alpha.value = score
+    return move, score, exact, _engine.nodes
+
+
+class ParallelSearch:
+    ''' Search the root moves of a position on a pool of processes.'''
+    def __init__(self, processes=None, size=3, k=3):
+        self.processes = processes or os.cpu_count() or 1
+        self.size = size
+        self.k = k
+        self.engine = SearchEngine(size, k)
+        self._alpha = multiprocessing.Value('i', -INFINITY)
+        self._pool = multiprocessing.Pool(self.processes, _init_worker,
+                                          (size, k, self._alpha))
+        self._search_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        ''' Stop the worker processes.'''
+        self._pool.close()
+        self._pool.join()
+
+    def search(self, board, player, depth=None):
+        ''' Return best move {'index', 'score'} for player on board.
+
+        Without depth the game tree is searched to the end. The result
+        also holds 'nodes' and 'time' (seconds).
+        '''
+        start = perf_counter()
+        cells = self.engine.cells_from_board(board)
+        side = AI if player == board.AI_PLAYER else HU
+
+        empties = cells.count(EMPTY)
+        if self.engine.winner(cells) != EMPTY or empties == 0:
+            result = self.engine.search(board, player)
+            result.update(nodes=0, time=perf_counter() - start)
+            return result
+        if depth is None or depth > empties:
+            depth = empties
+
+        self._search_id += 1
+        self._alpha.value = -INFINITY
+        moves = self.engine.ordered_moves(cells)
+        tasks = [(self._search_id, cells, side, move, depth)
+                 for move in moves]
+
+        results = {}
+        nodes = 0
+        for move, score, exact, move_nodes in \
+                self._pool.imap_unordered(_score_root_move, tasks):
+            results[move] = (score, exact)
+            nodes += move_nodes
+
+        # Merge: the first best score in move order, like the serial search
+        # (ties are exact, see _score_root_move())
+        best_move = None
+        best_score = -INFINITY
+        for move in moves:
+            score, exact = results[move]
+            if exact and score > best_score:
+                best_move = move
+                best_score = score
+        return {'index': best_move,
+                'score': best_score if side == AI else -best_score,
+                'nodes': nodes,
+                'time': perf_counter() - start}
+
+
+def benchmark(configs, process_counts, repeats=3):
+    ''' Print search time and speedup against the number of processes.'''
+    print('{} cores'.format(os.cpu_count()))
+    for size, k, depth in configs:
+        board = GridBoard(size, k)
+        print('{0}x{0}, {1} in a row, depth {2}:'.format(
+              size, k, depth if depth is not None else 'full'))
+
+        # Serial engine as reference
+        times = []
+        for _ in range(repeats):
+            engine = SearchEngine(size, k)
+            start = perf_counter()
+            cells = engine.cells_from_board(board)
+            empties = cells.count(EMPTY)
+            engine.root(cells, AI, engine.hash_cells(cells, AI), empties,
+                        depth or empties)
+            times.append(perf_counter() - start)
+        serial = min(times)
+        print('  serial      {:8.3f} s'.format(serial))
+
+        for processes in process_counts:
+            times = []
+            startups = []
+            for _ in range(repeats):
+                # New pool, so every run starts with empty tables. The
+                # search time leaves out the start of the pool, which the
+                # game pays once.
+                start = perf_counter()
+                with ParallelSearch(processes, size, k) as search:
+                    startups.append(perf_counter() - start)
+                    result = search.search(board, board.AI_PLAYER, depth)
+                times.append(result['time'])
+            best = min(times)
+            print('  {:2d} process{} {:8.3f} s  speedup {:5.2f}  '
+                  '(pool start {:.3f} s)'.format(
+                      processes, 'es' if processes > 1 else '  ', best,
+                      serial / best, min(startups)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark root-parallel search.')
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    configs = ((3, 3, None), (4, 4, 8), (5, 4, 5))
+    benchmark(configs, range(1, args.processes + 1), args.repeats)
+
+
+if __name__ == '__main__':
+    main()
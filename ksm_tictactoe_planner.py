@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+''' Motion planner for drawing the computer's cross.
+
+A plan is a list of steps, one motor move each. A step starts when the
+steps it comes after have finished, or already when the pen has left the
+paper (clear). This overlaps the axes that do not depend on each other:
+the turntable and pen move to the second line and back home while the
+pen is still rising. Moves between strokes run faster with speed ramps.
+
+The pen has left the paper at pen_clear. Until that position is measured
+on the machine it is PEN_UP, so the moves only start when the pen is all
+the way up. To measure it, put the pen down on a sheet of paper and raise
+it in steps of 2 degrees (motor_pen.run_to_abs_pos()): the first position
+where the sheet slides out without touching the pen, plus 4 degrees
+towards PEN_UP as margin, is PEN_CLEAR. Print the time it saves with
+--pen-clear.
+
+estimate() times a plan with a trapezoidal model of the motor moves and
+execute() runs it on the motors. Print the estimated time per field,
+compared to the former step by step sequence, with:
+    python3 ksm_tictactoe_planner.py
+Add --simulate to also run the plans on simulated motors. These move
+with the same trapezoidal model, so that only checks execute() itself;
+check the model against motor traces recorded on the machine (see
+ksm_tictactoe_motortrace) with:
+    python3 ksm_tictactoe_planner.py --traces traces
+'''
+import argparse
+import os
+from time import perf_counter, sleep
+
+from ksm_tictactoe_motion import MotorTimeout, MotionAborted, profile, \
+     profile_position
+from ksm_tictactoe_retry import retry
+
+INFINITY = float('inf')
+
+#        turntable   pen
+# field  turn  move  move
+# 0      1     5     3
+# 1      1     4     2
+# 2      1     3     1
+# 3      1     4     4
+# 4      1     3     3
+# 5      1     2     2
+# 6      1     3     5
+# 7      1     2     4
+# 8      1     1     3
+FIELDS = ((1, 5, 3),
+          (1, 4, 2),
+          (1, 3, 1),
+          (1, 4, 4),
+          (1, 3, 3),
+          (1, 2, 2),
+          (1, 3, 5),
+          (1, 2, 4),
+          (1, 1, 3))
+
+# Motor positions of the machine (see ksm_tictactoe_lego_devices)
+TURN_POSITIONS = (0, -345, 345)
+MOVE_POSITIONS = (0, -740, -890, -1030, -1175, -1380)
+PEN_MOVE_POSITIONS = (0, -60, -210, -350, -500, -640)
+PEN_UP = -20
+PEN_DOWN = 20
+# Pen position where it has left the paper: not measured yet (see above),
+# so moves wait until the pen is all the way up
+PEN_CLEAR = PEN_UP
+
+# Strokes of the cross, relative to the field position
+LINE1 = 200
+LINE2_START = (-100, -75)
+LINE2 = 175
+
+# Axes: turntable turn, turntable move, pen sideways, pen up/down
+AXES = ('turn', 'move', 'pen_move', 'pen')
+HOME = {'turn': 0, 'move': 0, 'pen_move': 0, 'pen': PEN_UP}
+# Steps of a plan that bring the turntable home
+HOME_STEPS = ('home_move', 'home_turn')
+
+
+class Step:
+    ''' Move of one axis to an absolute position.
+
+    The step starts after the steps named in after have finished, and
+    when clear = (step name, position) is given, not before the axis of
+    that step has passed position.
+    '''
+    def __init__(self, name, axis, target, speed, accel=INFINITY,
+                 after=(), clear=None):
+        self.name = name
+        self.axis = axis
+        self.target = target
+        self.speed = speed
+        self.accel = accel
+        self.after = tuple(after)
+        self.clear = clear
+        # Estimated times, set by estimate()
+        self.start = None
+        self.end = None
+        self.origin = None
+
+    def __repr__(self):
+        return 'Step({!r}, {!r}, {})'.format(self.name, self.axis,
+                                             self.target)
+
+
+def _passed(position, clear, target):
+    ''' Check if position is at or past clear, seen from target. A clear
+        position at the target is only passed at the target.'''
+    if clear == target:
+        return position == target
+    return (position - clear) * (target - clear) >= 0
+
+
+class MotionPlanner:
+    ''' Turn a field index into a plan for drawing a cross.'''
+    def __init__(self, fields=FIELDS, turn_positions=TURN_POSITIONS,
+                 move_positions=MOVE_POSITIONS,
+                 pen_move_positions=PEN_MOVE_POSITIONS,
+                 travel_speed=800, draw_speed=400, pen_speed=400,
+                 accel=3000, pen_clear=PEN_CLEAR):
+        self.fields = fields
+        self.turn_positions = turn_positions
+        self.move_positions = move_positions
+        self.pen_move_positions = pen_move_positions
+        self.travel_speed = travel_speed
+        self.draw_speed = draw_speed
+        self.pen_speed = pen_speed
+        self.accel = accel
+        self.pen_clear = pen_clear
+
+    def _targets(self, field_index):
+        turn, move, pen_move = self.fields[field_index]
+        move = self.move_positions[move]
+        pen_move = self.pen_move_positions[pen_move]
+        return (self.turn_positions[turn], move, pen_move,
+                move + LINE1 + LINE2_START[0], pen_move + LINE2_START[1],
+                pen_move + LINE2_START[1] + LINE2)
+
+    def neutral_pen_move(self, field_indexes):
+        ''' Pen sideways position with the least expected travel to the
+            fields (all equally likely): the median of their positions.'''
+        positions = sorted(self.pen_move_positions[self.fields[i][2]]
+                           for i in field_indexes)
+        if not positions:
+            return None
+        middle = len(positions) // 2
+        if len(positions) % 2:
+            return positions[middle]
+        return (positions[middle - 1] + positions[middle]) // 2
+
+    def plan(self, field_index):
+        ''' Return the overlapped plan (list of steps) for a field.
+
+        Moves between strokes run at travel_speed with ramps; the pen and
+        the strokes themselves keep their speed, without ramps.
+        '''
+        turn, move, pen_move, move2, pen_move2, pen_end = \
+            self._targets(field_index)
+        travel, draw, pen, accel = (self.travel_speed, self.draw_speed,
+                                    self.pen_speed, self.accel)
+        lifted = ('lift', self.pen_clear)
+        first_up = ('up1', self.pen_clear)
+        second_up = ('up2', self.pen_clear)
+        return [
+            # Make sure the pen is up, move to the field as soon as it is
+            Step('lift', 'pen', PEN_UP, pen),
+            Step('turn', 'turn', turn, travel, accel, clear=lifted),
+            Step('move', 'move', move, travel, accel, clear=lifted),
+            Step('pen_move', 'pen_move', pen_move, travel, accel,
+                 clear=lifted),
+            # First line
+            Step('down1', 'pen', PEN_DOWN, pen,
+                 after=('turn', 'move', 'pen_move')),
+            Step('line1', 'move', move + LINE1, draw, after=('down1',)),
+            # Start of second line while the pen rises
+            Step('up1', 'pen', PEN_UP, pen, after=('line1',)),
+            Step('move2', 'move', move2, travel, accel, clear=first_up),
+            Step('pen_move2', 'pen_move', pen_move2, travel, accel,
+                 clear=first_up),
+            # Second line
+            Step('down2', 'pen', PEN_DOWN, pen,
+                 after=('move2', 'pen_move2')),
+            Step('line2', 'pen_move', pen_end, draw, after=('down2',)),
+            # Turntable home while the pen rises
+            Step('up2', 'pen', PEN_UP, pen, after=('line2',)),
+            Step('home_move', 'move', 0, travel, accel, clear=second_up),
+            Step('home_turn', 'turn', 0, travel, accel, clear=second_up)]
+
+    def sequential_plan(self, field_index, speed=400):
+        ''' Return the former sequence for a field: no ramps, and every
+            move waits until the moves before have finished.'''
+        turn, move, pen_move, move2, pen_move2, pen_end = \
+            self._targets(field_index)
+        return [
+            Step('turn', 'turn', turn, speed),
+            Step('move', 'move', move, speed),
+            Step('pen_move', 'pen_move', pen_move, speed),
+            Step('down1', 'pen', PEN_DOWN, speed,
+                 after=('turn', 'move', 'pen_move')),
+            Step('line1', 'move', move + LINE1, speed, after=('down1',)),
+            Step('up1', 'pen', PEN_UP, speed, after=('line1',)),
+            Step('move2', 'move', move2, speed, after=('up1',)),
+            Step('pen_move2', 'pen_move', pen_move2, speed,
+                 after=('up1',)),
+            Step('down2', 'pen', PEN_DOWN, speed,
+                 after=('move2', 'pen_move2')),
+            Step('line2', 'pen_move', pen_end, speed, after=('down2',)),
+            Step('up2', 'pen', PEN_UP, speed, after=('line2',)),
+            Step('home_move', 'move', 0, speed, after=('up2',)),
+            Step('home_turn', 'turn', 0, speed, after=('up2',))]
+
+
+def _check(steps):
+    ''' Check that steps only depend on earlier steps.'''
+    seen = set()
+    for step in steps:
+        depends = step.after + ((step.clear[0],) if step.clear else ())
+        for name in depends:
+            if name not in seen:
+                raise ValueError('Step {} depends on unknown or later '
+                                 'step {}'.format(step.name, name))
+        seen.add(step.name)
+
+
+def estimate(steps, state=None):
+    ''' Time a plan with the trapezoidal model, return total seconds.
+
+    state holds the axis positions at the start (default: HOME). Sets
+    start, end and origin of every step.
+    '''
+    _check(steps)
+    positions = dict(HOME if state is None else state)
+    # End of the last step of every axis
+    axis_free = dict.fromkeys(positions, 0.0)
+    done = {}
+    for step in steps:
+        start = axis_free[step.axis]
+        for name in step.after:
+            start = max(start, done[name].end)
+        if step.clear is not None:
+            other, position = step.clear
+            start = max(start, _clear_time(done[other], position))
+        step.origin = positions[step.axis]
+        step.start = start
+        step.end = start + profile(step.target - step.origin, step.speed,
+                                   step.accel, step.accel)[0]
+        positions[step.axis] = step.target
+        axis_free[step.axis] = step.end
+        done[step.name] = step
+    return max(step.end for step in steps)
+
+
+def _clear_time(step, position):
+    ''' Time at which the axis of an estimated step passes position.'''
+    if _passed(step.origin, position, step.target):
+        return step.start
+    distance = step.target - step.origin
+    needed = abs(position - step.origin)
+    low, high = 0.0, step.end - step.start
+    # Bisection on the monotonic distance covered
+    for _ in range(40):
+        middle = (low + high) / 2
+        covered = abs(profile_position(middle, distance, step.speed,
+                                       step.accel, step.accel))
+        if covered < needed:
+            low = middle
+        else:
+            high = middle
+    return step.start + high
+
+
+def _motor_ports(motor, *args):
+    ''' Ports of a motor call, for the failure counters (see retry).'''
+    address = getattr(motor, 'address', None)
+    return (address,) if address is not None else ()
+
+
+# Single reads and commands of a motor are retried and charged to its
+# port; a failure of the plan itself is not retried (see execute()).
+@retry('wait', ports=_motor_ports)
+def _read(motor):
+    return motor.position, motor.state
+
+
+@retry('command', ports=_motor_ports)
+def _start(motor, ramp, speed, target):
+    motor.ramp_up_sp = ramp
+    motor.ramp_down_sp = ramp
+    motor.run_to_abs_pos(speed_sp=speed, position_sp=target)
+
+
+@retry('command', ports=_motor_ports)
+def _stop(motor):
+    motor.stop()
+
+
+@retry('wait', ports=_motor_ports)
+def _ramps(motor):
+    return motor.ramp_up_sp, motor.ramp_down_sp
+
+
+@retry('command', ports=_motor_ports)
+def _set_ramps(motor, ramp_up, ramp_down):
+    motor.ramp_up_sp = ramp_up
+    motor.ramp_down_sp = ramp_down
+
+
+def execute(steps, motors, timeout=30.0, poll=0.005, tolerance=5,
+            detach=(), abort=None, stall_time=0.5, stalled=None,
+            start_time=0.05):
+    ''' Run a plan on motors (dict axis -> motor), return the measured
+        (start, end) of every step in seconds from the start.
+
+    Steps named in detach are started but not waited for (end None),
+    e.g. HOME_STEPS to let the turntable go home during the next turn.
+    A step whose motor reports 'stalled', or runs without moving for
+    stall_time seconds (e.g. the pen pressed on the paper before its
+    target), counts as finished; its name is added to the list stalled.
+    A step away from its target that stopped moving only counts as
+    finished once its motor was seen running or moving, or start_time
+    seconds after its command (see wait_for_motors()). When the
+    threading.Event abort is set, the running motors are stopped
+    and MotionAborted is raised. The ramps of the motors are restored
+    afterwards, so later moves (Pen.home(), the turntable) keep theirs.
+    Every read and command of a motor is retried on OSError and charged
+    to the port of that motor (see ksm_tictactoe_retry).
+    '''
+    _check(steps)
+    ramps = {axis: _ramps(motor) for axis, motor in motors.items()}
+    try:
+        return _execute(steps, motors, timeout, poll, tolerance, detach,
+                        abort, stall_time, stalled, start_time)
+    finally:
+        for axis, (ramp_up, ramp_down) in ramps.items():
+            _set_ramps(motors[axis], ramp_up, ramp_down)
+
+
+def _execute(steps, motors, timeout, poll, tolerance, detach, abort,
+             stall_time, stalled, start_time):
+    steps_by_name = {step.name: step for step in steps}
+    waiting = list(steps)
+    running = []
+    times = {}
+    previous = {}
+    # Time of the last position change of every running step
+    moved = {}
+    # First position seen of every step, and the steps seen moving
+    origin = {}
+    started = set()
+    start = perf_counter()
+    while waiting or any(step.name not in detach for step in running):
+        now = perf_counter() - start
+        if abort is not None and abort.is_set():
+            for step in running:
+                _stop(motors[step.axis])
+            raise MotionAborted('Plan aborted after {:.2f} s'.format(now))
+        # Finished steps
+        for step in list(running):
+            position, state = _read(motors[step.axis])
+            unchanged = position == previous.get(step.name)
+            previous[step.name] = position
+            if 'running' in state or \
+                    position != origin.setdefault(step.name, position):
+                started.add(step.name)
+            # Unchanged before the motor has started is not finished
+            settled = unchanged and \
+                (step.name in started or
+                 now - times[step.name][0] >= start_time)
+            if not unchanged:
+                moved[step.name] = now
+            if 'stalled' in state or ('running' in state and
+                                      now - moved[step.name] >= stall_time):
+                running.remove(step)
+                times[step.name] = (times[step.name][0], now)
+                if stalled is not None:
+                    stalled.append(step.name)
+            elif 'running' not in state and \
+                    (abs(position - step.target) <= tolerance or settled):
+                running.remove(step)
+                times[step.name] = (times[step.name][0], now)
+        # Steps that can start, in order
+        busy = set(step.axis for step in running)
+        for step in list(waiting):
+            if step.axis in busy or \
+                    any(name not in times or times[name][1] is None
+                        for name in step.after):
+                busy.add(step.axis)
+                continue
+            if step.clear is not None:
+                other, position = step.clear
+                if other not in times:
+                    busy.add(step.axis)
+                    continue
+                other = steps_by_name[other]
+                if times[other.name][1] is None and \
+                        not _passed(_read(motors[other.axis])[0],
+                                    position, other.target):
+                    busy.add(step.axis)
+                    continue
+            motor = motors[step.axis]
+            ramp = 0
+            if step.accel != INFINITY:
+                ramp = int(motor.max_speed * 1000 / step.accel)
+            _start(motor, ramp, step.speed, step.target)
+            waiting.remove(step)
+            running.append(step)
+            busy.add(step.axis)
+            times[step.name] = (now, None)
+            moved[step.name] = now
+        if now >= timeout:
+            raise MotorTimeout('Plan not finished after {} s'.format(
+                               timeout))
+        sleep(poll)
+    return times
+
+
+def _simulated_motors():
+    from ksm_tictactoe_simulated_devices import SimulatedMotor
+    motors = {axis: SimulatedMotor(position=position)
+              for axis, position in HOME.items()}
+    # The turntable turns with a medium motor
+    motors['turn'].max_speed = 1560
+    return motors
+
+
+def measured_steps(directory):
+    ''' Return the step durations of the planned moves recorded in the
+        motor traces in directory, as {(field, step name): [seconds]}.'''
+    from ksm_tictactoe_motortrace import load_trace
+    measured = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.npz'):
+            continue
+        trace = load_trace(os.path.join(directory, name))
+        if 'field' not in trace['info']:
+            continue
+        field_index = int(trace['info']['field'])
+        for segment, begin, end, axis in trace['segments']:
+            if segment.startswith('draw.') and end is not None:
+                measured.setdefault((field_index, segment[5:]), []).append(
+                    end - begin)
+    return measured
+
+
+def compare(planner, measured):
+    ''' Print the estimated against the measured time of every step.'''
+    print('field  step          estimated  measured  runs   error')
+    errors = []
+    for field_index in range(len(planner.fields)):
+        steps = planner.plan(field_index)
+        estimate(steps)
+        for step in steps:
+            durations = measured.get((field_index, step.name))
+            if not durations:
+                continue
+            mean = sum(durations) / len(durations)
+            estimated = step.end - step.start
+            errors.append(mean - estimated)
+            print('{:5d}  {:12s} {:8.3f} s {:7.3f} s {:5d} {:+7.3f} s'.format(
+                  field_index, step.name, estimated, mean, len(durations),
+                  mean - estimated))
+    if errors:
+        print('mean error {:+.3f} s over {} steps'.format(
+              sum(errors) / len(errors), len(errors)))
+    else:
+        print('No planned moves in the traces')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Print estimated drawing time per field.')
+    parser.add_argument('--simulate', action='store_true',
+                        help='also run the plans on simulated motors')
+    parser.add_argument('--traces',
+                        help='compare with the motor traces in this '
+                             'directory')
+    parser.add_argument('--pen-clear', type=int, default=PEN_CLEAR,
+                        help='pen position where it has left the paper '
+                             '(default {})'.format(PEN_CLEAR))
+    args = parser.parse_args()
+
+    planner = MotionPlanner(pen_clear=args.pen_clear)
+    if args.traces:
+        compare(planner, measured_steps(args.traces))
+        return
+
+    # Drawn: the pen is up after the second line, the game continues
+    print('field  drawn: sequential  planned   total: sequential  planned' +
+          ('  simulated' if args.simulate else ''))
+    totals = [0.0] * 4
+    for field_index in range(len(planner.fields)):
+        times = []
+        for steps in (planner.sequential_plan(field_index),
+                      planner.plan(field_index)):
+            total = estimate(steps)
+            drawn = [step.end for step in steps if step.name == 'up2'][0]
+            times += [drawn, total]
+        times = [times[0], times[2], times[1], times[3]]
+        totals = [a + b for a, b in zip(totals, times)]
+        line = '{:5d}  {:16.2f} s {:6.2f} s  {:16.2f} s {:6.2f} s'.format(
+            field_index, *times)
+        if args.simulate:
+            measured = execute(planner.plan(field_index),
+                               _simulated_motors())
+            line += '  {:7.2f} s'.format(
+                max(end for start, end in measured.values()))
+        print(line)
+    print('mean   {:16.2f} s {:6.2f} s  {:16.2f} s {:6.2f} s'.format(
+          *[total / len(planner.fields) for total in totals]))
+
+
+if __name__ == '__main__':
+    main()
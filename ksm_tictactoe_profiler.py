@@ -0,0 +1,120 @@
+''' End-to-end latency profiler of the game loop.
+
+Records the wall time of every phase of every move and prints a
+breakdown per game. The game functions are wrapped once, before the game
+loop, so the loop itself stays unchanged. Nested phases only count their
+own time: the capture inside the vision phase is not counted twice. The
+stages the game loop waits for on worker threads are profiled too.
+
+Enable with the environment variable KSM_TICTACTOE_PROFILE=1.
+'''
+import asyncio
+import atexit
+import threading
+from time import perf_counter
+
+from ksm_tictactoe_events import STAGE_THREAD
+
+PHASES = ('capture', 'vision', 'search', 'motion', 'display', 'human')
+
+
+class Profiler:
+    ''' Wall time per phase per move, reported per game.
+
+    Moves are numbered from the calls that start them: a 'computer' or
+    'human' start. Move 0 holds the time before the first move.
+    '''
+    def __init__(self, output=print):
+        self.output = output
+        self.games = []
+        self._stack = []
+        atexit.register(self.end_game)
+
+    def start_game(self):
+        ''' Report the previous game and start a new one.'''
+        self.end_game()
+        self.games.append([{'player': 'setup'}])
+
+    def end_game(self):
+        ''' Report the current game, if it has moves.'''
+        if self.games and len(self.games[-1]) > 1 and \
+                not self.games[-1][0].get('reported'):
+            self.games[-1][0]['reported'] = True
+            self.output(self.report(len(self.games) - 1))
+
+    def wrap(self, phase, func, start=None):
+        ''' Return func recording its time in phase. start 'game',
+            'computer' or 'human' makes a call start a game or a move.
+            func can be a coroutine function.'''
+        if asyncio.iscoroutinefunction(func):
+            async def wrapper(*args, **kwargs):
+                if not self._profiled():
+                    return await func(*args, **kwargs)
+                begin = self._begin(start)
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self._end(phase, begin)
+        else:
+            def wrapper(*args, **kwargs):
+                if not self._profiled():
+                    return func(*args, **kwargs)
+                begin = self._begin(start)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self._end(phase, begin)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    def _profiled(self):
+        # Only the game loop and the stages it waits for are profiled,
+        # not background threads
+        thread = threading.current_thread()
+        return thread is threading.main_thread() or \
+            thread.name == STAGE_THREAD
+
+    def _begin(self, start):
+        if start == 'game':
+            self.start_game()
+        elif start is not None:
+            if not self.games:
+                self.start_game()
+            self.games[-1].append({'player': start})
+        self._stack.append(0.0)
+        return perf_counter()
+
+    def _end(self, phase, begin):
+        elapsed = perf_counter() - begin
+        children = self._stack.pop()
+        if self._stack:
+            self._stack[-1] += elapsed
+        if self.games:
+            move = self.games[-1][-1]
+            move[phase] = move.get(phase, 0.0) + elapsed - children
+
+    def report(self, game_index):
+        ''' Return the breakdown of a game as text (seconds).'''
+        moves = self.games[game_index]
+        header = '{:>4s}  {:8s}'.format('move', 'player') + \
+                 ''.join('{:>9s}'.format(phase) for phase in PHASES) + \
+                 '{:>9s}'.format('latency')
+        lines = ['Game {}'.format(game_index + 1), header]
+        totals = dict.fromkeys(PHASES, 0.0)
+        for nr, move in enumerate(moves):
+            # Latency: everything but waiting for the human
+            latency = sum(move.get(phase, 0.0) for phase in PHASES
+                          if phase != 'human')
+            lines.append('{:4d}  {:8s}'.format(nr, move['player']) +
+                         ''.join('{:9.3f}'.format(move.get(phase, 0.0))
+                                 for phase in PHASES) +
+                         '{:9.3f}'.format(latency))
+            for phase in PHASES:
+                totals[phase] += move.get(phase, 0.0)
+        latency = sum(totals[phase] for phase in PHASES if phase != 'human')
+        lines.append('{:>4s}  {:8s}'.format('', 'total') +
+                     ''.join('{:9.3f}'.format(totals[phase])
+                             for phase in PHASES) +
+                     '{:9.3f}'.format(latency))
+        return '\n'.join(lines)
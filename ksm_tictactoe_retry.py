@@ -0,0 +1,183 @@
+''' Retrying LEGO device operations on Remote I/O errors.
+
+The PiStorms I2C bus now and then fails with an OSError. Operations are
+retried with exponential backoff and jitter, following the policy of the
+operation. Nested operations share one retry budget, so a flaky bus can
+not multiply the retries of every level. Failures are counted per port:
+a port that keeps failing is marked bad, and operations on it fail at
+once instead of hanging the machine. Errors are written to logfile.txt
+in batches.
+'''
+import atexit
+import random
+import threading
+from datetime import datetime
+from time import sleep
+
+
+class ExceededRetries(Exception):
+    ''' Custom exception for exceeding retries at Remote I/O error.'''
+    pass
+
+
+class PortFailed(ExceededRetries):
+    ''' A port failed too often and is not used anymore.'''
+    pass
+
+
+class RetryPolicy:
+    ''' Number of attempts and the backoff between them (seconds).
+
+    The delay doubles (multiplier) from base_delay up to max_delay; jitter
+    takes a random part of up to jitter * delay off, so retries of
+    different threads do not hit the bus at the same moment.
+    '''
+    def __init__(self, attempts=3, base_delay=0.01, max_delay=0.5,
+                 multiplier=2.0, jitter=0.5):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def delay(self, retry, rng=random):
+        ''' Return delay before retry number retry (0, 1, ...).'''
+        delay = min(self.max_delay,
+                    self.base_delay * self.multiplier ** retry)
+        return delay * (1 - self.jitter * rng.random())
+
+
+# Policies per operation. Single motor commands and waits are retried;
+# drawing a stroke (or a whole cross) again would draw it twice, so those
+# are not.
+POLICIES = {'command': RetryPolicy(attempts=5),
+            'wait': RetryPolicy(attempts=5),
+            'move': RetryPolicy(attempts=3, base_delay=0.05),
+            'draw': RetryPolicy(attempts=1)}
+DEFAULT_POLICY = RetryPolicy()
+
+# Retries shared by an operation and all operations nested in it
+RETRY_BUDGET = 10
+
+
+class PortHealth:
+    ''' Failure counters per port. A port with limit failures in a row
+        is bad until reset().'''
+    def __init__(self, limit=10):
+        self.limit = limit
+        self.failures = {}
+        self.consecutive = {}
+        self.bad = set()
+        self._lock = threading.Lock()
+
+    def check(self, ports):
+        ''' Raise PortFailed when one of the ports is bad.'''
+        for port in ports:
+            if port in self.bad:
+                raise PortFailed('Port {} failed {} times in a row'.format(
+                                 port, self.limit))
+
+    def failed(self, ports):
+        with self._lock:
+            for port in ports:
+                self.failures[port] = self.failures.get(port, 0) + 1
+                self.consecutive[port] = self.consecutive.get(port, 0) + 1
+                if self.consecutive[port] >= self.limit:
+                    self.bad.add(port)
+
+    def succeeded(self, ports):
+        with self._lock:
+            for port in ports:
+                self.consecutive[port] = 0
+
+    def reset(self):
+        ''' Give all ports a new chance (e.g. after fixing a cable).'''
+        with self._lock:
+            self.consecutive.clear()
+            self.bad.clear()
+
+
+class ErrorLog:
+    ''' Error lines kept in memory and appended to filename in batches.'''
+    def __init__(self, filename='logfile.txt', batch_size=20):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.lines = []
+        self._lock = threading.Lock()
+
+    def add(self, operation, ports, error):
+        line = '{} {} {} {}: {}\n'.format(
+            datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3], operation,
+            ','.join(ports) or '-', type(error).__name__, error)
+        with self._lock:
+            self.lines.append(line)
+            full = len(self.lines) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            lines, self.lines = self.lines, []
+        if lines:
+            with open(self.filename, 'a') as f:
+                f.writelines(lines)
+
+
+health = PortHealth()
+error_log = ErrorLog()
+atexit.register(error_log.flush)
+
+_local = threading.local()
+
+
+def retry(operation, ports=None):
+    ''' Decorator retrying func on OSError with the policy of operation.
+
+    ports(*args) returns the ports the call uses; by default the ports
+    attribute of the object of a method. ExceededRetries is raised when
+    the attempts of the policy or the shared budget are used up, and
+    PortFailed when a port is bad.
+    '''
+    policy = POLICIES.get(operation, DEFAULT_POLICY)
+
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            if ports is not None:
+                used = ports(*args)
+            else:
+                used = getattr(args[0], 'ports', ()) if args else ()
+            health.check(used)
+            budget = getattr(_local, 'budget', None)
+            outermost = budget is None
+            if outermost:
+                budget = _local.budget = [RETRY_BUDGET]
+            try:
+                attempt = 1
+                while True:
+                    try:
+                        result = func(*args, **kwargs)
+                    except OSError as error:
+                        health.failed(used)
+                        error_log.add(operation, used, error)
+                        if attempt >= policy.attempts:
+                            raise ExceededRetries(
+                                'ExceededRetries in function ' +
+                                func.__name__) from error
+                        if budget[0] <= 0:
+                            raise ExceededRetries(
+                                'Retry budget used up in function ' +
+                                func.__name__) from error
+                        health.check(used)
+                        budget[0] -= 1
+                        sleep(policy.delay(attempt - 1))
+                        attempt += 1
+                    else:
+                        health.succeeded(used)
+                        return result
+            finally:
+                if outermost:
+                    _local.budget = None
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
@@ -0,0 +1,440 @@
+''' Alpha-beta search engine for N x N tic tac toe boards with k in a row.
+
+The engine plugs in where minimax(board, board.AI_PLAYER) is used and
+returns the same {'index', 'score'} result. Scores are depth-aware: a win
+scores WIN_SCORE plus the number of fields still empty when the game ends,
+so faster wins are preferred and slower losses are preferred over faster
+ones. Because this bonus depends only on the position, scores can be
+stored in the transposition table unchanged.
+'''
+import math
+import random
+from time import perf_counter
+
+from ksm_tictactoe_telemetry import timed
+
+# Score of a win, the number of empty fields at the end is added to it
+WIN_SCORE = 1000
+INFINITY = 1000000
+
+# Cell values used by the engine
+EMPTY = 0
+AI = 1
+HU = 2
+
+# Heuristic weight of an open line per number of own stones on it
+LINE_WEIGHTS = (0, 1, 4, 16, 64, 256, 1024)
+
+# Nodes between two checks of the search deadline
+DEADLINE_INTERVAL = 256
+
+# Transposition table entry flags
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+
+def winning_lines(size, k):
+    ''' Return all lines of k fields in a row on a size x size board.'''
+    lines = []
+    directions = ((0, 1), (1, 0), (1, 1), (1, -1))
+    for row in range(size):
+        for col in range(size):
+            for dr, dc in directions:
+                end_row = row + dr * (k - 1)
+                end_col = col + dc * (k - 1)
+                if 0 <= end_row < size and 0 <= end_col < size:
+                    lines.append(tuple((row + dr * i) * size + col + dc * i
+                                       for i in range(k)))
+    return tuple(lines)
+
+
+class GridBoard:
+    ''' Tic tac toe board of size x size fields where k in a row wins.
+
+    Same interface as Board. Human moves are mapped to fields by dividing
+    the board image (width x height pixels) in equal cells.
+    '''
+    def __init__(self, size=4, k=None, width=220, height=200):
+        self.size = size
+        self.k = k if k is not None else size
+        self.lines = winning_lines(size, self.k)
+        # Field indexes
+        self.index = list(range(size * size))
+        # Size of the board on the image
+        self.width = width
+        self.height = height
+        # Define symbols for human player and computer
+        self.HU_PLAYER = 'O'
+        self.AI_PLAYER = 'X'
+
+    def reset(self):
+        ''' Reset board for new game: empty all indexes.'''
+        self.index = list(range(self.size * self.size))
+
+    def empty_indexes(self):
+        ''' Return all empty indexs.'''
+        return [i for i, value in enumerate(self.index)
+                if value != self.AI_PLAYER and value != self.HU_PLAYER]
+
+    def check_for_winner(self, player):
+        ''' Check if player is a winner.'''
+        for line in self.lines:
+            if all(self.index[i] == player for i in line):
+                return True
+        return False
+
+    def add_human_move_to_board(self, x, y):
+        ''' Determine index of human move. '''
+        if 0 <= x < self.width and 0 <= y < self.height:
+            column = int(x) * self.size // self.width
+            row = int(y) * self.size // self.height
+            self.index[row * self.size + column] = self.HU_PLAYER
+
+
+class SearchTimeout(Exception):
+    ''' Raised inside the search when the time budget has run out.'''
+    pass
+
+
+class TranspositionTable:
+    ''' Fixed-size transposition table.
+
+    Each Zobrist key maps to one slot. An entry is replaced by an entry for
+    another position when that one was searched at least as deep, or when
+    the stored entry is left over from an earlier search.
+    '''
+    def __init__(self, size=1 << 16):
+        if size & (size - 1):
+            raise ValueError('Size must be a power of two')
+        self.mask = size - 1
+        self.keys = [None] * size
+        self.entries = [None] * size
+        self.generation = 0
+
+    def new_search(self):
+        ''' Age all stored entries.'''
+        self.generation += 1
+
+    def clear(self):
+        ''' Remove all entries.'''
+        size = self.mask + 1
+        self.keys = [None] * size
+        self.entries = [None] * size
+
+    def get(self, key):
+        ''' Return (depth, score, flag, move) for key, or None.'''
+        slot = key & self.mask
+        if self.keys[slot] == key:
+            return self.entries[slot]
+        return None
+
+    def put(self, key, depth, score, flag, move):
+        ''' Store a search result.'''
+        slot = key & self.mask
+        stored_key = self.keys[slot]
+        if stored_key is not None and stored_key != key:
+            stored = self.entries[slot]
+            if stored[0] > depth and stored[4] == self.generation:
+                return
+        self.keys[slot] = key
+        self.entries[slot] = (depth, score, flag, move, self.generation)
+
+
+class SearchEngine:
+    ''' Alpha-beta search with move ordering and a transposition table.'''
+    def __init__(self, size=3, k=3, tt_size=1 << 16, seed=2018):
+        self.size = size
+        self.k = k
+        self.fields = size * size
+        self.lines = winning_lines(size, k)
+        # Winning lines through each field
+        self.field_lines = tuple(
+            tuple(line for line in self.lines if field in line)
+            for field in range(self.fields))
+        # Static move order: fields on most winning lines first
+        self.order = tuple(sorted(range(self.fields),
+                                  key=lambda f: -len(self.field_lines[f])))
+        # Zobrist keys per field and player, plus a key for the human
+        # player to move
+        rng = random.Random(seed)
+        self.zobrist = tuple((0, rng.getrandbits(64), rng.getrandbits(64))
+                             for _ in range(self.fields))
+        self.hu_to_move = rng.getrandbits(64)
+        self.tt = TranspositionTable(tt_size)
+        self.nodes = 0
+        self.deadline = None
+
+    def cells_from_board(self, board):
+        ''' Return the fields of a board as a list of cell values.'''
+        cells = []
+        for i in range(self.fields):
+            value = board.index[i]
+            if value == board.AI_PLAYER:
+                cells.append(AI)
+            elif value == board.HU_PLAYER:
+                cells.append(HU)
+            else:
+                cells.append(EMPTY)
+        return cells
+
+    def hash_cells(self, cells, side):
+        ''' Return Zobrist key of a position.'''
+        key = self.hu_to_move if side == HU else 0
+        for field, value in enumerate(cells):
+            key ^= self.zobrist[field][value]
+        return key
+
+    def winner(self, cells):
+        ''' Return the player with k in a row, or EMPTY.'''
+        for line in self.lines:
+            value = cells[line[0]]
+            if value != EMPTY and all(cells[i] == value for i in line):
+                return value
+        return EMPTY
+
+    def wins(self, cells, field, side):
+        ''' Check if the move of side on field completes a line.'''
+        for line in self.field_lines[field]:
+            for i in line:
+                if cells[i] != side:
+                    break
+            else:
+                return True
+        return False
+
+    def evaluate(self, cells, side):
+        ''' Heuristic score of a position seen from side to move.
+
+        Lines that are still open for only one player count for that
+        player, weighted by the number of stones on them. The result stays
+        below WIN_SCORE, so real wins always score higher.
+        '''
+        score = 0
+        for line in self.lines:
+            ai_count = 0
+            hu_count = 0
+            for i in line:
+                if cells[i] == AI:
+                    ai_count += 1
+                elif cells[i] == HU:
+                    hu_count += 1
+            if hu_count == 0:
+                score += LINE_WEIGHTS[min(ai_count, 6)]
+            elif ai_count == 0:
+                score -= LINE_WEIGHTS[min(hu_count, 6)]
+        score = max(1 - WIN_SCORE, min(WIN_SCORE - 1, score))
+        return score if side == AI else -score
+
+    def ordered_moves(self, cells, first=None):
+        ''' Return empty fields, the given move first.'''
+        moves = [f for f in self.order if cells[f] == EMPTY and f != first]
+        if first is not None:
+            moves.insert(0, first)
+        return moves
+
+    def search(self, board, player):
+        ''' Return best move {'index', 'score'} for player on board.
+
+        The score is seen from the computer, like minimax(). A finished
+        game returns only a score.
+        '''
+        cells = self.cells_from_board(board)
+        side = AI if player == board.AI_PLAYER else HU
+        self.nodes = 0
+        self.tt.new_search()
+
+        won = self.winner(cells)
+        empties = cells.count(EMPTY)
+        if won != EMPTY:
+            score = WIN_SCORE + empties
+            return {'score': score if won == AI else -score}
+        if empties == 0:
+            return {'score': 0}
+
+        key = self.hash_cells(cells, side)
+        move, score = self.root(cells, side, key, empties, empties)
+        return {'index': move, 'score': score if side == AI else -score}
+
+    def iterative_deepening(self, board, player, budget=0.5, max_depth=None):
+        ''' Anytime search: deepen one ply at a time until the time budget
+            (seconds) runs out, return the best move of the deepest
+            completed iteration.
+
+        Besides 'index' and 'score' the result holds 'depth' (plies
+        searched), 'nodes', 'time' (seconds) and 'nps' (nodes per second).
+        '''
+        start = perf_counter()
+        cells = self.cells_from_board(board)
+        side = AI if player == board.AI_PLAYER else HU
+        self.tt.new_search()
+
+        won = self.winner(cells)
+        empties = cells.count(EMPTY)
+        if won != EMPTY or empties == 0:
+            result = self.search(board, player)
+            result.update(depth=0, nodes=0, time=0.0, nps=0.0)
+            return result
+
+        key = self.hash_cells(cells, side)
+        if max_depth is None or max_depth > empties:
+            max_depth = empties
+        nodes = 0
+        move = None
+        score = 0
+        reached = 0
+        for depth in range(1, max_depth + 1):
+            # The first iteration always completes, so there is a move
+            self.deadline = start + budget if depth > 1 else None
+            self.nodes = 0
+            try:
+                move, score = self.root(list(cells), side, key, empties,
+                                        depth)
+            except SearchTimeout:
+                nodes += self.nodes
+                break
+            finally:
+                self.deadline = None
+            nodes += self.nodes
+            reached = depth
+            # Stop early when the game is decided
+            if abs(score) >= WIN_SCORE:
+                break
+
+        elapsed = perf_counter() - start
+        return {'index': move,
+                'score': score if side == AI else -score,
+                'depth': reached,
+                'nodes': nodes,
+                'time': elapsed,
+                'nps': nodes / elapsed if elapsed > 0 else 0.0}
+
+    def root(self, cells, side, key, empties, depth,
+             alpha=-INFINITY, beta=INFINITY):
+        ''' Search all moves at the root, return (best move, score).'''
+        alpha_orig = alpha
+        entry = self.tt.get(key)
+        best_move = None
+        best_score = -INFINITY
+        for move in self.ordered_moves(cells, entry and entry[3]):
+            score = self.score_move(cells, side, key, empties, depth, move,
+                                    alpha, beta)
+            if score > best_score:
+                best_score = score
+                best_move = move
+                if score > alpha:
+                    alpha = score
+                if alpha >= beta:
+                    break
+        self.tt.put(key, depth, best_score,
+                    self.bound(best_score, alpha_orig, beta), best_move)
+        return best_move, best_score
+
+    @staticmethod
+    def bound(score, alpha, beta):
+        ''' Return transposition table flag of a score in window.'''
+        if score <= alpha:
+            return UPPER
+        if score >= beta:
+            return LOWER
+        return EXACT
+
+    def score_move(self, cells, side, key, empties, depth, move,
+                   alpha=-INFINITY, beta=INFINITY):
+        ''' Return score of move for side (seen from side).'''
+        cells[move] = side
+        if self.wins(cells, move, side):
+            score = WIN_SCORE + empties - 1
+        elif empties == 1:
+            score = 0
+        else:
+            child_key = key ^ self.zobrist[move][side] ^ self.hu_to_move
+            score = -self.negamax(cells, AI + HU - side, child_key,
+                                  empties - 1, depth - 1, -beta, -alpha)
+        cells[move] = EMPTY
+        return score
+
+    def negamax(self, cells, side, key, empties, depth, alpha, beta):
+        ''' Alpha-beta search, returns score seen from side to move.'''
+        self.nodes += 1
+        if self.deadline is not None and \
+           self.nodes % DEADLINE_INTERVAL == 0 and \
+           perf_counter() > self.deadline:
+            raise SearchTimeout()
+        alpha_orig = alpha
+
+        # Use stored result of this position
+        tt_move = None
+        entry = self.tt.get(key)
+        if entry is not None:
+            tt_depth, tt_score, flag, tt_move = entry[:4]
+            if tt_depth >= depth:
+                if flag == EXACT:
+                    return tt_score
+                elif flag == LOWER:
+                    alpha = max(alpha, tt_score)
+                else:
+                    beta = min(beta, tt_score)
+                if alpha >= beta:
+                    return tt_score
+
+        # Depth cutoff: estimate the position
+        if depth <= 0:
+            return self.evaluate(cells, side)
+
+        best_move = None
+        best_score = -INFINITY
+        opponent = AI + HU - side
+        for move in self.ordered_moves(cells, tt_move):
+            cells[move] = side
+            if self.wins(cells, move, side):
+                score = WIN_SCORE + empties - 1
+            elif empties == 1:
+                score = 0
+            else:
+                child_key = key ^ self.zobrist[move][side] ^ self.hu_to_move
+                score = -self.negamax(cells, opponent, child_key,
+                                      empties - 1, depth - 1, -beta, -alpha)
+            cells[move] = EMPTY
+
+            if score > best_score:
+                best_score = score
+                best_move = move
+                if score > alpha:
+                    alpha = score
+                if alpha >= beta:
+                    break
+
+        self.tt.put(key, depth, best_score,
+                    self.bound(best_score, alpha_orig, beta), best_move)
+        return best_score
+
+
+# Search engines per board size, so their transposition tables stay warm
+# between moves
+_engines = {}
+
+
+def get_engine(size=3, k=3):
+    ''' Return the shared search engine for a board size.'''
+    if (size, k) not in _engines:
+        _engines[size, k] = SearchEngine(size, k)
+    return _engines[size, k]
+
+
+def board_shape(board):
+    ''' Return (size, k) of a board.'''
+    size = int(math.sqrt(len(board.index)))
+    return size, getattr(board, 'k', size)
+
+
+def alphabeta(board, player):
+    ''' Alpha-beta replacement for minimax(board, player).'''
+    return get_engine(*board_shape(board)).search(board, player)
+
+
+@timed('timed_search')
+def timed_search(board, player, budget=0.5, max_depth=None):
+    ''' Iterative-deepening search within budget seconds.'''
+    return get_engine(*board_shape(board)).iterative_deepening(
+        board, player, budget, max_depth)
@@ -0,0 +1,420 @@
+''' Simulated PiStorms devices for running the game without hardware.
+
+The simulated motors, touch sensors, display, touchscreen and camera
+share one SimulatedRig: the paper with the moves on it. The rig draws a
+computer cross when the pen goes down on a field, and plays a random
+human move when the play TouchSensor is bumped. The camera renders the
+paper, or replays the image files given by KSM_TICTACTOE_IMAGES.
+'''
+import glob
+import random
+import sys
+from collections import namedtuple
+from os import environ
+from time import perf_counter, sleep
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from ksm_tictactoe_camera import FileCamera, render_board
+from ksm_tictactoe_motion import ramp_accel, profile, profile_position
+from ksm_tictactoe_planner import FIELDS, MOVE_POSITIONS, \
+     PEN_MOVE_POSITIONS
+
+# Ports of the machine (see ksm_tictactoe_lego_devices)
+TURNTABLE_MOVE_PORT = 'pistorms:BAM1'
+PEN_MOVE_PORT = 'pistorms:BBM2'
+PEN_PORT = 'pistorms:BBM1'
+PLAY_SENSOR_PORT = 'pistorms:BAS2'
+PEN_SENSOR_PORT = 'pistorms:BBS2'
+# Position of the pen motor where the pen presses its TouchSensor
+PEN_END_STOP = -25
+
+# Centres of the start menu buttons on the touchscreen
+MENU_BUTTONS = {'AI_PLAYER': (80, 125),
+                'HU_PLAYER': (240, 125),
+                'STOP_PROGRAM': (150, 195)}
+# A pixel of the blue title bar of the start menu
+MENU_PIXEL = ((5, 30), (0, 0, 255))
+# Time the human holds the play TouchSensor down (seconds)
+PRESS_TIME = 0.1
+# Time the driver of a TouchSensor takes to load after the port mode is
+# set, and the camera takes to adapt its exposure (seconds)
+SENSOR_LOAD_TIME = 0.5
+CAMERA_WARM_UP = 1.0
+
+
+class SimulatedRig:
+    ''' The simulated machine: devices by port and the paper.'''
+    def __init__(self, games=1, seed=2018):
+        self.devices = {}
+        self.paper = [None] * 9
+        self.rng = random.Random(seed)
+        # Start menu choices: alternate the starting player
+        self.menu = ['AI_PLAYER' if game % 2 == 0 else 'HU_PLAYER'
+                     for game in range(games)] + ['STOP_PROGRAM']
+        self.display = None
+        # Time at which the sensor on a port is loaded, by port
+        self.sensors_loaded = {}
+        # End of the press of the play TouchSensor (None: released)
+        self.play_pressed = None
+
+    def register(self, address, device):
+        if address is not None:
+            self.devices[address] = device
+
+    def human_move(self):
+        ''' Draw a circle in a random empty field.'''
+        empty = [i for i, value in enumerate(self.paper) if value is None]
+        if empty:
+            self.paper[self.rng.choice(empty)] = 'O'
+
+    def pen_down(self):
+        ''' Draw a cross when the pen goes down on a field position.'''
+        move = self.devices.get(TURNTABLE_MOVE_PORT)
+        pen_move = self.devices.get(PEN_MOVE_PORT)
+        if move is None or pen_move is None:
+            return
+        for i, (turn, move_pos, pen_move_pos) in enumerate(FIELDS):
+            if abs(move.position - MOVE_POSITIONS[move_pos]) <= 10 and \
+                    abs(pen_move.position -
+                        PEN_MOVE_POSITIONS[pen_move_pos]) <= 10:
+                if self.paper[i] is None:
+                    self.paper[i] = 'X'
+                return
+
+    def press_play(self):
+        ''' Return whether the play TouchSensor is pressed: the human
+            draws a move and presses it once every time it is released.'''
+        now = perf_counter()
+        if self.play_pressed is None:
+            self.human_move()
+            self.play_pressed = now + PRESS_TIME
+            return True
+        if now < self.play_pressed:
+            return True
+        self.play_pressed = None
+        return False
+
+    def menu_shown(self):
+        ''' Return whether the start menu is on the display.'''
+        position, color = MENU_PIXEL
+        return self.display is not None and \
+            self.display.image.getpixel(position) == color
+
+    def next_menu_choice(self):
+        return self.menu.pop(0) if len(self.menu) > 1 else self.menu[0]
+
+    def new_game(self):
+        self.paper = [None] * 9
+
+
+rig = SimulatedRig(int(environ.get('KSM_TICTACTOE_GAMES', '1')))
+
+
+class SimulatedMotor:
+    ''' Stand-in for an ev3dev2 Motor that moves at speed_sp (deg/s).
+
+    The position follows from the time since the last command, with the
+    trapezoidal profile of the ramps, so the motor runs in the background
+    like a real one. Supports the commands and attributes used by
+    ksm_tictactoe_lego_devices.
+    '''
+    def __init__(self, address=None, speed_sp=400, position=0,
+                 stop_action='brake', max_speed=1050):
+        self.address = address
+        self.speed_sp = speed_sp
+        self.max_speed = max_speed
+        # Ramp times (ms from 0 to max_speed) as on ev3dev motors
+        self.ramp_up_sp = 0
+        self.ramp_down_sp = 0
+        self.stop_action = stop_action
+        self.position_sp = 0
+        self._start_position = position
+        self._target = position
+        self._start_time = perf_counter()
+        self._forever = 0
+        self._profile = (speed_sp, float('inf'), float('inf'))
+        # Position of a mechanical end stop (None: no end stop)
+        self.end_stop = None
+        if address == PEN_PORT:
+            self.end_stop = PEN_END_STOP
+        rig.register(address, self)
+
+    def _update(self, elapsed=None):
+        ''' Return (position, running) at this moment (or elapsed seconds
+            after the last command).'''
+        if elapsed is None:
+            elapsed = perf_counter() - self._start_time
+        speed, accel_up, accel_down = self._profile
+        if self._forever:
+            position = self._start_position + \
+                       self._forever * abs(speed) * elapsed
+            running = True
+        else:
+            delta = self._target - self._start_position
+            total = profile(delta, speed, accel_up, accel_down)[0]
+            position = self._start_position + profile_position(
+                elapsed, delta, speed, accel_up, accel_down)
+            running = elapsed < total
+        if self.end_stop is not None and \
+                (position - self.end_stop) * \
+                (self._start_position - self.end_stop) < 0:
+            # Blocked by the end stop: keeps trying to run
+            return self.end_stop, True
+        return position, running
+
+    def _command(self, target=None, forever=0, **kwargs):
+        # The current move runs with the settings of its own command
+        self._start_position = self._update()[0]
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+        self._profile = (self.speed_sp,
+                         ramp_accel(self.ramp_up_sp, self.max_speed),
+                         ramp_accel(self.ramp_down_sp, self.max_speed))
+        self._start_time = perf_counter()
+        self._forever = forever
+        self._target = self._start_position if target is None else target
+
+    @property
+    def position(self):
+        return int(round(self._update()[0]))
+
+    @property
+    def speed(self):
+        # Over the last 10 ms, as the tacho counts of a real motor
+        elapsed = perf_counter() - self._start_time
+        before = max(0.0, elapsed - 0.01)
+        if elapsed <= before:
+            return 0
+        return int(round((self._update(elapsed)[0] -
+                          self._update(before)[0]) / (elapsed - before)))
+
+    @property
+    def state(self):
+        position, running = self._update()
+        if running:
+            if self.end_stop is not None and position == self.end_stop:
+                return ['running', 'stalled']
+            return ['running']
+        return ['holding'] if self.stop_action == 'hold' else []
+
+    @property
+    def is_running(self):
+        return 'running' in self.state
+
+    def run_to_abs_pos(self, **kwargs):
+        self._command(**kwargs)
+        self._target = self.position_sp
+        if self.address == PEN_PORT and self._target > 0:
+            rig.pen_down()
+
+    def run_to_rel_pos(self, **kwargs):
+        self._command(**kwargs)
+        self._target = self._start_position + self.position_sp
+
+    def run_forever(self, **kwargs):
+        self._command(**kwargs)
+        self._forever = 1 if self.speed_sp >= 0 else -1
+
+    def stop(self):
+        self._command()
+
+    def reset(self):
+        self._command()
+        self._start_position = self._target = 0
+
+
+def draw_cross(turntable_move, pen_move, pen, wait):
+    ''' Same motor commands and waits as Tic_tac_toe_machine._draw_cross().
+    '''
+    def pen_to(position):
+        pen.run_to_abs_pos(speed_sp=400, position_sp=position)
+        wait(pen)
+
+    # Bring pen down to paper
+    pen_to(20)
+    # Draw first line of cross
+    turntable_move.run_to_rel_pos(position_sp=200)
+    wait(turntable_move)
+    # Move pen up
+    pen_to(-20)
+    # Goto startpoint of second line of the cross
+    turntable_move.run_to_rel_pos(position_sp=-100)
+    pen_move.run_to_rel_pos(position_sp=-75)
+    wait(turntable_move, pen_move)
+    # Bring pen down to paper
+    pen_to(20)
+    # Draw second line of the cross
+    pen_move.run_to_rel_pos(position_sp=175)
+    wait(pen_move)
+    # Move pen up
+    pen_to(-20)
+
+
+class DeviceNotFound(Exception):
+    ''' Like the ev3dev2 DeviceNotFound.'''
+    pass
+
+
+class SimulatedLegoPort:
+    ''' Stand-in for an ev3dev2 LegoPort: setting the mode loads the
+        sensor driver of the port in the background.'''
+    def __init__(self, address=None):
+        self.address = address
+        self._mode = None
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @mode.setter
+    def mode(self, mode):
+        self._mode = mode
+        rig.sensors_loaded[self.address] = perf_counter() + SENSOR_LOAD_TIME
+
+
+class SimulatedTouchSensor:
+    ''' Stand-in for an ev3dev2 TouchSensor.
+
+    The pen sensor is pressed when the pen motor is at its end stop. A
+    bump of the play sensor is the human player drawing a move.
+    '''
+    def __init__(self, address=None):
+        if address in (PLAY_SENSOR_PORT, PEN_SENSOR_PORT):
+            loaded = rig.sensors_loaded.get(address)
+            if loaded is None or perf_counter() < loaded:
+                raise DeviceNotFound('TouchSensor on {} not found'.format(
+                                     address))
+        self.address = address
+        rig.register(address, self)
+
+    @property
+    def is_pressed(self):
+        if self.address == PEN_SENSOR_PORT:
+            pen = rig.devices.get(PEN_PORT)
+            return pen is not None and pen.position <= PEN_END_STOP
+        if self.address == PLAY_SENSOR_PORT:
+            return rig.press_play()
+        return False
+
+    def wait_for_pressed(self, timeout_ms=None, sleep_ms=10):
+        start = perf_counter()
+        while not self.is_pressed:
+            if timeout_ms is not None and \
+                    perf_counter() - start >= timeout_ms / 1000:
+                return False
+            sleep(sleep_ms / 1000)
+        return True
+
+    def wait_for_bump(self, timeout_ms=None, sleep_ms=10):
+        if self.address == PLAY_SENSOR_PORT:
+            rig.human_move()
+        return True
+
+
+class SimulatedDisplay:
+    ''' Stand-in for the ev3dev2 Display of the PiStorms (320x240).
+
+    Texts are printed; with KSM_TICTACTOE_SCREEN set, every update is
+    saved to that image file. Otherwise it has a 16 bit framebuffer in
+    memory, like the PiStorms, that the display service writes into.
+    '''
+    def __init__(self, resolution=(320, 240)):
+        self.image = Image.new('RGB', resolution, 'white')
+        self.draw = ImageDraw.Draw(self.image)
+        self.font = ImageFont.load_default()
+        self.filename = environ.get('KSM_TICTACTOE_SCREEN')
+        self.updates = 0
+        rig.display = self
+        self.mmap = None
+        if not self.filename:
+            width, height = resolution
+            self.var_info = SimpleNamespace(bits_per_pixel=16)
+            self.fix_info = SimpleNamespace(line_length=width * 2)
+            self.mmap = bytearray(width * height * 2)
+
+    def clear(self):
+        self.draw.rectangle(((0, 0), self.image.size), fill='white')
+
+    def update(self):
+        self.updates += 1
+        if self.filename:
+            self.image.save(self.filename)
+
+    def text_pixels(self, text, clear_screen=True, x=0, y=0,
+                    text_color='black', font=None):
+        if clear_screen:
+            self.clear()
+        self.draw.text((x, y), text, fill=text_color, font=self.font)
+        print('[screen] ' + text.replace('\n', ' | '))
+        sys.stdout.flush()
+
+
+InputEvent = namedtuple('InputEvent', 'type code value')
+
+
+class SimulatedInputDevice:
+    ''' Stand-in for the evdev InputDevice of the touchscreen: touches
+        the start menu button of the next choice of the rig every time
+        the menu appears.'''
+    def __init__(self, path=None):
+        self.path = path
+
+    def read_loop(self, poll=0.05):
+        while True:
+            # The human touches the menu when it is on the display
+            while not rig.menu_shown():
+                sleep(poll)
+            choice = rig.next_menu_choice()
+            if choice != 'STOP_PROGRAM':
+                rig.new_game()
+            x, y = MENU_BUTTONS[choice]
+            yield InputEvent(3, 0, x)
+            yield InputEvent(3, 1, y)
+            yield InputEvent(0, 0, 0)
+            while rig.menu_shown():
+                sleep(poll)
+
+
+class SimulatedCamera:
+    ''' Stand-in for PiCamera that renders the paper of the rig. Its gain
+        rises for CAMERA_WARM_UP seconds after start_preview().'''
+    def __init__(self, resolution=(1024, 768)):
+        self.resolution = resolution
+        self._preview = None
+
+    @property
+    def analog_gain(self):
+        if self._preview is None:
+            return 0
+        warm = min(1.0, (perf_counter() - self._preview) / CAMERA_WARM_UP)
+        return round(1.5 * warm, 2)
+
+    def capture(self, output, format=None, **kwargs):
+        img = render_board(rig.paper, self.resolution)
+        if isinstance(output, np.ndarray):
+            np.copyto(output, img)
+        else:
+            cv2.imwrite(output, img)
+
+    def start_preview(self):
+        if self._preview is None:
+            self._preview = perf_counter()
+
+    def stop_preview(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def simulated_camera():
+    ''' Return the simulated camera: replay of the image files matching
+        KSM_TICTACTOE_IMAGES, or else a render of the paper.'''
+    pattern = environ.get('KSM_TICTACTOE_IMAGES')
+    if pattern:
+        return FileCamera(sorted(glob.glob(pattern)))
+    return SimulatedCamera()
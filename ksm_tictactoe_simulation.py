@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+''' Headless batch simulation of tic tac toe games.
+
+Plays large batches of games without hardware. All games of a batch are
+stepped in lockstep on NumPy arrays of boards, one ply at a time. The
+computer plays the moves of the precomputed move table, which is checked
+against minimax() by ksm_tictactoe_movetable.py.
+
+To check the AI the game actually runs, --ai search (timed_search(), the
+fallback of the game) or --ai minimax plays the games one by one on the
+game's BitBoard, with its check_for_winner(), like the game loop does.
+
+Opponents:
+- 'random': random empty field
+- 'ai':     perfect play (the move table, or minimax() for the human)
+- 'replay': human move sequences read from a file, one game per line:
+            the starting player and the comma separated field indexes,
+            e.g. 'AI:4,0,8' or 'HU:4,2' (no player: the human starts)
+
+Example regression checks (fail when the computer loses a game):
+    python3 ksm_tictactoe_simulation.py --games 1000000 --check
+    python3 ksm_tictactoe_simulation.py --games 2000 --ai search --check
+'''
+import argparse
+import sys
+from time import perf_counter
+
+import numpy as np
+
+from ksm_tictactoe_core_ps import BitBoard, minimax
+from ksm_tictactoe_movetable import MoveTable, TABLE_FILE, AI, HU, \
+     EMPTY, LINES, winner
+from ksm_tictactoe_search import timed_search
+
+# Powers of 3 for the base-3 code of a board (same as movetable.encode)
+POWERS = 3 ** np.arange(9, dtype=np.int32)
+LINE_ARRAY = np.array(LINES, dtype=np.intp)
+
+# Game results
+RUNNING = 0
+AI_WON = 1
+HU_WON = 2
+DRAW = 3
+INVALID = 4
+
+
+def build_policy(move_table):
+    ''' Return array: board code -> computer's move (-1 if none).'''
+    policy = np.full(3 ** 9, -1, dtype=np.int8)
+    seen = set()
+    stack = [((EMPTY,) * 9, AI), ((EMPTY,) * 9, HU)]
+    while stack:
+        cells, player = stack.pop()
+        if (cells, player) in seen:
+            continue
+        seen.add((cells, player))
+        if winner(cells) != EMPTY or EMPTY not in cells:
+            continue
+        if player == AI:
+            code = int(np.dot(cells, POWERS))
+            policy[code] = move_table.lookup_cells(cells)['index']
+        opponent = HU if player == AI else AI
+        for spot in range(9):
+            if cells[spot] == EMPTY:
+                stack.append((cells[:spot] + (player,) + cells[spot + 1:],
+                              opponent))
+    return policy
+
+
+def build_swap():
+    ''' Return array: board code -> code with both players swapped.'''
+    codes = np.arange(3 ** 9, dtype=np.int32)
+    digits = codes[:, None] // POWERS % 3
+    swapped = np.where(digits == 0, 0, 3 - digits)
+    return (swapped * POWERS).sum(axis=1).astype(np.int32)
+
+
+def read_replays(filename):
+    ''' Read human move sequences, return (array of the sequences padded
+        with -1, boolean array: the computer starts).'''
+    sequences = []
+    ai_starts = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            starter, _, moves = line.rpartition(':')
+            if starter.strip().upper() not in ('', 'AI', 'HU'):
+                raise ValueError('Unknown starting player: ' + line)
+            ai_starts.append(starter.strip().upper() == 'AI')
+            sequences.append([int(v) for v in moves.split(',')])
+    replays = np.full((len(sequences), 5), -1, dtype=np.int8)
+    for i, sequence in enumerate(sequences):
+        replays[i, :len(sequence[:5])] = sequence[:5]
+    return replays, np.array(ai_starts, dtype=bool)
+
+
+class BatchSimulator:
+    ''' Play batches of games on NumPy arrays of boards.'''
+    def __init__(self, move_table=None, seed=None):
+        if move_table is None:
+            move_table = MoveTable(TABLE_FILE)
+        self.policy = build_policy(move_table)
+        self.swap = build_swap()
+        self.rng = np.random.RandomState(seed)
+
+    def random_moves(self, boards):
+        ''' Return a random empty field for each board.'''
+        noise = self.rng.random_sample(boards.shape)
+        noise[boards != EMPTY] = -1.0
+        return noise.argmax(axis=1)
+
+    def play_batch(self, games, opponent='random', ai_starts=None,
+                   replays=None):
+        ''' Play a batch of games, return array of results.
+
+        ai_starts is a boolean array (or bool) telling which games the
+        computer starts; by default half of the games. For opponent
+        'replay', replays holds one move sequence per game.
+        '''
+        boards = np.zeros((games, 9), dtype=np.int8)
+        codes = np.zeros(games, dtype=np.int32)
+        results = np.zeros(games, dtype=np.int8)
+        hu_moves = np.zeros(games, dtype=np.intp)
+        rows = np.arange(games)
+        if ai_starts is None:
+            ai_starts = rows % 2 == 0
+        ai_starts = np.broadcast_to(np.asarray(ai_starts, dtype=bool),
+                                    (games,))
+
+        for ply in range(9):
+            active = results == RUNNING
+            if not active.any():
+                break
+            ai_turn = ai_starts == (ply % 2 == 0)
+            player = np.where(ai_turn, AI, HU).astype(np.int8)
+
+            # Computer's moves from the move table
+            moves = self.policy[codes].astype(np.intp)
+
+            # Opponent's moves
+            hu_turn = active & ~ai_turn
+            if opponent == 'random':
+                hu = self.random_moves(boards)
+            elif opponent == 'ai':
+                hu = self.policy[self.swap[codes]].astype(np.intp)
+            elif opponent == 'replay':
+                step = np.minimum(hu_moves, replays.shape[1] - 1)
+                hu = replays[rows, step].astype(np.intp)
+                illegal = hu_turn & ((hu < 0) | (hu > 8))
+                hu = np.clip(hu, 0, 8)
+                illegal |= hu_turn & (boards[rows, hu] != EMPTY)
+                results[illegal] = INVALID
+                hu_turn &= ~illegal
+            else:
+                raise ValueError('Unknown opponent: ' + opponent)
+            hu_moves += hu_turn
+            moves = np.where(ai_turn, moves, hu)
+
+            # Apply moves of all active games
+            playing = active & (results == RUNNING)
+            idx = rows[playing]
+            move = moves[playing]
+            boards[idx, move] = player[playing]
+            codes[idx] += player[playing].astype(np.int32) * POWERS[move]
+
+            # Check for winners and ties
+            lines = boards[idx][:, LINE_ARRAY]
+            won = (lines == player[playing][:, None, None]).all(axis=2)
+            won = won.any(axis=1)
+            results[idx[won]] = np.where(ai_turn[idx[won]], AI_WON, HU_WON)
+            if ply == 8:
+                results[idx[~won]] = DRAW
+        return results
+
+    def run(self, games, opponent='random', batch_size=100000,
+            replays=None, ai_starts=None):
+        ''' Play games in batches, return statistics. ai_starts holds the
+            starting player of every replay.'''
+        totals = np.zeros(5, dtype=np.int64)
+        start = perf_counter()
+        played = 0
+        while played < games:
+            size = min(batch_size, games - played)
+            batch_replays = None
+            batch_starts = None
+            if replays is not None:
+                batch = np.arange(played, played + size) % len(replays)
+                batch_replays = replays[batch]
+                if ai_starts is not None:
+                    batch_starts = ai_starts[batch]
+            results = self.play_batch(size, opponent, batch_starts,
+                                      batch_replays)
+            totals += np.bincount(results, minlength=5)
+            played += size
+        return statistics(totals, played, perf_counter() - start)
+
+
+def statistics(totals, played, elapsed):
+    ''' Return the statistics of totals (games per result).'''
+    return {'games': played,
+            'ai_wins': int(totals[AI_WON]),
+            'draws': int(totals[DRAW]),
+            'ai_losses': int(totals[HU_WON]),
+            'invalid': int(totals[INVALID]),
+            'seconds': elapsed,
+            'games_per_second': played / elapsed if elapsed > 0 else 0.0}
+
+
+def play_game(board, computer_move, human_move, computer):
+    ''' Play one game on board like the game loop of ksm_tictactoe.py,
+        return the result. computer is True when the computer starts.'''
+    board.reset()
+    for move in range(9):
+        if computer:
+            board.index[computer_move(board)['index']] = board.AI_PLAYER
+        else:
+            index = human_move(board)
+            if index not in board.empty_indexes():
+                return INVALID
+            board.index[index] = board.HU_PLAYER
+        if board.check_for_winner(board.HU_PLAYER):
+            return HU_WON
+        elif board.check_for_winner(board.AI_PLAYER):
+            return AI_WON
+        computer = not computer
+    return DRAW
+
+
+class GameSimulator:
+    ''' Play games one by one with the search of the game: ai 'search'
+        (timed_search()) or 'minimax' (minimax()).'''
+    def __init__(self, ai='search', budget=0.5, seed=None):
+        if ai == 'search':
+            self.computer_move = lambda board: timed_search(
+                board, board.AI_PLAYER, budget)
+        elif ai == 'minimax':
+            self.computer_move = lambda board: minimax(board,
+                                                       board.AI_PLAYER)
+        else:
+            raise ValueError('Unknown AI: ' + ai)
+        self.rng = np.random.RandomState(seed)
+
+    def run(self, games, opponent='random', replays=None, ai_starts=None):
+        ''' Play games, return statistics like BatchSimulator.run().'''
+        board = BitBoard()
+        totals = np.zeros(5, dtype=np.int64)
+        start = perf_counter()
+        for game in range(games):
+            if opponent == 'random':
+                def human_move(board):
+                    return int(self.rng.choice(board.empty_indexes()))
+            elif opponent == 'ai':
+                def human_move(board):
+                    return minimax(board, board.HU_PLAYER)['index']
+            elif opponent == 'replay':
+                moves = iter(int(v) for v in replays[game % len(replays)])
+
+                def human_move(board):
+                    return next(moves, -1)
+            else:
+                raise ValueError('Unknown opponent: ' + opponent)
+            if ai_starts is not None:
+                computer = bool(ai_starts[game % len(ai_starts)])
+            else:
+                computer = game % 2 == 0
+            totals[play_game(board, self.computer_move, human_move,
+                             computer)] += 1
+        return statistics(totals, games, perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Play batches of simulated games.')
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--opponent', default='random',
+                        choices=('random', 'ai', 'replay'))
+    parser.add_argument('--replay-file',
+                        help='human move sequences for opponent replay')
+    parser.add_argument('--ai', default='table',
+                        choices=('table', 'search', 'minimax'),
+                        help='moves of the computer: move table (batches) '
+                             'or the search of the game (one by one)')
+    parser.add_argument('--batch-size', type=int, default=100000)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--check', action='store_true',
+                        help='exit with error when the computer loses')
+    args = parser.parse_args()
+
+    replays = None
+    ai_starts = None
+    if args.opponent == 'replay':
+        if not args.replay_file:
+            parser.error('opponent replay needs --replay-file')
+        replays, ai_starts = read_replays(args.replay_file)
+
+    if args.ai == 'table':
+        simulator = BatchSimulator(seed=args.seed)
+        stats = simulator.run(args.games, args.opponent, args.batch_size,
+                              replays, ai_starts)
+    else:
+        simulator = GameSimulator(args.ai, seed=args.seed)
+        stats = simulator.run(args.games, args.opponent, replays,
+                              ai_starts)
+    print('Games:     {games}\n'
+          'AI wins:   {ai_wins}\n'
+          'Draws:     {draws}\n'
+          'AI losses: {ai_losses}\n'
+          'Invalid:   {invalid}\n'
+          'Time:      {seconds:.2f} s ({games_per_second:.0f} games/s)'
+          .format(**stats))
+    if args.check and stats['ai_losses']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
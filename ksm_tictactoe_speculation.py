@@ -0,0 +1,92 @@
+''' Speculative computer moves while the human player is thinking.
+
+While the game waits for the human, a background thread computes the
+computer's reply to every possible human move and caches it. Once the
+human move has been detected, the reply is taken from the cache, so no
+search is left between the TouchSensor press and the pen on the paper.
+'''
+import threading
+from time import perf_counter
+
+
+def copy_board(board):
+    ''' Return a new board of the same class with the same fields.'''
+    clone = type(board)()
+    for i, value in enumerate(board.index):
+        clone.index[i] = value
+    return clone
+
+
+class SpeculativeMover:
+    ''' Compute the replies to all possible human moves in the background.
+
+    compute(board) returns the computer's move on board, like
+    computer_move() in ksm_tictactoe.py. on_ready(replies) is called from
+    the background thread with the list of reply fields once all replies
+    are known, e.g. to pre-position the pen.
+    '''
+    def __init__(self, compute, on_ready=None):
+        self.compute = compute
+        self.on_ready = on_ready
+        self.cache = {}
+        self.stats = {'speculations': 0, 'hits': 0, 'misses': 0,
+                      'seconds': 0.0}
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, board):
+        ''' Start computing replies to the human moves on board.'''
+        self.stop()
+        self.cache = {}
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        args=(copy_board(board),),
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, wait=True):
+        ''' Stop the background thread. With wait, also wait until it
+            has finished its current search.'''
+        self._stop.set()
+        # No pre-positioning after stop() has returned
+        with self._lock:
+            pass
+        if wait and self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, board):
+        start = perf_counter()
+        replies = []
+        for field_index in board.empty_indexes():
+            if self._stop.is_set():
+                return
+            candidate = copy_board(board)
+            candidate.index[field_index] = board.HU_PLAYER
+            if candidate.check_for_winner(board.HU_PLAYER) or \
+                    not candidate.empty_indexes():
+                continue
+            result = self.compute(candidate)
+            self.cache[tuple(candidate.index)] = result
+            replies.append(result['index'])
+            self.stats['speculations'] += 1
+        self.stats['seconds'] += perf_counter() - start
+        if self.on_ready is not None:
+            with self._lock:
+                if not self._stop.is_set():
+                    self.on_ready(replies)
+
+    def reply(self, board):
+        ''' Return the computer's move on board: the cached reply when
+            there is one, otherwise compute it now.'''
+        result = self.cache.get(tuple(board.index))
+        if result is not None:
+            # Let a running search finish in the background
+            self.stop(wait=False)
+            self.stats['hits'] += 1
+            return result
+        # compute() may not run in two threads at once
+        self.stop()
+        self.stats['misses'] += 1
+        return self.compute(board)
@@ -0,0 +1,148 @@
+''' Startup of the machine: hardware initialisation steps in parallel.
+
+Nothing is initialised when the game modules are imported. The steps
+(splash screen, camera warm-up, port configuration, pen homing, ...) run
+on threads as soon as the steps they depend on are done, and every step
+polls its device until it is ready instead of sleeping a fixed time.
+report() lists when each step ran.
+'''
+import threading
+from time import perf_counter, sleep
+
+from ksm_tictactoe_backend import PiCamera
+
+
+class StartupError(Exception):
+    ''' An initialisation step failed.'''
+    pass
+
+
+class StartupTimeout(StartupError):
+    ''' A device was not ready in time.'''
+    pass
+
+
+def wait_until(ready, timeout=10.0, poll=0.01, max_poll=0.2, what='device'):
+    ''' Poll ready() until it returns a true value and return that value.
+
+    Exceptions of ready() count as not ready (e.g. DeviceNotFound while a
+    driver loads). The poll interval grows from poll to max_poll.
+    StartupTimeout is raised after timeout seconds.
+    '''
+    start = perf_counter()
+    interval = poll
+    error = None
+    while True:
+        try:
+            result = ready()
+            if result:
+                return result
+        except Exception as e:
+            error = e
+        if perf_counter() - start >= timeout:
+            message = '{} not ready after {} s'.format(what, timeout)
+            if error is not None:
+                message += ': {}'.format(error)
+            raise StartupTimeout(message)
+        sleep(interval)
+        interval = min(interval * 1.5, max_poll)
+
+
+def start_camera(resolution=(1024, 768), timeout=5.0, settle=3):
+    ''' Open the camera and wait until its exposure has settled.
+
+    The gains of the PiCamera start at 0 and rise while the automatic
+    exposure adapts; the camera is ready when the analog gain is above
+    0 and has not changed for settle polls. A camera without gains (a
+    replay) is ready at once. A camera that has not settled after timeout
+    seconds (flickering light) is used anyway, with a warning.
+    '''
+    camera = PiCamera()
+    camera.resolution = resolution
+    camera.start_preview()
+    if not hasattr(camera, 'analog_gain'):
+        return camera
+    gains = []
+
+    def settled():
+        gains.append(camera.analog_gain)
+        recent = gains[-settle:]
+        return len(recent) == settle and recent[0] > 0 and \
+            all(gain == recent[0] for gain in recent)
+    try:
+        wait_until(settled, timeout, poll=0.05, max_poll=0.1,
+                   what='Camera')
+    except StartupTimeout as e:
+        print('Warning: {}, exposure still adapting'.format(e))
+    return camera
+
+
+class Startup:
+    ''' Initialisation steps, run in parallel where they can.
+
+    add() a step with the names of the steps it needs (after); run()
+    starts every step on its own thread once those are done and returns
+    the results by step name.
+    '''
+    def __init__(self):
+        self.steps = []
+        # Step name -> (start, end) in seconds from the start
+        self.times = {}
+        self.total = None
+
+    def add(self, name, func, after=()):
+        ''' Add step name: func(*results of the after steps).'''
+        names = [step[0] for step in self.steps]
+        for other in after:
+            if other not in names:
+                raise ValueError('Step {} needs unknown step {}'.format(
+                                 name, other))
+        self.steps.append((name, func, tuple(after)))
+
+    def run(self):
+        ''' Run all steps, return a dict of their results. StartupError
+            is raised when a step fails (after all steps have ended).'''
+        results = {}
+        errors = {}
+        done = {name: threading.Event() for name, func, after in self.steps}
+        start = perf_counter()
+
+        def run_step(name, func, after):
+            for other in after:
+                done[other].wait()
+            try:
+                if any(other in errors for other in after):
+                    raise StartupError('needs a failed step')
+                begin = perf_counter() - start
+                results[name] = func(*[results[other] for other in after])
+                self.times[name] = (begin, perf_counter() - start)
+            except Exception as e:
+                errors[name] = e
+            finally:
+                done[name].set()
+
+        threads = [threading.Thread(target=run_step, args=step, daemon=True)
+                   for step in self.steps]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.total = perf_counter() - start
+        if errors:
+            raise StartupError('; '.join(
+                '{}: {}'.format(name, error) for name, error in
+                sorted(errors.items())))
+        return results
+
+    def report(self):
+        ''' Return the timing of the steps as text (seconds).'''
+        lines = ['Startup {:.2f} s'.format(self.total),
+                 '{:12s}{:>8s}{:>8s}{:>8s}'.format('step', 'start', 'end',
+                                                   'time')]
+        for name, (begin, end) in sorted(self.times.items(),
+                                         key=lambda item: item[1]):
+            lines.append('{:12s}{:8.2f}{:8.2f}{:8.2f}'.format(
+                         name, begin, end, end - begin))
+        serial = sum(end - begin for begin, end in self.times.values())
+        lines.append('{:12s}{:>24.2f}'.format('serial', serial))
+        return '\n'.join(lines)
@@ -0,0 +1,234 @@
+''' Timing spans of the game, for production metrics.
+
+Spans are kept in an in-memory ring buffer and written to a file in
+batches by a writer thread, so the game threads never wait for the file,
+as JSON lines (one span per line) or as a Prometheus text file
+with the summary per span name (for the node exporter textfile
+collector).
+
+Enable with the environment variable KSM_TICTACTOE_TELEMETRY set to the
+output file, before the game modules are imported:
+    KSM_TICTACTOE_TELEMETRY=telemetry.jsonl python3 ksm_tictactoe.py
+    KSM_TICTACTOE_TELEMETRY=ksm_tictactoe.prom python3 ksm_tictactoe.py
+
+When disabled, timed() returns the function itself and span() a shared
+context that does nothing, so the instrumentation costs (almost) nothing.
+'''
+import atexit
+import json
+import os
+import queue
+import threading
+from time import perf_counter, time
+
+
+class SpanRecorder:
+    ''' Ring buffer of spans (name, start time, duration). Every
+        batch_size spans are handed to the writer thread, which writes
+        them to filename. When queue_size batches are waiting, the oldest
+        batch is dropped.'''
+    def __init__(self, filename, capacity=4096, batch_size=256,
+                 format=None, queue_size=16):
+        if format is None:
+            format = 'prometheus' if filename.endswith('.prom') else 'jsonl'
+        if format not in ('jsonl', 'prometheus'):
+            raise ValueError('Unknown telemetry format: ' + format)
+        self.filename = filename
+        self.format = format
+        self.capacity = capacity
+        self.batch_size = min(batch_size, capacity)
+        self.buffer = [None] * capacity
+        # Number of spans recorded and flushed so far
+        self.recorded = 0
+        self.flushed = 0
+        self.dropped = 0
+        # Totals per span name: [count, sum, max] (writer thread)
+        self.summary = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def record(self, name, duration, start=None):
+        ''' Add a span; start is a time.time() (default: now - duration).'''
+        if start is None:
+            start = time() - duration
+        spans = None
+        with self._lock:
+            self.buffer[self.recorded % self.capacity] = (name, start,
+                                                          duration)
+            self.recorded += 1
+            if self.recorded - self.flushed >= self.batch_size:
+                spans = self._take()
+        if spans:
+            self._put(spans)
+
+    def flush(self):
+        ''' Write the spans recorded so far and wait until they are
+            written.'''
+        with self._lock:
+            spans = self._take()
+        self._put(spans)
+        self._queue.join()
+
+    def close(self):
+        ''' Write the spans recorded so far and stop the writer thread.'''
+        if self._thread is not None:
+            self.flush()
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _take(self):
+        ''' Return the spans recorded since the last batch (with _lock).'''
+        pending = self.recorded - self.flushed
+        if pending > self.capacity:
+            # Overwritten before they could be handed over
+            self.dropped += pending - self.capacity
+            pending = self.capacity
+        spans = [self.buffer[i % self.capacity]
+                 for i in range(self.recorded - pending, self.recorded)]
+        self.flushed = self.recorded
+        return spans
+
+    def _put(self, spans):
+        ''' Queue a batch for the writer thread without waiting.'''
+        while True:
+            try:
+                self._queue.put_nowait(spans)
+                return
+            except queue.Full:
+                try:
+                    self.dropped += len(self._queue.get_nowait())
+                    self._queue.task_done()
+                except queue.Empty:
+                    pass
+
+    def _run(self):
+        while True:
+            spans = self._queue.get()
+            if spans is None:
+                self._queue.task_done()
+                break
+            try:
+                self._write(spans)
+            except OSError as error:
+                print('Warning: telemetry not written: {}'.format(error))
+            finally:
+                self._queue.task_done()
+
+    def _write(self, spans):
+        for name, start, duration in spans:
+            totals = self.summary.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += duration
+            totals[2] = max(totals[2], duration)
+        if self.format == 'jsonl':
+            if spans:
+                with open(self.filename, 'a') as f:
+                    f.write(''.join(
+                        json.dumps({'name': name, 'ts': round(start, 6),
+                                    'dur': round(duration, 6)},
+                                   separators=(',', ':')) + '\n'
+                        for name, start, duration in spans))
+        else:
+            self._write_prometheus()
+
+    def _write_prometheus(self):
+        lines = ['# HELP ksm_tictactoe_span_seconds Duration of game spans.',
+                 '# TYPE ksm_tictactoe_span_seconds summary']
+        for name, (count, total, longest) in sorted(self.summary.items()):
+            label = '{{span="{}"}}'.format(name)
+            lines.append('ksm_tictactoe_span_seconds_count{} {}'.format(
+                         label, count))
+            lines.append('ksm_tictactoe_span_seconds_sum{} {:.6f}'.format(
+                         label, total))
+        lines.append('# HELP ksm_tictactoe_span_max_seconds Longest span.')
+        lines.append('# TYPE ksm_tictactoe_span_max_seconds gauge')
+        for name, (count, total, longest) in sorted(self.summary.items()):
+            lines.append('ksm_tictactoe_span_max_seconds{{span="{}"}} '
+                         '{:.6f}'.format(name, longest))
+        # Replace the file at once, so a collector never reads half of it
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, self.filename)
+
+
+class _Span:
+    __slots__ = ('recorder', 'name', 'begin')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.begin = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.record(self.name, perf_counter() - self.begin)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+# The recorder of the game, None when telemetry is disabled
+recorder = None
+
+
+def configure(filename, **kwargs):
+    ''' Enable telemetry to filename (see SpanRecorder).'''
+    global recorder
+    recorder = SpanRecorder(filename, **kwargs)
+    atexit.register(recorder.flush)
+    return recorder
+
+
+def enabled():
+    return recorder is not None
+
+
+def span(name):
+    ''' Context manager timing a block as span name.'''
+    if recorder is None:
+        return _NULL_SPAN
+    return _Span(recorder, name)
+
+
+def record(name, duration, start=None):
+    ''' Add a span measured elsewhere.'''
+    if recorder is not None:
+        recorder.record(name, duration, start)
+
+
+def timed(name):
+    ''' Decorator timing every call as span name.'''
+    def decorator(func):
+        if recorder is None:
+            return func
+
+        def wrapper(*args, **kwargs):
+            begin = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                recorder.record(name, perf_counter() - begin)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+if os.environ.get('KSM_TICTACTOE_TELEMETRY'):
+    configure(os.environ['KSM_TICTACTOE_TELEMETRY'])
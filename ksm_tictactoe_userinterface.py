@@ -1,141 +1,133 @@
 ''' All things related to userinterface on the screen of the PiStorms.'''
 
+import threading
 from os import environ
-from time import sleep
 
 from PIL import Image
-from evdev import InputDevice
-from ev3dev2.display import Display
+
+from ksm_tictactoe_backend import InputDevice, Display
+from ksm_tictactoe_display import DisplayService
+from ksm_tictactoe_events import TouchScreen, GO, run_blocking
+from ksm_tictactoe_telemetry import timed
 
 # workaround for ev3dev-lang-python bug (issue #469)
 environ['FRAMEBUFFER'] = '/dev/fb1'
 
-display = Display()
+# PiStorms TouchScreen, opened when the start menu is first shown and
+# read for the whole program
+touchscreen = TouchScreen(lambda: InputDevice('/dev/input/event2'))
+
+# Display and display service, opened by init()
+display = None
+service = None
+_init_lock = threading.Lock()
+
+
+def _draw_image(filename):
+    def draw(display):
+        display.image.paste(Image.open(filename), (0, 0))
+    return draw
+
+
+# Start menu buttons: name, box, text, text position
+BUTTONS = (('AI_PLAYER', (15, 100, 150, 150), 'Computer', (40, 113)),
+           ('HU_PLAYER', (170, 100, 305, 150), 'Human', (215, 113)),
+           ('STOP_PROGRAM', (85, 170, 220, 220), 'Stop', (125, 185)))
+
+
+def _draw_menu(pressed=None):
+    def draw(display):
+        # Menu text
+        display.draw.rectangle((0, 10, 320, 50), fill='blue',
+                               outline='blue')
+        display.text_pixels('Choose which player starts',
+                            clear_screen=False, x=15, y=20,
+                            text_color='white', font='lutBS18')
+        for name, box, text, (x, y) in BUTTONS:
+            if name == pressed:
+                fill, color = 'black', 'white'
+            else:
+                fill, color = 'white', 'black'
+            display.draw.rectangle(box, fill=fill, outline='black')
+            display.text_pixels(text, clear_screen=False, x=x, y=y,
+                                text_color=color, font='lutBS18')
+    return draw
+
+
+def init():
+    ''' Open the display and start drawing in the background (once).'''
+    global display, service
+    with _init_lock:
+        if service is not None:
+            return
+        display = Display()
+        # Draw on the screen in the background; screens are drawn once
+        service = DisplayService(display)
+        service.register('start_screen',
+                         _draw_image('images/start_screen.png'))
+        service.register('end_screen', _draw_image('images/end_screen.png'))
+        service.register('menu', _draw_menu())
+        for name, box, text, position in BUTTONS:
+            service.register('menu_' + name, _draw_menu(name))
 
 
 def show_start_screen():
     ''' Show start screen.'''
 
     # Show start screen
-    display.clear()
-    logo = Image.open('images/start_screen.png')
-    display.image.paste(logo, (0, 0))
-    display.update()
-    sleep(2)
+    init()
+    service.show_screen('start_screen', 2)
 
 
 def show_end_screen():
     ''' Show end screen.'''
 
-    # Show end screen
-    display.clear()
-    logo = Image.open('images/end_screen.png')
-    display.image.paste(logo, (0, 0))
-    display.update()
-    sleep(2)
-
-
-def show_start_menu():
-    ''' Show start menu.'''
-
-    # Set input device to pistorms TouchScreen
-    device = InputDevice('/dev/input/event2')
-
-    # Initilize variables for x and y of screentouch
-    abs_x = 0
-    abs_y = 0
-    start = None
-
-    # Clear screen
-    display.clear()
-    display.update()
+    # Show end screen, and wait until it has been shown
+    init()
+    service.show_screen('end_screen', 2)
+    service.wait_idle()
 
-    # Menu text
-    display.draw.rectangle((0, 10, 320, 50), fill='blue', outline='blue')
-    display.text_pixels('Choose which player starts', clear_screen=False,
-                        x=15, y=20, text_color='white', font='lutBS18')
 
-    # Computer button
-    display.draw.rectangle((15, 100, 150, 150), fill='white', outline='black')
-    display.text_pixels('Computer', clear_screen=False, x=40, y=113,
-                        text_color='black', font='lutBS18')
+def menu_button(x, y):
+    ''' Return the start menu button at touch (x, y), or None.'''
+    if y > 100 and y < 150:
+        if x > 15 and x < 150:
+            return 'AI_PLAYER'
+        elif x > 180 and x < 315:
+            return 'HU_PLAYER'
+    elif y > 170 and y < 220:
+        if x > 85 and x < 220:
+            return 'STOP_PROGRAM'
+    return None
 
-    # Human button
-    display.draw.rectangle((170, 100, 305, 150), fill='white', outline='black')
-    display.text_pixels('Human', clear_screen=False, x=215, y=113,
-                        text_color='black', font='lutBS18')
 
-    # Stop button
-    display.draw.rectangle((85, 170, 220, 220), fill='white', outline='black')
-    display.text_pixels('Stop', clear_screen=False, x=125, y=185,
-                        text_color='black', font='lutBS18')
+async def show_start_menu():
+    ''' Show start menu, return the choice of the player.'''
 
-    # Update screen to show menu
-    display.update()
+    # Show menu after the messages of the previous game
+    init()
+    touchscreen.start()
+    await run_blocking(service.wait_idle)
+    # Touches before the menu was shown do not count
+    touchscreen.clear()
+    service.show_screen('menu')
 
     # Detect user input (touch on screen)
-    abs_x_valid = False
-    abs_y_valid = False
-    valid_input = False
-
-    for event in device.read_loop():
-        if event.type == 3 and event.code == 0:
-            # ABS_X event
-            abs_x = event.value
-            abs_x_valid = True
-        elif event.type == 3 and event.code == 1:
-            # ABS_Y event
-            abs_y = event.value
-            abs_y_valid = True
-        elif event.code == 28:
+    while True:
+        touch = await touchscreen.touch()
+        if touch == GO:
             # PiStorms' GO-button pressed, stop program
-            start = 'STOP_PROGRAM'
-            break
-
-        # Check which button is pressed and act accordingly
-        if abs_x_valid and abs_y_valid:
-            if abs_y > 100 and abs_y < 150:
-                if abs_x > 15 and abs_x < 150:
-                    display.draw.rectangle((15, 100, 150, 150),
-                                           fill='black',
-                                           outline='black')
-                    display.text_pixels('Computer', clear_screen=False,
-                                        x=40, y=113,
-                                        text_color='white', font='lutBS18')
-                    display.update()
-                    start = 'AI_PLAYER'
-                    valid_input = True
-                elif abs_x > 180 and abs_x < 315:
-                    display.draw.rectangle((170, 100, 305, 150),
-                                           fill='black',
-                                           outline='black')
-                    display.text_pixels('Human', clear_screen=False,
-                                        x=215, y=113,
-                                        text_color='white', font='lutBS18')
-                    display.update()
-                    start = 'HU_PLAYER'
-                    valid_input = True
-            elif abs_y > 170 and abs_y < 220:
-                if abs_x > 85 and abs_x < 220:
-                    display.draw.rectangle((85, 170, 220, 220),
-                                           fill='black',
-                                           outline='black')
-                    display.text_pixels('Stop', clear_screen=False,
-                                        x=125, y=185,
-                                        text_color='white', font='lutBS18')
-                    display.update()
-                    start = 'STOP_PROGRAM'
-                    valid_input = True
-            if valid_input:
-                break
-
-    return start
+            return 'STOP_PROGRAM'
+        start = menu_button(*touch)
+        if start is not None:
+            service.show_screen('menu_' + start)
+            return start
 
 
+@timed('show_message')
 def show_message(msg, sec):
-    ''' Display a message on PiStorms screen.'''
+    ''' Display a message on PiStorms screen for at least sec seconds
+        (without waiting for it).'''
 
-    display.text_pixels(msg, clear_screen=True, x=15, y=100,
-                        text_color='black', font='lutBS18')
-    display.update()
-    sleep(sec)
+    init()
+    service.show_text(msg, sec)
@@ -0,0 +1,774 @@
+#!/usr/bin/env python3
+''' Human move detection stages for ksm_tictactoe_ps.
+
+Compare the detector engines on a labelled image set with:
+    python3 ksm_tictactoe_vision.py --labels labels.json
+'''
+import argparse
+import json
+import os
+import queue
+import threading
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+from ksm_tictactoe_camera import ROI_X, ROI_Y, render_board
+from ksm_tictactoe_core_ps import Board, preprocess, hough_circles
+from ksm_tictactoe_telemetry import span, timed
+
+# Labels of the cell classifier
+EMPTY = '.'
+HUMAN = 'O'
+COMPUTER = 'X'
+
+
+def field_slices(boundaries, shape):
+    ''' Return (rows, columns) slices of the 9 fields on the board image.
+
+    boundaries are the field boundaries (x0, y0, x1, y1), the size of the
+    board image is taken from shape.
+    '''
+    x0, y0, x1, y1 = boundaries
+    height, width = shape[:2]
+    xs = (0, x0, x1, width)
+    ys = (0, y0, y1, height)
+    return [(slice(ys[i // 3], ys[i // 3 + 1]),
+             slice(xs[i % 3], xs[i % 3 + 1])) for i in range(9)]
+
+
+class HoughDetector:
+    ''' Detector engine with HoughCircles, the original detection.
+
+    Detector engines have a method detect(img, boundaries) that returns
+    the circles (x, y, r) found on the BGR board image with the field
+    boundaries (x0, y0, x1, y1); HoughDetector does not need them.
+    '''
+    def __init__(self, block_size=11, c=3.5, dp=1.2, min_dist=50,
+                 param1=200, param2=50, min_radius=10, max_radius=50):
+        self.block_size = block_size
+        self.c = c
+        self.hough = dict(dp=dp, min_dist=min_dist, param1=param1,
+                          param2=param2, min_radius=min_radius,
+                          max_radius=max_radius)
+
+    def detect(self, img, boundaries=None):
+        ''' Return circles (x, y, r) on the board image.'''
+        if self.block_size == 11 and self.c == 3.5:
+            gray = preprocess(img)
+        else:
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            gray = cv2.adaptiveThreshold(gray, 255,
+                                         cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                         cv2.THRESH_BINARY, self.block_size,
+                                         self.c)
+            gray = cv2.GaussianBlur(gray, (5, 5), 0)
+            gray = cv2.medianBlur(gray, 5)
+        return hough_circles(gray, **self.hough)
+
+
+class CellClassifierDetector:
+    ''' Detector engine that classifies the 9 fields as empty, O or X.
+
+    The board image is thresholded to an ink mask once. For all fields at
+    once, np.bincount over precomputed label maps sums the ink in three
+    zones of each field: the whole field (without a margin for the grid
+    lines), a disk at the centre and a ring around it. A field with
+    little ink is empty; an X has ink at its centre, where its lines
+    cross; an O has its ink on the ring and an empty centre. The label
+    maps are built again when the image size or the field boundaries
+    change.
+    '''
+    def __init__(self, margin=6, empty_density=0.04, centre_density=0.2,
+                 ring_density=0.15, block_size=11, c=12):
+        self.boundaries = None
+        self.margin = margin
+        self.empty_density = empty_density
+        self.centre_density = centre_density
+        self.ring_density = ring_density
+        self.block_size = block_size
+        self.c = c
+        self._shape = None
+
+    def _label_maps(self, shape, boundaries):
+        ''' Build label maps: field index per pixel of each zone, 9 for
+            pixels outside the zone.'''
+        height, width = shape
+        x0, y0, x1, y1 = boundaries
+        xs = (0, x0, x1, width)
+        ys = (0, y0, y1, height)
+        self.inner = np.full(shape, 9, dtype=np.intp)
+        self.centre = np.full(shape, 9, dtype=np.intp)
+        self.ring = np.full(shape, 9, dtype=np.intp)
+        self.centres = []
+        self.radii = []
+        yy, xx = np.mgrid[0:height, 0:width]
+        for i in range(9):
+            left, right = xs[i % 3], xs[i % 3 + 1]
+            top, bottom = ys[i // 3], ys[i // 3 + 1]
+            cx = (left + right) / 2.0
+            cy = (top + bottom) / 2.0
+            half = min(right - left, bottom - top) / 2.0 - self.margin
+            inside = (xx >= left + self.margin) & (xx < right - self.margin) \
+                & (yy >= top + self.margin) & (yy < bottom - self.margin)
+            dist = np.hypot(xx - cx, yy - cy)
+            self.inner[inside] = i
+            self.centre[inside & (dist < 0.25 * half)] = i
+            self.ring[inside & (dist >= 0.45 * half) & (dist < half)] = i
+            self.centres.append((int(cx), int(cy)))
+            self.radii.append(int(0.75 * half))
+        self._areas = [np.bincount(labels.ravel(), minlength=10)[:9]
+                       for labels in (self.inner, self.centre, self.ring)]
+        self._shape = shape
+        self.boundaries = boundaries
+
+    def features(self, img, boundaries):
+        ''' Return ink density of (field, centre, ring) per field.'''
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        boundaries = tuple(int(v) for v in boundaries)
+        if gray.shape != self._shape or boundaries != self.boundaries:
+            self._label_maps(gray.shape, boundaries)
+        ink = cv2.adaptiveThreshold(gray, 1, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                    cv2.THRESH_BINARY_INV, self.block_size,
+                                    self.c).ravel()
+        return [np.bincount(labels.ravel(), weights=ink, minlength=10)[:9] /
+                np.maximum(area, 1)
+                for labels, area in zip((self.inner, self.centre, self.ring),
+                                        self._areas)]
+
+    def classify(self, img, boundaries):
+        ''' Return label (EMPTY, HUMAN, COMPUTER) of the 9 fields.'''
+        density, centre, ring = self.features(img, boundaries)
+        labels = np.full(9, EMPTY)
+        labels[(density >= self.empty_density) &
+               (centre >= self.centre_density)] = COMPUTER
+        labels[(density >= self.empty_density) &
+               (centre < self.centre_density) &
+               (ring >= self.ring_density)] = HUMAN
+        return list(labels)
+
+    def detect(self, img, boundaries):
+        ''' Return a circle (x, y, r) at the centre of each O field.'''
+        labels = self.classify(img, boundaries)
+        return [(self.centres[i][0], self.centres[i][1], self.radii[i])
+                for i in range(9) if labels[i] == HUMAN]
+
+
+def _circle_fields(circles, boundaries):
+    ''' Return the set of fields with the centre of one of circles.'''
+    x0, y0, x1, y1 = boundaries
+    fields = set()
+    for x, y, r in circles:
+        column = 0 if x < x0 else 1 if x < x1 else 2
+        row = 0 if y < y0 else 1 if y < y1 else 2
+        fields.add(row * 3 + column)
+    return fields
+
+
+ENGINES = {'hough': HoughDetector, 'cells': CellClassifierDetector}
+# Detector engine of the game, written by ksm_tictactoe_archive.py --save
+ENGINE_FILE = 'detector.json'
+
+
+def load_engine(filename=ENGINE_FILE):
+    ''' Return the detector engine of filename, a JSON object with the
+        engine name ('hough', 'cells') and its parameters, e.g.
+        {"engine": "hough", "params": {"param2": 40}}; None when there is
+        no such file.'''
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return ENGINES[data.get('engine', 'hough')](**data.get('params', {}))
+
+
+def save_engine(params, engine='hough', filename=ENGINE_FILE):
+    ''' Write the detector engine for load_engine().'''
+    with open(filename, 'w') as f:
+        json.dump({'engine': engine, 'params': params}, f)
+
+
+class IncrementalDetector:
+    ''' Detect new human moves by examining only the empty fields.
+
+    The grayscale board image of the previous turn is kept. Each field
+    the board still reports as empty is compared with its previous
+    appearance, and only fields that changed get the (expensive) circle
+    check. Fields taken by the computer are never examined, so a circle
+    can not be detected on top of an X. A human makes one move per turn:
+    when several fields show a new circle, only the one that changed most
+    is accepted.
+
+    The previous appearance of a field is only updated while it does not
+    change. A changed field without an accepted circle keeps its old
+    appearance, so it is checked again next turn: a circle that was
+    missed is accepted when it is found later. It counts for max_moves of
+    that turn like a new circle; the fields that changed most win and the
+    others are checked again the turn after. The first image after reset()
+    is compared with an empty board: every field blank paper of its own
+    brightness inside a border of margin pixels (where the grid lines
+    are), so a circle missed on the first turn is checked again too.
+    Circles are checked on the board thresholded like HoughDetector does,
+    with the same HoughCircles accumulator threshold param2. With a
+    detector engine (HoughDetector, CellClassifierDetector, see
+    load_engine()) the engine examines the board instead, once per turn
+    and only when a field changed; its circles count for the fields their
+    centres are in.
+    '''
+    def __init__(self, pixel_threshold=40, changed_fraction=0.02,
+                 max_moves=1, param2=50, margin=10, engine=None):
+        # A pixel changed when its gray value differs more than this
+        self.pixel_threshold = pixel_threshold
+        # A field changed when this fraction of its pixels changed
+        self.changed_fraction = changed_fraction
+        self.max_moves = max_moves
+        self.param2 = param2
+        # Pixels around a field included in its circle check
+        self.margin = margin
+        self.engine = engine
+        self.previous = None
+        self.gray = None
+        self.stats = {'fields_checked': 0, 'fields_changed': 0,
+                      'circle_checks': 0, 'rejected': 0}
+
+    def reset(self):
+        ''' Forget the previous image, e.g. for a new game.'''
+        self.previous = None
+
+    def _empty_board(self, fields):
+        ''' Return the image of the board without moves, as reference for
+            the first turn.'''
+        empty = self.gray.copy()
+        for rows, columns in fields:
+            inner = (slice(rows.start + self.margin, rows.stop - self.margin),
+                     slice(columns.start + self.margin,
+                           columns.stop - self.margin))
+            if empty[inner].size:
+                empty[inner] = int(np.median(empty[inner]))
+        return empty
+
+    def changed(self, field):
+        ''' Return fraction of changed pixels in field slices.'''
+        diff = cv2.absdiff(self.gray[field], self.previous[field])
+        return np.count_nonzero(diff > self.pixel_threshold) / diff.size
+
+    def has_circle(self, binary):
+        ''' Check for a circle on the preprocessed image of one field.'''
+        max_radius = min(binary.shape) // 2 + 5
+        circles = cv2.HoughCircles(binary, cv2.HOUGH_GRADIENT, 1.2,
+                                   max(binary.shape),
+                                   param1=200, param2=self.param2,
+                                   minRadius=10, maxRadius=max_radius)
+        return circles is not None
+
+    def detect(self, img, board, boundaries=None):
+        ''' Add new human moves on the board image img to board, return
+            their field indexes.
+
+        The field boundaries (x0, y0, x1, y1) default to the board's.
+        '''
+        if self.gray is None or self.gray.shape != img.shape[:2]:
+            self.gray = np.empty(img.shape[:2], dtype=np.uint8)
+            self.previous = None
+        cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=self.gray)
+
+        if boundaries is None:
+            boundaries = (board.x0, board.y0, board.x1, board.y1)
+        fields = field_slices(boundaries, img.shape)
+        if self.previous is None:
+            self.previous = self._empty_board(fields)
+        candidates = []
+        unchanged = []
+        binary = None
+        circle_fields = None
+        for index in board.empty_indexes():
+            self.stats['fields_checked'] += 1
+            change = self.changed(fields[index])
+            if change < self.changed_fraction:
+                unchanged.append(index)
+                continue
+            self.stats['fields_changed'] += 1
+            self.stats['circle_checks'] += 1
+            if self.engine is not None:
+                if circle_fields is None:
+                    circle_fields = _circle_fields(
+                        self.engine.detect(img, boundaries), boundaries)
+                if index in circle_fields:
+                    candidates.append((change, index))
+                continue
+            if binary is None:
+                # Threshold the whole board once, as HoughDetector does
+                binary = preprocess(img)
+            rows, columns = fields[index]
+            # With a margin: circles at the border of an image get too few
+            # votes
+            field = binary[max(0, rows.start - self.margin):
+                           rows.stop + self.margin,
+                           max(0, columns.start - self.margin):
+                           columns.stop + self.margin]
+            if self.has_circle(field):
+                candidates.append((change, index))
+
+        # Keep the fields that changed most, circles missed in earlier
+        # turns included
+        candidates.sort(reverse=True)
+        if len(candidates) > self.max_moves:
+            self.stats['rejected'] += len(candidates) - self.max_moves
+            candidates = candidates[:self.max_moves]
+
+        moves = sorted(index for change, index in candidates)
+        for index in moves:
+            board.index[index] = board.HU_PLAYER
+
+        # Follow slow changes (light) of the fields that did not change;
+        # changed fields keep their old appearance until they are taken
+        for index in unchanged + moves:
+            self.previous[fields[index]] = self.gray[fields[index]]
+        return moves
+
+
+class DebugImageWriter:
+    ''' Write annotated debug images on a background thread.
+
+    submit() copies the board image and returns at once; drawing and
+    writing happen on the writer thread. The queue is bounded: when it is
+    full, the oldest image is dropped, so the game loop never waits.
+
+    Modes:
+    - 'off':    no debug images
+    - 'latest': only the latest image, as ttt_circles.jpg
+    - 'keep':   numbered images, the oldest removed beyond max_files
+                (also those of earlier runs)
+    '''
+    MODES = ('off', 'latest', 'keep')
+
+    def __init__(self, mode='latest', directory='.', max_files=100,
+                 queue_size=4):
+        if mode not in self.MODES:
+            raise ValueError('Unknown debug image mode: ' + mode)
+        self.mode = mode
+        self.directory = directory
+        self.max_files = max_files
+        self.written = []
+        self.dropped = 0
+        self.errors = 0
+        self._counter = 0
+        if mode == 'keep':
+            # Continue after the images already in the directory
+            os.makedirs(directory, exist_ok=True)
+            numbers = []
+            for name in os.listdir(directory):
+                if name.startswith('ttt_circles_') and name.endswith('.jpg'):
+                    try:
+                        numbers.append(int(name[12:-4]))
+                    except ValueError:
+                        pass
+            numbers.sort()
+            self.written = [self._filename(nr) for nr in numbers]
+            self._counter = numbers[-1] if numbers else 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        if mode != 'off':
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def submit(self, img, circles=()):
+        ''' Queue board image img with circles (x, y, r) for writing.'''
+        if self.mode == 'off':
+            return
+        item = (img.copy(), [tuple(int(v) for v in c) for c in circles])
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def flush(self):
+        ''' Wait until all queued images are written.'''
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        ''' Write the queued images and stop the writer thread.'''
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            try:
+                self._write(*item)
+            except Exception as error:
+                # A failed image must not stop the writer thread
+                self.errors += 1
+                print('Warning: debug image not written: {}'.format(
+                    str(error).strip()))
+            finally:
+                self._queue.task_done()
+
+    def _filename(self, nr):
+        return os.path.join(self.directory,
+                            'ttt_circles_{:05d}.jpg'.format(nr))
+
+    def _write(self, img, circles):
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        for nr, (x, y, r) in enumerate(circles, 1):
+            # Draw the outer circle, its centre and its number
+            cv2.circle(img, (x, y), r, (0, 255, 0), 2)
+            cv2.circle(img, (x, y), 2, (0, 0, 255), 3)
+            cv2.putText(img, str(nr), (x, y), font, 2, 255)
+
+        if self.mode == 'latest':
+            filename = os.path.join(self.directory, 'ttt_circles.jpg')
+            # Write to a temporary file first, so a reader never sees a
+            # half written image
+            tmp = os.path.join(self.directory, 'ttt_circles.tmp.jpg')
+            if not cv2.imwrite(tmp, img):
+                raise OSError('Cannot write ' + tmp)
+            os.replace(tmp, filename)
+        else:
+            self._counter += 1
+            filename = self._filename(self._counter)
+            if not cv2.imwrite(filename, img):
+                raise OSError('Cannot write ' + filename)
+            self.written.append(filename)
+            while len(self.written) > self.max_files:
+                try:
+                    os.remove(self.written.pop(0))
+                except OSError:
+                    pass
+
+
+def board_image(camera, grabber=None, grid=None):
+    ''' Capture the board, return (board image, field boundaries).
+
+    With a calibrated grid the board image is rectified, otherwise it is
+    the fixed crop with the boundaries of Board (None).
+    '''
+    with span('vision.capture'):
+        if grabber is not None:
+            frame = grabber.capture()
+        else:
+            camera.capture('ttt.jpg')
+            frame = cv2.imread('ttt.jpg')
+    with span('vision.board'):
+        if grid is not None and grid.ensure(frame):
+            return grid.warp(frame), grid.boundaries
+        return frame[ROI_Y[0]:ROI_Y[1], ROI_X[0]:ROI_X[1]], None
+
+
+@timed('human_moves_incremental')
+def human_moves_incremental(camera, board, detector, grabber=None,
+                            grid=None, debug_writer=None):
+    ''' Incremental version of human_moves_from_image(): detect the new
+        human moves only, return (number of new moves, board).
+
+    The new moves are marked on the debug image of debug_writer, if any.
+    '''
+    img, boundaries = board_image(camera, grabber, grid)
+    with span('vision.detect'):
+        moves = detector.detect(img, board, boundaries)
+    if debug_writer is not None:
+        if boundaries is None:
+            boundaries = (board.x0, board.y0, board.x1, board.y1)
+        fields = field_slices(boundaries, img.shape)
+        circles = []
+        for index in moves:
+            rows, columns = fields[index]
+            circles.append(((columns.start + columns.stop) // 2,
+                            (rows.start + rows.stop) // 2,
+                            min(rows.stop - rows.start,
+                                columns.stop - columns.start) // 3))
+        debug_writer.submit(img, circles)
+    return len(moves), board
+
+
+class StreamEnded(Exception):
+    ''' The video stream has ended, no more moves will be detected.'''
+    pass
+
+
+class StreamingMoveDetector:
+    ''' Detect human moves from the video stream, without the touch sensor.
+
+    A background thread captures low resolution frames from the video port
+    (splitter port 1, so still captures on port 0 keep working) into a
+    fixed pool of buffers. Frames go through a bounded queue; when the
+    consumer falls behind, the oldest frame is dropped, so memory stays
+    flat. wait_for_move() compares consecutive frames of the board region:
+    after motion (the hand drawing) and then stable_frames still frames in
+    a row (the hand has left), the full move detection detect() fires.
+    The motion seen so far is kept between calls, so a hand may come and
+    go across the timeouts of wait_for_move().
+
+    stats holds capture fps, dropped frames and the latency from the
+    moment the scene was stable until detection was done.
+    '''
+    def __init__(self, camera, detect, resolution=(256, 192), queue_size=4,
+                 pixel_threshold=25, motion_fraction=0.01,
+                 still_fraction=0.002, stable_frames=5):
+        self.camera = camera
+        self.detect = detect
+        self.resolution = resolution
+        self.pixel_threshold = pixel_threshold
+        self.motion_fraction = motion_fraction
+        self.still_fraction = still_fraction
+        self.stable_frames = stable_frames
+
+        # Board region on the low resolution frames
+        width, height = resolution
+        full_width, full_height = camera.resolution
+        self.roi = (slice(ROI_Y[0] * height // full_height,
+                          ROI_Y[1] * height // full_height),
+                    slice(ROI_X[0] * width // full_width,
+                          ROI_X[1] * width // full_width))
+
+        # Fixed pool of frame buffers
+        self._capture = np.empty((height, width, 3), dtype=np.uint8)
+        self._free = queue.Queue()
+        for _ in range(queue_size + 1):
+            self._free.put(np.empty((height, width, 3), dtype=np.uint8))
+        self._frames = queue.Queue(maxsize=queue_size)
+        self._gray = np.empty((height, width), dtype=np.uint8)
+        self._previous = np.empty((height, width), dtype=np.uint8)
+        self._has_previous = False
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._ended = False
+        self._moving = False
+        self._still = 0
+        self.stats = {'frames': 0, 'dropped': 0, 'capture_fps': 0.0,
+                      'detections': 0, 'latency': None}
+
+    def start(self):
+        ''' Start the capture thread.'''
+        self._stop.clear()
+        self._ended = False
+        self.reset()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def reset(self):
+        ''' Forget the motion seen so far (e.g. for a new game).'''
+        self._moving = False
+        self._still = 0
+
+    def stop(self):
+        ''' Stop the capture thread.'''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        start = perf_counter()
+        stream = None
+        try:
+            stream = self.camera.capture_continuous(
+                self._capture, 'bgr', use_video_port=True,
+                resize=self.resolution, splitter_port=1)
+            for _ in stream:
+                if self._stop.is_set():
+                    break
+                buffer = self._take_buffer()
+                np.copyto(buffer, self._capture)
+                self._queue_frame((perf_counter(), buffer))
+                self.stats['frames'] += 1
+                self.stats['capture_fps'] = \
+                    self.stats['frames'] / (perf_counter() - start)
+        except Exception as error:
+            print('Warning: video stream failed: {}'.format(
+                str(error).strip()))
+        finally:
+            if stream is not None:
+                try:
+                    stream.close()
+                except Exception:
+                    pass
+            # Tell a waiting consumer that no frames will come anymore
+            self._queue_frame((None, None))
+
+    def _queue_frame(self, item):
+        ''' Queue item (timestamp, buffer) without waiting: when the queue
+            is full, the oldest frame is dropped and its buffer freed.'''
+        while True:
+            try:
+                self._frames.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            try:
+                self._free.put(self._frames.get_nowait()[1])
+                self.stats['dropped'] += 1
+            except queue.Empty:
+                pass
+
+    def _take_buffer(self):
+        ''' Return a free buffer; when the consumer is behind, the buffer of
+            the oldest queued frame.'''
+        while True:
+            try:
+                return self._free.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                buffer = self._frames.get_nowait()[1]
+                self.stats['dropped'] += 1
+                return buffer
+            except queue.Empty:
+                pass
+
+    def _change(self, frame):
+        ''' Return fraction of changed pixels in the board region.'''
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        if not self._has_previous:
+            change = 0.0
+            self._has_previous = True
+        else:
+            diff = cv2.absdiff(self._gray[self.roi], self._previous[self.roi])
+            change = np.count_nonzero(diff > self.pixel_threshold) / diff.size
+        np.copyto(self._previous, self._gray)
+        return change
+
+    def wait_for_move(self, timeout=None):
+        ''' Wait for a human move, return the result of detect().
+
+        Returns None on timeout and raises StreamEnded when the stream has
+        ended (the camera stopped or failed). A detection without new
+        moves (e.g. the hand only passed by) is ignored.
+        '''
+        if self._ended:
+            raise StreamEnded('Video stream has ended')
+        deadline = None if timeout is None else perf_counter() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - perf_counter()
+                if remaining <= 0:
+                    return None
+            try:
+                timestamp, frame = self._frames.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if frame is None:
+                self._ended = True
+                raise StreamEnded('Video stream has ended')
+            change = self._change(frame)
+            self._free.put(frame)
+
+            if change > self.motion_fraction:
+                self._moving = True
+                self._still = 0
+            elif self._moving and change < self.still_fraction:
+                self._still += 1
+                if self._still >= self.stable_frames:
+                    self.reset()
+                    result = self.detect()
+                    self.stats['latency'] = perf_counter() - timestamp
+                    if result[0] > 0:
+                        self.stats['detections'] += 1
+                        return result
+
+
+def evaluate_engines(engines, dataset, board_factory, repeats=1):
+    ''' Run detector engines over a labelled image set.
+
+    dataset is a list of (BGR board image, labels) with labels a string of
+    9 characters ('O', 'X' or '.'). Returns per engine name the field
+    accuracy (O or not O), the fraction of images with all fields right
+    and the mean latency per frame in milliseconds.
+    '''
+    report = {}
+    board = board_factory()
+    boundaries = (board.x0, board.y0, board.x1, board.y1)
+    for name, engine in engines.items():
+        fields_right = 0
+        boards_right = 0
+        elapsed = 0.0
+        for img, labels in dataset:
+            for _ in range(repeats):
+                board = board_factory()
+                start = perf_counter()
+                for x, y, r in engine.detect(img, boundaries):
+                    board.add_human_move_to_board(x, y)
+                elapsed += perf_counter() - start
+            found = [board.index[i] == board.HU_PLAYER for i in range(9)]
+            expected = [label == HUMAN for label in labels]
+            right = sum(f == e for f, e in zip(found, expected))
+            fields_right += right
+            boards_right += right == 9
+        frames = len(dataset) * repeats
+        report[name] = {'field_accuracy': fields_right / (9.0 * len(dataset)),
+                        'board_accuracy': boards_right / float(len(dataset)),
+                        'latency_ms': 1000.0 * elapsed / frames}
+    return report
+
+
+def load_dataset(filename):
+    ''' Load a labelled image set.
+
+    The JSON file maps image filenames (relative to the file) to labels;
+    the images are camera frames, cropped here to the board region.
+    '''
+    directory = os.path.dirname(os.path.abspath(filename))
+    with open(filename) as f:
+        labels = json.load(f)
+    dataset = []
+    for image, label in sorted(labels.items()):
+        img = cv2.imread(os.path.join(directory, image))
+        dataset.append((img[ROI_Y[0]:ROI_Y[1], ROI_X[0]:ROI_X[1]], label))
+    return dataset
+
+
+def synthetic_dataset(count, seed=2018):
+    ''' Return a labelled set of noisy synthetic board images.'''
+    rng = np.random.RandomState(seed)
+    dataset = []
+    for _ in range(count):
+        labels = ''.join(rng.choice([HUMAN, COMPUTER, EMPTY], 9))
+        frame = render_board(labels)
+        noise = rng.normal(0, 6, frame.shape)
+        frame = np.clip(frame + noise, 0, 255).astype(np.uint8)
+        dataset.append((frame[ROI_Y[0]:ROI_Y[1], ROI_X[0]:ROI_X[1]], labels))
+    return dataset
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare detector engines on a labelled image set.')
+    parser.add_argument('--labels',
+                        help='JSON file: image filename -> 9 labels')
+    parser.add_argument('--synthetic', type=int, default=50,
+                        help='number of synthetic images without --labels')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.labels:
+        dataset = load_dataset(args.labels)
+    else:
+        dataset = synthetic_dataset(args.synthetic)
+    engines = {'hough': HoughDetector(), 'cells': CellClassifierDetector()}
+    report = evaluate_engines(engines, dataset, Board, args.repeats)
+    print('{} images'.format(len(dataset)))
+    for name, result in sorted(report.items()):
+        print('{:6s} fields {:6.1%}  boards {:6.1%}  {:7.2f} ms/frame'.format(
+              name, result['field_accuracy'], result['board_accuracy'],
+              result['latency_ms']))
+
+
+if __name__ == '__main__':
+    main()
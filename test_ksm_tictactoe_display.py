@@ -0,0 +1,59 @@
+''' Tests of the message queue of ksm_tictactoe_display.
+
+Run with:
+    python3 -m pytest test_ksm_tictactoe_display.py
+'''
+from time import sleep
+
+from ksm_tictactoe_display import DisplayService
+
+
+class TextDisplay:
+    ''' Display that only records the texts drawn on it.'''
+    def __init__(self):
+        self.image = None
+        self.shown = []
+
+    def text_pixels(self, msg, **kwargs):
+        self.shown.append(msg)
+
+    def update(self):
+        pass
+
+
+def test_messages_with_a_minimum_time_are_all_shown():
+    display = TextDisplay()
+    service = DisplayService(display)
+    service.show_text('first', 0.05)
+    service.show_text('Aantal: 1', 0.05)
+    service.show_text('board', 0.05)
+    service.show_text('Computer move:4', 0)
+    service.show_text('won', 0.05)
+    service.close()
+    assert display.shown == ['first', 'Aantal: 1', 'board',
+                             'Computer move:4', 'won']
+
+
+def test_frames_without_a_minimum_time_collapse():
+    display = TextDisplay()
+    service = DisplayService(display)
+    service.show_text('first', 0.1)
+    service.show_text('a', 0)
+    service.show_text('b', 0)
+    service.show_text('c', 0)
+    service.close()
+    assert display.shown == ['first', 'c']
+    assert service.stats['superseded'] == 2
+
+
+def test_full_queue_drops_the_oldest_frame():
+    display = TextDisplay()
+    service = DisplayService(display, queue_size=2)
+    service.show_text('first', 0.2)
+    # Let the renderer take the first frame from the queue
+    sleep(0.05)
+    for nr in range(4):
+        service.show_text(str(nr), 0.01)
+    service.close()
+    assert display.shown == ['first', '2', '3']
+    assert service.stats['dropped'] == 2
@@ -0,0 +1,101 @@
+''' Tests of wait_for_motors() on simulated motors.
+
+Run with:
+    python3 -m pytest test_ksm_tictactoe_motion.py
+'''
+from time import perf_counter
+
+import pytest
+
+from ksm_tictactoe_motion import wait_for_motors, MotorStalled, \
+     MotorTimeout
+from ksm_tictactoe_simulated_devices import SimulatedMotor
+
+SPEED = 400
+
+
+class LateMotor(SimulatedMotor):
+    ''' Simulated motor that reports standstill at its old position for
+        delay seconds after a command, like an ev3dev motor may.'''
+    delay = 0.02
+
+    def _update(self, elapsed=None):
+        if elapsed is None:
+            elapsed = perf_counter() - self._start_time
+        if elapsed < self.delay:
+            return self._start_position, False
+        return super()._update(elapsed - self.delay)
+
+
+def test_motor_that_starts_late_is_waited_for():
+    motor = LateMotor(speed_sp=SPEED)
+    motor.run_to_rel_pos(position_sp=SPEED // 4)
+    assert wait_for_motors(motor) == []
+    assert motor.position == SPEED // 4
+
+
+def test_motor_that_does_not_move_settles():
+    motor = SimulatedMotor(speed_sp=SPEED)
+    motor.run_to_abs_pos(position_sp=0)
+    start = perf_counter()
+    assert wait_for_motors(motor, start_time=0.05) == []
+    assert perf_counter() - start < 0.2
+
+
+def test_finished_move():
+    # A move of 0.5 s: waited for until it ends, not longer
+    motor = SimulatedMotor(speed_sp=SPEED)
+    motor.run_to_rel_pos(position_sp=SPEED // 2)
+    start = perf_counter()
+    assert wait_for_motors(motor) == []
+    assert 0.45 <= perf_counter() - start < 0.65
+    assert motor.position == SPEED // 2
+
+
+def test_concurrent_moves():
+    # Two moves at once: waited for as long as the longest one
+    first = SimulatedMotor(speed_sp=SPEED)
+    second = SimulatedMotor(speed_sp=SPEED)
+    first.run_to_rel_pos(position_sp=SPEED // 2)
+    second.run_to_rel_pos(position_sp=-SPEED // 4)
+    start = perf_counter()
+    assert wait_for_motors(first, second) == []
+    assert 0.45 <= perf_counter() - start < 0.65
+
+
+def end_stop_motor():
+    # Blocked by an end stop: the motor reports 'stalled'
+    motor = SimulatedMotor(speed_sp=SPEED)
+    motor.end_stop = -SPEED // 10
+    motor.run_to_abs_pos(position_sp=-SPEED)
+    return motor
+
+
+def test_stall_at_end_stop():
+    motor = end_stop_motor()
+    assert wait_for_motors(motor, timeout=1.0) == [motor]
+
+
+def test_motor_stalled_at_end_stop():
+    with pytest.raises(MotorStalled):
+        wait_for_motors(end_stop_motor(), timeout=1.0, raise_on_stall=True)
+
+
+def test_stall_without_moving():
+    motor = SimulatedMotor(speed_sp=0)
+    motor.run_forever()
+    start = perf_counter()
+    assert wait_for_motors(motor, timeout=2.0, stall_time=0.3) == [motor]
+    assert 0.3 <= perf_counter() - start < 0.5
+
+
+def test_motor_timeout():
+    motor = SimulatedMotor(speed_sp=SPEED)
+    motor.run_forever()
+    start = perf_counter()
+    try:
+        with pytest.raises(MotorTimeout):
+            wait_for_motors(motor, timeout=0.3)
+    finally:
+        motor.stop()
+    assert 0.3 <= perf_counter() - start < 0.5
@@ -0,0 +1,47 @@
+''' Tests of the motor trace analysis of ksm_tictactoe_motortrace.
+
+Run with:
+    python3 -m pytest test_ksm_tictactoe_motortrace.py
+'''
+import numpy as np
+
+from ksm_tictactoe_motortrace import analyse, save_trace, load_trace, \
+     RUNNING
+
+
+def overlapping_trace():
+    ''' Two motors that move at the same time, 1 s at 100 Hz.'''
+    time = np.arange(100) / 100.0
+    turn = np.minimum(time, 0.5) * -690
+    move = np.minimum(time, 0.8) * -1000
+    running = np.stack([time < 0.5, time < 0.8], axis=1)
+    return {'name': 'draw_computer_move', 'info': {'field': 4},
+            'motors': ['turn', 'move'], 'rate': 100, 'end': 1.0,
+            'time': time,
+            'position': np.stack([turn, move], axis=1).astype(np.int32),
+            'speed': np.where(running, 690, 0).astype(np.int32),
+            'state': np.where(running, RUNNING, 0).astype(np.uint8),
+            'segments': [('draw.turn', 0.0, 0.6, 'turn'),
+                         ('draw.move', 0.0, 0.9, 'move')]}
+
+
+def test_segment_reports_only_its_own_motor():
+    results = analyse(overlapping_trace())
+    assert [(result['segment'], result['motor']) for result in results] == \
+        [('draw.turn', 'turn'), ('draw.move', 'move')]
+    assert results[0]['travel'] == -345
+
+
+def test_segment_without_axis_reports_all_moving_motors():
+    trace = overlapping_trace()
+    trace['segments'] = [('draw.move_to_field', 0.0, 0.9, None)]
+    assert [result['motor'] for result in analyse(trace)] == \
+        ['turn', 'move']
+
+
+def test_axes_are_saved(tmp_path):
+    filename = str(tmp_path / 'move_000001.npz')
+    trace = overlapping_trace()
+    trace['segments'].append(('draw.home', 0.5, None, None))
+    save_trace(filename, trace)
+    assert load_trace(filename)['segments'] == trace['segments']
@@ -0,0 +1,64 @@
+''' Tests of the precomputed move table of ksm_tictactoe_movetable.
+
+Run with:
+    python3 -m pytest test_ksm_tictactoe_movetable.py
+'''
+import os
+
+import pytest
+
+from ksm_tictactoe_movetable import MoveTable, Solver, write_table, verify, \
+     SYMMETRIES, TABLE_FILE, EMPTY, AI, HU
+
+# Reachable positions with the computer to move
+POSITIONS = 4520
+
+
+@pytest.fixture(scope='module')
+def table_file(tmp_path_factory):
+    filename = str(tmp_path_factory.mktemp('movetable') / TABLE_FILE)
+    write_table(Solver().build(), filename)
+    return filename
+
+
+def test_table_agrees_with_minimax(table_file):
+    table = MoveTable(table_file)
+    try:
+        assert verify(table) == POSITIONS
+    finally:
+        table.close()
+
+
+def test_shipped_table_is_up_to_date(table_file):
+    shipped = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           TABLE_FILE)
+    with open(shipped, 'rb') as f, open(table_file, 'rb') as g:
+        assert f.read() == g.read()
+
+
+def test_symmetric_positions_get_the_same_score(table_file):
+    cells = (HU, EMPTY, EMPTY,
+             EMPTY, AI, EMPTY,
+             EMPTY, EMPTY, HU)
+    table = MoveTable(table_file)
+    try:
+        expected = table.lookup_cells(cells)
+        for perm in SYMMETRIES:
+            transformed = tuple(cells[p] for p in perm)
+            result = table.lookup_cells(transformed)
+            assert result['score'] == expected['score']
+            # The move is mapped back to a free cell of this board
+            assert transformed[result['index']] == EMPTY
+    finally:
+        table.close()
+
+
+def test_position_without_a_move(table_file):
+    table = MoveTable(table_file)
+    try:
+        # The computer has three in a row: game over
+        assert table.lookup_cells((AI, AI, AI,
+                                   HU, HU, EMPTY,
+                                   EMPTY, EMPTY, EMPTY)) is None
+    finally:
+        table.close()
@@ -0,0 +1,101 @@
+''' Tests of ksm_tictactoe_planner on simulated motors.
+
+Run with:
+    python3 -m pytest test_ksm_tictactoe_planner.py
+'''
+from time import perf_counter
+
+import pytest
+
+import ksm_tictactoe_retry
+from ksm_tictactoe_planner import MotionPlanner, execute, \
+     _simulated_motors
+from ksm_tictactoe_retry import retry, ErrorLog, PortHealth, \
+     ExceededRetries
+from ksm_tictactoe_simulated_devices import SimulatedMotor, PEN_PORT
+
+
+class FlakyMotor(SimulatedMotor):
+    ''' Simulated motor whose state fails with OSError failures times.'''
+    def __init__(self, failures, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+
+    @property
+    def state(self):
+        if self.failures:
+            self.failures -= 1
+            raise OSError(121, 'Remote I/O error')
+        return SimulatedMotor.state.fget(self)
+
+
+class LateMotor(SimulatedMotor):
+    ''' Simulated motor that reports standstill at its old position for
+        20 ms after a command, like an ev3dev motor may.'''
+    def _update(self, elapsed=None):
+        if elapsed is None:
+            elapsed = perf_counter() - self._start_time
+        if elapsed < 0.02:
+            return self._start_position, False
+        return super()._update(elapsed - 0.02)
+
+
+@pytest.fixture
+def health(monkeypatch, tmp_path):
+    ''' Fresh failure counters, errors logged to a temporary file.'''
+    health = PortHealth()
+    monkeypatch.setattr(ksm_tictactoe_retry, 'health', health)
+    monkeypatch.setattr(ksm_tictactoe_retry, 'error_log',
+                        ErrorLog(str(tmp_path / 'logfile.txt')))
+    return health
+
+
+def flaky_motors(failures):
+    motors = _simulated_motors()
+    motors['pen'] = FlakyMotor(failures, address=PEN_PORT,
+                               position=motors['pen'].position)
+    return motors
+
+
+# As Tic_tac_toe_machine.draw_computer_move(): the cross itself is not
+# retried
+@retry('draw', ports=lambda *args: ())
+def draw(motors, field_index):
+    return execute(MotionPlanner().plan(field_index), motors)
+
+
+def test_flaky_planned_move_is_charged_to_its_port(health):
+    motors = flaky_motors(1)
+    times = draw(motors, 4)
+    assert all(end is not None for start, end in times.values())
+    assert health.failures == {PEN_PORT: 1}
+    assert health.consecutive[PEN_PORT] == 0
+
+
+def test_failing_port_ends_the_planned_move(health):
+    motors = flaky_motors(100)
+    with pytest.raises(ExceededRetries):
+        draw(motors, 4)
+    assert health.failures[PEN_PORT] == \
+        ksm_tictactoe_retry.POLICIES['wait'].attempts
+
+
+def test_ramps_are_restored(health):
+    motors = _simulated_motors()
+    for motor in motors.values():
+        motor.ramp_up_sp = 111
+        motor.ramp_down_sp = 222
+    execute(MotionPlanner().plan(0), motors)
+    assert all((motor.ramp_up_sp, motor.ramp_down_sp) == (111, 222)
+               for motor in motors.values())
+
+
+def test_steps_wait_for_motors_that_start_late(health):
+    motors = {axis: LateMotor(position=motor.position,
+                              max_speed=motor.max_speed)
+              for axis, motor in _simulated_motors().items()}
+    steps = MotionPlanner().plan(4)
+    execute(steps, motors)
+    targets = {step.axis: step.target for step in steps}
+    for axis, motor in motors.items():
+        assert abs(motor.position - targets[axis]) <= 5
@@ -0,0 +1,121 @@
+''' Tests of the move detection of ksm_tictactoe_vision.
+
+Run with:
+    python3 -m pytest test_ksm_tictactoe_vision.py
+'''
+from time import perf_counter, sleep
+
+import cv2
+import pytest
+
+from ksm_tictactoe_camera import ROI_X, ROI_Y, render_board
+from ksm_tictactoe_core_ps import Board
+from ksm_tictactoe_vision import HoughDetector, IncrementalDetector, \
+     StreamingMoveDetector, StreamEnded, EMPTY
+
+
+def board_image(fields):
+    ''' Return the board region of a synthetic camera image.'''
+    img = render_board(fields)
+    return img[ROI_Y[0]:ROI_Y[1], ROI_X[0]:ROI_X[1]].copy()
+
+
+class MissingEngine:
+    ''' HoughDetector that misses all circles of the first misses calls.'''
+    def __init__(self, misses):
+        self.engine = HoughDetector()
+        self.misses = misses
+
+    def detect(self, img, boundaries):
+        if self.misses:
+            self.misses -= 1
+            return []
+        return self.engine.detect(img, boundaries)
+
+
+def test_circle_missed_on_the_first_turn_is_found_later():
+    fields = [None] * 9
+    fields[4] = 'O'
+    board = Board()
+    detector = IncrementalDetector(engine=MissingEngine(1))
+    img = board_image(fields)
+    assert detector.detect(img, board) == []
+    # Nothing changed on the board, the missed circle is checked again
+    assert detector.detect(img, board) == [4]
+    assert board.index[4] == board.HU_PLAYER
+
+
+def test_first_turn_only_checks_fields_with_moves():
+    fields = [None] * 9
+    fields[0] = 'O'
+    board = Board()
+    detector = IncrementalDetector()
+    assert detector.detect(board_image(fields), board) == [0]
+    # The empty fields look like the empty board: no circle checks
+    assert detector.stats['circle_checks'] == 1
+
+
+class HandCamera:
+    ''' Video port stand-in: an empty board with a hand moving over it
+        from enter until leave seconds after the first frame.'''
+    resolution = (1024, 768)
+
+    def __init__(self, enter, leave, duration, fps=30.0):
+        self.enter = enter
+        self.leave = leave
+        self.duration = duration
+        self.fps = fps
+
+    def capture_continuous(self, output, format='bgr', use_video_port=True,
+                           resize=None, **kwargs):
+        board = render_board([EMPTY] * 9, self.resolution)
+        start = perf_counter()
+        for nr in range(int(self.duration * self.fps)):
+            t = nr / self.fps
+            frame = board
+            if self.enter <= t < self.leave:
+                # The hand, a dark block moving across the board
+                frame = board.copy()
+                x = ROI_X[0] + int(400 * (t - self.enter)) % 150
+                frame[ROI_Y[0]:ROI_Y[0] + 100, x:x + 80] = 60
+            cv2.resize(frame, resize, dst=output,
+                       interpolation=cv2.INTER_AREA)
+            sleep(max(0.0, start + t - perf_counter()))
+            yield output
+
+
+class FailingCamera(HandCamera):
+    ''' Video port whose stream fails after a few frames.'''
+    def capture_continuous(self, output, **kwargs):
+        frames = super().capture_continuous(output, **kwargs)
+        for nr in range(3):
+            yield next(frames)
+        raise OSError('camera gone')
+
+
+@pytest.mark.parametrize('leave', [0.3, 0.45, 0.7, 0.95, 1.2, 1.4])
+def test_streamed_move_is_detected_across_timeouts(leave):
+    # wait_for_move() is called in a loop with short timeouts, like the
+    # game does; the hand leaves the board after leave seconds
+    camera = HandCamera(max(0.05, leave - 0.25), leave, leave + 1.5)
+    streamer = StreamingMoveDetector(camera, lambda: (1, None))
+    streamer.start()
+    try:
+        result = None
+        while result is None:
+            result = streamer.wait_for_move(0.5)
+    finally:
+        streamer.stop()
+    assert result == (1, None)
+
+
+def test_failing_stream_ends():
+    camera = FailingCamera(0.0, 0.0, 10.0)
+    streamer = StreamingMoveDetector(camera, lambda: (1, None))
+    streamer.start()
+    try:
+        with pytest.raises(StreamEnded):
+            for _ in range(10):
+                streamer.wait_for_move(0.5)
+    finally:
+        streamer.stop()